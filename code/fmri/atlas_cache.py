@@ -0,0 +1,570 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+#
+# Copyright 2023 The Axon Lab <theaxonlab@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# We support and encourage derived works from this project, please read
+# about our expectations at
+#
+#     https://www.nipreps.org/community/licensing/
+#
+"""Python module for caching atlas projection operators on the BOLD grids and the
+geometry of the atlas regions"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import shutil
+import tempfile
+from typing import Iterator, Optional, Union
+
+import nibabel as nib
+import numpy as np
+from nibabel.openers import ImageOpener
+
+ATLAS_CACHE_DIR: str = op.join(op.expanduser("~"), ".cache", "hcph-sops", "atlas")
+GEOMETRY_CHUNK_MB: float = 256
+
+
+def get_atlas_description(atlas_filename: str) -> dict:
+    """Describe an atlas file for the cache keys.
+
+    Parameters
+    ----------
+    atlas_filename : str
+        Path to the 4D atlas file
+
+    Returns
+    -------
+    dict
+        Path, size, modification time and dimension of the atlas.
+    """
+    atlas_stat = os.stat(atlas_filename)
+    atlas_header = nib.load(atlas_filename).header
+
+    return {
+        "atlas": op.abspath(atlas_filename),
+        "size": atlas_stat.st_size,
+        "mtime": atlas_stat.st_mtime_ns,
+        "dimension": int(atlas_header.get_data_shape()[3]),
+    }
+
+
+def get_projection_key(
+    atlas_filename: str, target_affine: np.ndarray, target_shape: tuple
+) -> str:
+    """Return the cache key of an atlas resampled to a target grid.
+
+    Parameters
+    ----------
+    atlas_filename : str
+        Path to the 4D atlas file
+    target_affine : np.ndarray
+        Affine of the target grid
+    target_shape : tuple
+        Spatial shape of the target grid
+
+    Returns
+    -------
+    str
+        Hexadecimal key identifying the atlas (path, size, modification time and
+        dimension) and the target grid.
+    """
+    description = {
+        **get_atlas_description(atlas_filename),
+        "affine": np.round(np.asarray(target_affine, dtype=float), 6).tolist(),
+        "shape": [int(n) for n in target_shape[:3]],
+    }
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def compute_projection(
+    atlas_filename: str, target_affine: np.ndarray, target_shape: tuple
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Resample the atlas maps to the target grid and compute the projection
+    operator.
+
+    The regional signals are the least-squares solution of ``maps @ signals =
+    data``. Voxels outside of the support of the maps do not change the solution,
+    so the operator is the pseudo-inverse of the maps restricted to their support.
+
+    Parameters
+    ----------
+    atlas_filename : str
+        Path to the 4D atlas file
+    target_affine : np.ndarray
+        Affine of the target grid
+    target_shape : tuple
+        Spatial shape of the target grid
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        Flat (Fortran-ordered) indices of the voxels in the support of the maps,
+        resampled maps of shape (n_voxels, n_regions) restricted to that support
+        and the pseudo-inverse projection operator of shape (n_regions, n_voxels).
+    """
+    from nilearn.image import resample_img
+
+    logging.info("Computing the atlas projection operator on the BOLD grid ...")
+
+    maps_img = resample_img(
+        atlas_filename,
+        interpolation="continuous",
+        target_shape=tuple(target_shape[:3]),
+        target_affine=target_affine,
+    )
+    maps = np.asarray(maps_img.dataobj, dtype=float)
+    maps = maps.reshape(-1, maps.shape[-1], order="F")
+    np.nan_to_num(maps, copy=False)
+
+    voxels = np.flatnonzero(maps.any(axis=1))
+    maps = maps[voxels]
+
+    return voxels, maps, np.linalg.pinv(maps)
+
+
+def get_atlas_projection(
+    atlas_filename: str,
+    target_affine: np.ndarray,
+    target_shape: tuple,
+    cache_dir: str = ATLAS_CACHE_DIR,
+    dtype: type = np.float64,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Load (or compute and store) the projection operator of the atlas on a grid.
+
+    Parameters
+    ----------
+    atlas_filename : str
+        Path to the 4D atlas file
+    target_affine : np.ndarray
+        Affine of the target grid
+    target_shape : tuple
+        Spatial shape of the target grid
+    cache_dir : str, optional
+        Directory of the persistent cache, by default ATLAS_CACHE_DIR
+    dtype : type, optional
+        Data type of the operator, by default np.float64 (other types are stored
+        alongside the double precision operator the first time they are requested)
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Flat indices of the voxels in the support of the maps and memory-mapped
+        projection operator of shape (n_regions, n_voxels).
+    """
+    key = get_projection_key(atlas_filename, target_affine, target_shape)
+    entry = op.join(cache_dir, key)
+
+    if not op.exists(op.join(entry, "operator.npy")):
+        voxels, maps, operator = compute_projection(
+            atlas_filename, target_affine, target_shape
+        )
+
+        # Write in a temporary folder first so that concurrent runs never read
+        # a partially written entry.
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(dir=cache_dir, prefix=f".{key}-")
+        np.save(op.join(tmp_entry, "voxels.npy"), voxels)
+        np.save(op.join(tmp_entry, "maps.npy"), maps)
+        np.save(op.join(tmp_entry, "operator.npy"), operator)
+        with open(op.join(tmp_entry, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "atlas": op.abspath(atlas_filename),
+                    "affine": np.asarray(target_affine).tolist(),
+                    "shape": [int(n) for n in target_shape[:3]],
+                    "n_regions": int(operator.shape[0]),
+                    "n_voxels": int(operator.shape[1]),
+                },
+                f,
+                indent=2,
+            )
+
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another process stored the same entry in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        logging.debug(f"Atlas projection operator stored in: {entry}")
+
+    operator_filename = op.join(entry, "operator.npy")
+    if np.dtype(dtype) != np.float64:
+        operator_filename = op.join(entry, f"operator.{np.dtype(dtype).name}.npy")
+        if not op.exists(operator_filename):
+            operator = np.load(op.join(entry, "operator.npy"), mmap_mode="r")
+            fd, tmp_filename = tempfile.mkstemp(dir=entry, suffix=".npy")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, operator.astype(dtype))
+            os.replace(tmp_filename, operator_filename)
+
+    return (
+        np.load(op.join(entry, "voxels.npy")),
+        np.load(operator_filename, mmap_mode="r"),
+    )
+
+
+def compute_centroids(
+    atlas_filename: str, chunk_mb: float = GEOMETRY_CHUNK_MB
+) -> tuple[np.ndarray, np.ndarray]:
+    """Compute the centers of mass of all the regions of a 4D atlas.
+
+    The maps are streamed once by chunks of regions, and the centers of mass of
+    each chunk are obtained with a single matrix product with the voxel
+    coordinates (as ``scipy.ndimage.center_of_mass`` would for each region).
+
+    Parameters
+    ----------
+    atlas_filename : str
+        Path to the 4D atlas file
+    chunk_mb : float, optional
+        Memory budget (in MB) of the chunks of regions, by default GEOMETRY_CHUNK_MB
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Centers of mass of shape (n_regions, 3) in voxel and in world coordinates.
+    """
+    atlas_img = nib.load(atlas_filename)
+    n_regions = atlas_img.shape[3]
+
+    # Voxel coordinates in the (Fortran) order of the streamed volumes
+    coordinates = np.ascontiguousarray(
+        np.indices(atlas_img.shape[:3], dtype=float).reshape(3, -1, order="F")
+    )
+
+    centroids = np.empty((n_regions, 3))
+    for start, maps in iter_volume_chunks(atlas_img, chunk_mb):
+        maps = np.nan_to_num(maps.astype(float), copy=False)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            centroids[start : start + maps.shape[1]] = (
+                (coordinates @ maps) / maps.sum(axis=0)
+            ).T
+
+    return centroids, nib.affines.apply_affine(atlas_img.affine, centroids)
+
+
+def get_atlas_geometry(
+    atlas_filename: str, cache_dir: str = ATLAS_CACHE_DIR
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Load (or compute and store) the geometry of the atlas regions.
+
+    Parameters
+    ----------
+    atlas_filename : str
+        Path to the 4D atlas file
+    cache_dir : str, optional
+        Directory of the persistent cache, by default ATLAS_CACHE_DIR
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        Centers of mass of the regions in voxel and world coordinates (of shape
+        (n_regions, 3)), and the condensed vector of the euclidean distances (in
+        mm) between them, in the order of ``np.triu_indices(n_regions, k=1)``.
+    """
+    from scipy.spatial.distance import pdist
+
+    description = {**get_atlas_description(atlas_filename), "geometry": True}
+    key = hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+    entry = op.join(cache_dir, key)
+
+    if not op.exists(op.join(entry, "distances.npy")):
+        logging.info("Computing the centers of mass of the atlas regions ...")
+        centroids, centroids_world = compute_centroids(atlas_filename)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(dir=cache_dir, prefix=f".{key}-")
+        np.save(op.join(tmp_entry, "centroids.npy"), centroids)
+        np.save(op.join(tmp_entry, "centroids_world.npy"), centroids_world)
+        np.save(op.join(tmp_entry, "distances.npy"), pdist(centroids_world))
+        with open(op.join(tmp_entry, "meta.json"), "w") as f:
+            json.dump(
+                {**description, "n_regions": int(centroids.shape[0])}, f, indent=2
+            )
+
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another process stored the same entry in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        logging.debug(f"Atlas geometry stored in: {entry}")
+
+    return (
+        np.load(op.join(entry, "centroids.npy")),
+        np.load(op.join(entry, "centroids_world.npy")),
+        np.load(op.join(entry, "distances.npy")),
+    )
+
+
+def iter_volume_chunks(
+    img: Union[str, nib.Nifti1Image], chunk_mb: float
+) -> Iterator[tuple[int, np.ndarray]]:
+    """Stream the volumes of a 4D NIfTI image by chunks.
+
+    The (possibly compressed) file is read sequentially once, and only one chunk
+    of volumes is resident at a time.
+
+    Parameters
+    ----------
+    img : Union[str, nib.Nifti1Image]
+        4D image (or path to it)
+    chunk_mb : float
+        Memory budget (in MB) of a chunk of volumes, including its conversion to
+        double precision
+
+    Yields
+    ------
+    Iterator[tuple[int, np.ndarray]]
+        Index of the first volume of the chunk and the scaled data of the chunk, of
+        shape (n_voxels, n_volumes) with voxels in Fortran order.
+    """
+    if isinstance(img, str):
+        img = nib.load(img)
+
+    proxy = img.dataobj
+    n_voxels = int(np.prod(proxy.shape[:3]))
+    n_volumes = proxy.shape[3] if len(proxy.shape) > 3 else 1
+    volume_bytes = n_voxels * proxy.dtype.itemsize
+
+    chunk_size = int(chunk_mb * 2**20 // (n_voxels * (proxy.dtype.itemsize + 8)))
+    chunk_size = min(max(chunk_size, 1), n_volumes)
+    logging.debug(f"Streaming {n_volumes} volumes by chunks of {chunk_size}.")
+
+    slope, inter = proxy.slope, proxy.inter
+    with ImageOpener(img.get_filename(), "rb") as f:
+        f.seek(proxy.offset)
+        for start in range(0, n_volumes, chunk_size):
+            n_chunk = min(chunk_size, n_volumes - start)
+            buffer = f.read(volume_bytes * n_chunk)
+            data = np.frombuffer(buffer, dtype=proxy.dtype).reshape(
+                (n_voxels, n_chunk), order="F"
+            )
+            if slope != 1 or inter != 0:
+                data = data * slope + inter
+            yield start, data
+
+
+def project_img(
+    img: Union[str, nib.Nifti1Image],
+    atlas_filename: Union[str, list[str]],
+    cache_dir: str = ATLAS_CACHE_DIR,
+    chunk_mb: Optional[float] = None,
+    dtype: type = np.float64,
+) -> Union[np.ndarray, list[np.ndarray]]:
+    """Extract the regional signals of a 4D image with the cached projection.
+
+    With several atlases, the image is read once and its data is projected on each
+    of them. With a chunk size, the volumes are streamed and projected by chunks
+    so that only the regional signals stay resident.
+
+    Parameters
+    ----------
+    img : Union[str, nib.Nifti1Image]
+        4D image (or path to it)
+    atlas_filename : Union[str, list[str]]
+        Path to the 4D atlas file (or list of paths)
+    cache_dir : str, optional
+        Directory of the persistent cache, by default ATLAS_CACHE_DIR
+    chunk_mb : Optional[float], optional
+        Memory budget (in MB) of the chunks of volumes, by default None (the whole
+        image is loaded)
+    dtype : type, optional
+        Data type of the projection and of the signals, by default np.float64
+
+    Returns
+    -------
+    Union[np.ndarray, list[np.ndarray]]
+        Regional signals of shape (n_timepoints, n_regions) (one per atlas if a
+        list of atlases is given)
+    """
+    if isinstance(img, str):
+        img = nib.load(img)
+
+    if chunk_mb is not None:
+        return project_img_chunked(img, atlas_filename, cache_dir, chunk_mb, dtype)
+
+    atlas_filenames = (
+        [atlas_filename] if isinstance(atlas_filename, str) else atlas_filename
+    )
+    projections = [
+        get_atlas_projection(
+            filename, img.affine, img.shape[:3], cache_dir=cache_dir, dtype=dtype
+        )
+        for filename in atlas_filenames
+    ]
+
+    data = np.asarray(img.dataobj)
+    data = data.reshape(-1, data.shape[-1], order="F")
+
+    signals = []
+    for voxels, operator in projections:
+        support = np.nan_to_num(data[voxels].astype(dtype, copy=False), copy=False)
+        signals.append((operator @ support).T)
+
+    return signals[0] if isinstance(atlas_filename, str) else signals
+
+
+def project_img_chunked(
+    img: nib.Nifti1Image,
+    atlas_filename: Union[str, list[str]],
+    cache_dir: str = ATLAS_CACHE_DIR,
+    chunk_mb: float = 256,
+    dtype: type = np.float64,
+) -> Union[np.ndarray, list[np.ndarray]]:
+    """Extract the regional signals of a 4D image by streaming chunks of volumes.
+
+    Parameters
+    ----------
+    img : nib.Nifti1Image
+        4D image
+    atlas_filename : Union[str, list[str]]
+        Path to the 4D atlas file (or list of paths)
+    cache_dir : str, optional
+        Directory of the persistent cache, by default ATLAS_CACHE_DIR
+    chunk_mb : float, optional
+        Memory budget (in MB) of the chunks of volumes, by default 256
+    dtype : type, optional
+        Data type of the projection and of the signals, by default np.float64
+
+    Returns
+    -------
+    Union[np.ndarray, list[np.ndarray]]
+        Regional signals of shape (n_timepoints, n_regions) (one per atlas if a
+        list of atlases is given)
+    """
+    atlas_filenames = (
+        [atlas_filename] if isinstance(atlas_filename, str) else atlas_filename
+    )
+    projections = [
+        get_atlas_projection(
+            filename, img.affine, img.shape[:3], cache_dir=cache_dir, dtype=dtype
+        )
+        for filename in atlas_filenames
+    ]
+
+    n_volumes = img.shape[3]
+    signals = [
+        np.empty((n_volumes, operator.shape[0]), dtype=dtype)
+        for _, operator in projections
+    ]
+    for start, data in iter_volume_chunks(img, chunk_mb):
+        for (voxels, operator), atlas_signals in zip(projections, signals):
+            support = np.nan_to_num(data[voxels].astype(dtype, copy=False), copy=False)
+            atlas_signals[start : start + data.shape[1]] = (operator @ support).T
+
+    return signals[0] if isinstance(atlas_filename, str) else signals
+
+
+def transform_cached(
+    func_filename: list[str],
+    atlas_filename: Union[str, list[str]],
+    confounds: Optional[list] = None,
+    sample_mask: Optional[list] = None,
+    cache_dir: str = ATLAS_CACHE_DIR,
+    n_jobs: int = 1,
+    chunk_mb: Optional[float] = None,
+    dtype: type = np.float64,
+    **kwargs,
+) -> Union[list[np.ndarray], list[list[np.ndarray]]]:
+    """Extract and denoise regional timeseries with the cached atlas projection.
+
+    This is equivalent to NiLearn's MultiNiftiMapsMasker (without mask image nor
+    smoothing): the signals are projected on the atlas and then cleaned. With
+    several atlases, each file is read once for all of them.
+
+    Parameters
+    ----------
+    func_filename : list[str]
+        List of BIDS functional filenames
+    atlas_filename : Union[str, list[str]]
+        Path to the atlas file (or list of paths)
+    confounds : Optional[list], optional
+        List of confounds (usually from nilearn.interface.fmriprep.load_confounds),
+        by default None
+    sample_mask : Optional[list], optional
+        List of sample masks (usually from nilearn.interface.fmriprep.load_confounds),
+        by default None
+    cache_dir : str, optional
+        Directory of the persistent cache, by default ATLAS_CACHE_DIR
+    n_jobs : int, optional
+        Number of parallel jobs, by default 1
+    chunk_mb : Optional[float], optional
+        Memory budget (in MB) of the chunks of volumes streamed by each job, by
+        default None (the whole images are loaded)
+    dtype : type, optional
+        Data type of the projection and of the timeseries, by default np.float64
+
+    Returns
+    -------
+    Union[list[np.ndarray], list[list[np.ndarray]]]
+        List of extracted and denoised timeseries (one list per atlas if a list of
+        atlases is given)
+    """
+    from joblib import Parallel, delayed
+    from nilearn.signal import clean
+
+    if confounds is None:
+        confounds = [None] * len(func_filename)
+    if sample_mask is None:
+        sample_mask = [None] * len(func_filename)
+
+    # Same defaults as NiLearn's maskers (no detrending)
+    clean_kwargs = {"detrend": False}
+    clean_kwargs |= {
+        key: kwargs[key]
+        for key in ["standardize", "detrend", "low_pass", "high_pass", "t_r"]
+        if key in kwargs
+    }
+
+    atlas_filenames = (
+        [atlas_filename] if isinstance(atlas_filename, str) else atlas_filename
+    )
+
+    def _transform_single(filename, conf, sm):
+        return [
+            clean(signals, confounds=conf, sample_mask=sm, **clean_kwargs).astype(
+                dtype, copy=False
+            )
+            for signals in project_img(
+                filename,
+                atlas_filenames,
+                cache_dir=cache_dir,
+                chunk_mb=chunk_mb,
+                dtype=dtype,
+            )
+        ]
+
+    # Compute the operators once before the parallel jobs look them up
+    if len(func_filename):
+        img = nib.load(func_filename[0])
+        for filename in atlas_filenames:
+            get_atlas_projection(filename, img.affine, img.shape[:3], cache_dir, dtype)
+
+    # Threads share the memory-mapped operators, and reading the compressed volumes
+    # and projecting them release the GIL.
+    time_series = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(_transform_single)(filename, conf, sm)
+        for filename, conf, sm in zip(func_filename, confounds, sample_mask)
+    )
+
+    # From one list per file to one list per atlas
+    time_series = [list(atlas_time_series) for atlas_time_series in zip(*time_series)]
+    if not time_series:
+        time_series = [[] for _ in atlas_filenames]
+
+    return time_series[0] if isinstance(atlas_filename, str) else time_series
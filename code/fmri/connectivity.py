@@ -0,0 +1,654 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+#
+# Copyright 2023 The Axon Lab <theaxonlab@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# We support and encourage derived works from this project, please read
+# about our expectations at
+#
+#     https://www.nipreps.org/community/licensing/
+#
+"""Python module for batched functional connectivity estimation"""
+
+import logging
+import time
+import warnings
+from collections import defaultdict
+from typing import Optional
+
+import numpy as np
+
+CONNECTIVITY_BATCH_SIZE: int = 32
+SPARSE_N_FOLDS: int = 5
+
+
+def ledoit_wolf_batch(
+    time_series: np.ndarray, standardize: bool = False
+) -> np.ndarray:
+    """Ledoit-Wolf shrunk covariances of a batch of equal-length timeseries.
+
+    This reproduces scikit-learn's ``LedoitWolf().fit(x).covariance_`` (and
+    NiLearn's standardization for correlations) for all the timeseries at once.
+
+    Parameters
+    ----------
+    time_series : np.ndarray
+        Timeseries of shape (n_subjects, n_timepoints, n_regions)
+    standardize : bool, optional
+        Condition to z-score the timeseries before estimating the covariance,
+        by default False
+
+    Returns
+    -------
+    np.ndarray
+        Shrunk covariances of shape (n_subjects, n_regions, n_regions)
+    """
+    n_samples, n_features = time_series.shape[1:]
+
+    X = time_series - time_series.mean(axis=1, keepdims=True)
+    if standardize:
+        std = X.std(axis=1, keepdims=True)
+        std[std < np.finfo(float).eps] = 1.0
+        X /= std
+
+    emp_cov = np.einsum("sti,stj->sij", X, X, optimize=True) / n_samples
+    mu = np.einsum("sii->s", emp_cov) / n_features
+
+    # Same shrinkage as sklearn.covariance.ledoit_wolf_shrinkage
+    beta_ = ((X**2).sum(axis=2) ** 2).sum(axis=1)
+    delta_ = (emp_cov**2).sum(axis=(1, 2))
+    beta = (beta_ / n_samples - delta_) / (n_features * n_samples)
+    delta = (delta_ - n_features * mu**2) / n_features
+    beta = np.minimum(beta, delta)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shrinkage = np.where(beta == 0, 0.0, beta / delta)
+
+    shrunk_cov = (1 - shrinkage)[:, np.newaxis, np.newaxis] * emp_cov
+    diagonal = np.arange(n_features)
+    shrunk_cov[:, diagonal, diagonal] += (shrinkage * mu)[:, np.newaxis]
+
+    return shrunk_cov
+
+
+def cov_to_corr_batch(covariances: np.ndarray) -> np.ndarray:
+    """Convert a batch of covariances to correlations.
+
+    Parameters
+    ----------
+    covariances : np.ndarray
+        Covariances of shape (n_subjects, n_regions, n_regions)
+
+    Returns
+    -------
+    np.ndarray
+        Correlations of shape (n_subjects, n_regions, n_regions)
+    """
+    inv_std = 1.0 / np.sqrt(np.einsum("sii->si", covariances))
+    return covariances * inv_std[:, :, np.newaxis] * inv_std[:, np.newaxis, :]
+
+
+def batched_connectivity(
+    time_series: list[np.ndarray],
+    connectivity_kind: str = "correlation",
+    dtype: type = np.float32,
+    batch_size: int = CONNECTIVITY_BATCH_SIZE,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Compute Ledoit-Wolf correlation or covariance matrices of all the timeseries.
+
+    Timeseries of equal length are stacked and estimated together by batches,
+    and the results are written into a preallocated buffer.
+
+    Parameters
+    ----------
+    time_series : list[np.ndarray]
+        List of timeseries of shape (n_timepoints, n_regions)
+    connectivity_kind : str, optional
+        Type of connectivity to compute, "correlation" or "covariance", by
+        default "correlation"
+    dtype : type, optional
+        Data type of the output, by default np.float32
+    batch_size : int, optional
+        Maximum number of timeseries estimated together, by default
+        CONNECTIVITY_BATCH_SIZE
+    out : Optional[np.ndarray], optional
+        Output buffer of shape (n_subjects, n_regions, n_regions), by default None
+
+    Returns
+    -------
+    np.ndarray
+        Connectivity matrices of shape (n_subjects, n_regions, n_regions) with a
+        null diagonal.
+    """
+    if connectivity_kind not in ["correlation", "covariance"]:
+        raise ValueError(
+            f"Batched connectivity is not available for '{connectivity_kind}'."
+        )
+
+    n_area = time_series[0].shape[-1]
+    if out is None:
+        out = np.empty((len(time_series), n_area, n_area), dtype=dtype)
+
+    # Group the timeseries by length so they can be stacked
+    indices_by_length = defaultdict(list)
+    for i, ts in enumerate(time_series):
+        indices_by_length[ts.shape[0]].append(i)
+
+    for n_timepoints, indices in indices_by_length.items():
+        logging.debug(
+            f"Estimating {len(indices)} connectivity matrices of timeseries with "
+            f"{n_timepoints} timepoints."
+        )
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start : start + batch_size]
+            # Single precision timeseries are estimated in single precision
+            stacked = np.stack([time_series[i] for i in batch]).astype(
+                np.result_type(np.float32, *(time_series[i].dtype for i in batch)),
+                copy=False,
+            )
+
+            covariances = ledoit_wolf_batch(
+                stacked, standardize=connectivity_kind == "correlation"
+            )
+            if connectivity_kind == "correlation":
+                covariances = cov_to_corr_batch(covariances)
+
+            out[batch] = covariances
+
+    diagonal = np.arange(n_area)
+    out[:, diagonal, diagonal] = 0
+
+    return out
+
+
+def alpha_max(time_series: np.ndarray) -> float:
+    """Smallest regularization for which the sparse precision is diagonal, i.e.
+    the largest off-diagonal empirical covariance (as in scikit-learn).
+
+    Parameters
+    ----------
+    time_series : np.ndarray
+        Timeseries of shape (n_timepoints, n_regions)
+
+    Returns
+    -------
+    float
+        Largest absolute off-diagonal coefficient of the empirical covariance.
+    """
+    from sklearn.covariance import empirical_covariance
+
+    emp_cov = empirical_covariance(time_series)
+    np.fill_diagonal(emp_cov, 0)
+    return float(np.abs(emp_cov).max())
+
+
+def refine_alphas(alphas: np.ndarray, scores: np.ndarray, n_alphas: int) -> np.ndarray:
+    """Refine the grid of regularizations around the best cross-validated score,
+    as GraphicalLassoCV does between two refinements.
+
+    Parameters
+    ----------
+    alphas : np.ndarray
+        Evaluated regularizations, in decreasing order
+    scores : np.ndarray
+        Cross-validated log-likelihood of each regularization
+    n_alphas : int
+        Number of regularizations of the refined grid
+
+    Returns
+    -------
+    np.ndarray
+        Refined grid of regularizations, in decreasing order.
+    """
+    scores = np.where(np.isfinite(scores), scores, -np.inf)
+    best_index = int(np.argmax(scores))
+    last_finite_index = int(np.flatnonzero(np.isfinite(scores))[-1])
+
+    if best_index == 0:
+        alpha_1, alpha_0 = alphas[0], alphas[1]
+    elif best_index == last_finite_index and best_index != len(alphas) - 1:
+        # The next regularization did not converge, search in between
+        alpha_1, alpha_0 = alphas[best_index], alphas[best_index + 1]
+    elif best_index == len(alphas) - 1:
+        alpha_1, alpha_0 = alphas[best_index], 0.01 * alphas[best_index]
+    else:
+        alpha_1, alpha_0 = alphas[best_index - 1], alphas[best_index + 1]
+
+    return np.logspace(np.log10(alpha_1), np.log10(alpha_0), n_alphas + 2)[1:-1]
+
+
+def _pooled_path(
+    fold_scores: list[dict], indices: list[int]
+) -> tuple[np.ndarray, np.ndarray]:
+    """Pool the cross-validated scores of some runs along all the evaluated
+    regularizations (in decreasing order).
+    """
+    alphas = np.array(sorted(fold_scores[indices[0]], reverse=True))
+    scores = np.array(
+        [sum(np.mean(fold_scores[i][alpha]) for i in indices) for alpha in alphas]
+    )
+    return alphas, scores
+
+
+def _warm_start(covariance: np.ndarray, emp_cov: np.ndarray) -> np.ndarray:
+    """Rescale the covariance of a previous run to the variances of a new run, so
+    that the initial guess stays positive definite.
+    """
+    std = np.sqrt(np.diag(covariance))
+    new_std = np.sqrt(np.diag(emp_cov))
+    return covariance * np.outer(new_std / std, new_std / std)
+
+
+def _graphical_lasso_first(
+    emp_cov: np.ndarray,
+    alpha: float,
+    cov_inits: list[Optional[np.ndarray]],
+    max_iter: int,
+    tol: float,
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """Fit a sparse covariance from the first initial guess giving a finite
+    solution (None starts from the empirical covariance, as a cold start).
+
+    The warnings of the rejected guesses are discarded, and the errors of the last
+    guess are raised.
+    """
+    from sklearn.covariance._graph_lasso import _graphical_lasso
+
+    for k, cov_init in enumerate(cov_inits):
+        last = k == len(cov_inits) - 1
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            try:
+                covariance, precision, costs, n_iter = _graphical_lasso(
+                    emp_cov, alpha, cov_init=cov_init, tol=tol, max_iter=max_iter
+                )
+            except (FloatingPointError, np.linalg.LinAlgError):
+                if last:
+                    raise
+                continue
+
+        # A warm start can diverge into NaN duality gaps without raising
+        finite = (
+            np.all(np.isfinite(covariance))
+            and np.all(np.isfinite(precision))
+            and np.all(np.isfinite(costs[-1:]))
+        )
+        if finite or last:
+            for warning in caught:
+                warnings.warn(warning.message, warning.category)
+            return covariance, precision, n_iter
+
+
+def _cv_path_chain(
+    time_series: list[np.ndarray],
+    fold: int,
+    n_folds: int,
+    alphas: np.ndarray,
+    max_iter: int,
+    tol: float,
+) -> tuple[np.ndarray, list[float]]:
+    """Score one cross-validation fold along the regularization path for the runs
+    of a participant, each regularization starting from the solution of the
+    previous run at the same regularization.
+    """
+    from sklearn.covariance import empirical_covariance, log_likelihood
+    from sklearn.exceptions import ConvergenceWarning
+    from sklearn.model_selection import KFold
+
+    scores = np.full((len(time_series), len(alphas)), -np.inf)
+    durations = []
+    previous = [None] * len(alphas)
+    for i, ts in enumerate(time_series):
+        start = time.perf_counter()
+        train, test = list(KFold(n_folds).split(ts))[fold]
+        emp_cov = empirical_covariance(ts[train])
+        test_emp_cov = empirical_covariance(ts[test])
+
+        # Without a previous solution (or if it does not give a finite one), the
+        # path starts from the solution of the previous regularization, as in
+        # graphical_lasso_path
+        covariance = None
+        for j, alpha in enumerate(alphas):
+            cov_inits = [covariance]
+            if previous[j] is not None:
+                cov_inits.insert(0, _warm_start(previous[j], emp_cov))
+
+            with warnings.catch_warnings():
+                # Points of the grid that do not converge are expected
+                warnings.simplefilter("ignore", ConvergenceWarning)
+                try:
+                    covariance, precision, _ = _graphical_lasso_first(
+                        emp_cov, alpha, cov_inits, max_iter, tol
+                    )
+                except (FloatingPointError, np.linalg.LinAlgError):
+                    # This point of the path diverged
+                    continue
+
+            score = log_likelihood(test_emp_cov, precision)
+            if np.isfinite(score):
+                scores[i, j] = score
+                previous[j] = covariance
+
+        durations.append(time.perf_counter() - start)
+
+    return scores, durations
+
+
+def _fit_chain(
+    time_series: list[np.ndarray], alphas: list[float], max_iter: int, tol: float
+) -> list[tuple[np.ndarray, int, float]]:
+    """Fit the sparse covariances of the runs of a participant, each run starting
+    from the solution of the previous run with the same regularization.
+    """
+    from scipy import linalg
+    from sklearn.covariance import empirical_covariance
+
+    results = []
+    solutions = {}
+    for ts, alpha in zip(time_series, alphas):
+        start = time.perf_counter()
+        emp_cov = empirical_covariance(ts)
+        cov_inits = [None]
+        if alpha in solutions:
+            cov_inits.insert(0, _warm_start(solutions[alpha], emp_cov))
+        covariance, _, n_iter = _graphical_lasso_first(
+            emp_cov, alpha, cov_inits, max_iter, tol
+        )
+        solutions[alpha] = covariance
+        # Same precision as NiLearn's ConnectivityMeasure
+        results.append((linalg.inv(covariance), n_iter, time.perf_counter() - start))
+
+    return results
+
+
+def sparse_precision(
+    time_series: list[np.ndarray],
+    groups: Optional[list] = None,
+    n_alphas: int = 4,
+    n_refinements: int = 4,
+    n_folds: int = SPARSE_N_FOLDS,
+    max_iter: int = 100,
+    tol: float = 1e-4,
+    shared_alpha: bool = False,
+    n_jobs: int = 1,
+    dtype: type = np.float32,
+) -> tuple[np.ndarray, list[dict]]:
+    """Estimate sparse inverse covariances of all the timeseries.
+
+    This follows GraphicalLassoCV, but the grid of regularizations is shared by
+    the runs of a participant (``groups``), each regularization of a run is
+    warm-started from the solution of the previous run of the same participant at
+    the same regularization (or cold-started if that does not give a finite
+    solution), and the cross-validation folds and participants are distributed
+    over parallel jobs. With
+    ``shared_alpha``, a single regularization is selected for all the runs from
+    their pooled cross-validated scores.
+
+    Parameters
+    ----------
+    time_series : list[np.ndarray]
+        List of timeseries of shape (n_timepoints, n_regions)
+    groups : Optional[list], optional
+        Participant of each timeseries, by default None (every run on its own)
+    n_alphas : int, optional
+        Number of regularizations of each grid, by default 4
+    n_refinements : int, optional
+        Number of times the grid is refined, by default 4
+    n_folds : int, optional
+        Number of cross-validation folds, by default SPARSE_N_FOLDS
+    max_iter : int, optional
+        Maximum number of iterations of the final fits (the cross-validation uses
+        a tenth of it), by default 100
+    tol : float, optional
+        Tolerance on the dual gap, by default 1e-4
+    shared_alpha : bool, optional
+        Condition to select one regularization for all the runs, by default False
+    n_jobs : int, optional
+        Number of parallel jobs, by default 1
+    dtype : type, optional
+        Data type of the output, by default np.float32
+
+    Returns
+    -------
+    tuple[np.ndarray, list[dict]]
+        Precision matrices of shape (n_subjects, n_regions, n_regions) with a null
+        diagonal, and the regularization, number of iterations and timings of each
+        run.
+    """
+    from joblib import Parallel, delayed
+
+    n_ts = len(time_series)
+    time_series = [np.asarray(ts, dtype=float) for ts in time_series]
+    if groups is None:
+        groups = list(range(n_ts))
+
+    members = defaultdict(list)
+    for i, group in enumerate(groups):
+        members[group].append(i)
+
+    # One grid of regularizations per participant, or one for all the runs
+    grid_members = {None: list(range(n_ts))} if shared_alpha else dict(members)
+    alpha_grids = {}
+    for key, indices in grid_members.items():
+        alpha_1 = max(alpha_max(time_series[i]) for i in indices)
+        alpha_grids[key] = np.logspace(
+            np.log10(alpha_1), np.log10(1e-2 * alpha_1), n_alphas
+        )
+
+    fold_scores = [defaultdict(list) for _ in range(n_ts)]
+    cv_durations = np.zeros(n_ts)
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for refinement in range(n_refinements):
+            logging.debug(
+                f"Sparse inverse covariance cross-validation, grid {refinement + 1} "
+                f"out of {n_refinements}."
+            )
+            tasks = [
+                (alpha_grids[None if shared_alpha else group], indices, fold)
+                for group, indices in members.items()
+                for fold in range(n_folds)
+            ]
+            results = parallel(
+                delayed(_cv_path_chain)(
+                    [time_series[i] for i in indices],
+                    fold,
+                    n_folds,
+                    alphas,
+                    int(0.1 * max_iter),
+                    tol,
+                )
+                for alphas, indices, fold in tasks
+            )
+            for (alphas, indices, _), (scores, durations) in zip(tasks, results):
+                for i, run_scores, duration in zip(indices, scores, durations):
+                    for alpha, score in zip(alphas, run_scores):
+                        fold_scores[i][alpha].append(score)
+                    cv_durations[i] += duration
+
+            if refinement == n_refinements - 1:
+                break
+            for key, indices in grid_members.items():
+                path_alphas, path_scores = _pooled_path(fold_scores, indices)
+                alpha_grids[key] = refine_alphas(path_alphas, path_scores, n_alphas)
+
+        # Select the regularizations
+        best_alphas = np.empty(n_ts)
+        selections = [[i] for i in range(n_ts)]
+        for indices in grid_members.values() if shared_alpha else selections:
+            path_alphas, path_scores = _pooled_path(fold_scores, indices)
+            path_scores = np.where(np.isfinite(path_scores), path_scores, -np.inf)
+            best_alphas[indices] = path_alphas[np.argmax(path_scores)]
+
+        fits = parallel(
+            delayed(_fit_chain)(
+                [time_series[i] for i in indices],
+                best_alphas[indices].tolist(),
+                max_iter,
+                tol,
+            )
+            for indices in members.values()
+        )
+
+    n_area = time_series[0].shape[-1]
+    out = np.empty((n_ts, n_area, n_area), dtype=dtype)
+    convergence = [None] * n_ts
+    for indices, results in zip(members.values(), fits):
+        for i, (precision, n_iter, duration) in zip(indices, results):
+            out[i] = precision
+            convergence[i] = {
+                "alpha": float(best_alphas[i]),
+                "n_iter": int(n_iter),
+                "cv_time": float(cv_durations[i]),
+                "fit_time": float(duration),
+            }
+
+    diagonal = np.arange(n_area)
+    out[:, diagonal, diagonal] = 0
+
+    return out, convergence
+
+
+def sliding_window_onsets(n_timepoints: int, window: int, step: int) -> np.ndarray:
+    """First volume of each window sliding over a run.
+
+    Parameters
+    ----------
+    n_timepoints : int
+        Number of volumes of the run
+    window : int
+        Number of volumes of each window
+    step : int
+        Number of volumes between the onsets of consecutive windows
+
+    Returns
+    -------
+    np.ndarray
+        Onsets of the windows fully contained in the run.
+    """
+    if window < 2 or step < 1:
+        raise ValueError(
+            f"Windows need at least 2 volumes and a step of at least 1 volume, got "
+            f"a window of {window} and a step of {step}."
+        )
+    return np.arange(0, n_timepoints - window + 1, step)
+
+
+def sliding_window_connectivity(
+    time_series: np.ndarray,
+    window: int,
+    step: int,
+    taper: Optional[str] = None,
+    dtype: type = np.float32,
+    sample_mask: Optional[np.ndarray] = None,
+    n_timepoints: Optional[int] = None,
+) -> np.ndarray:
+    """Compute the correlations between regions within windows sliding over a run.
+
+    Without taper, the first and second moments of each window are obtained from
+    those of the previous window by adding the volumes entering the window and
+    removing the volumes leaving it. Tapered windows are weighted moments of the
+    volumes of each window. For censored timeseries, the windows slide over all
+    the volumes of the run and the windows containing censored volumes are NaN.
+
+    Parameters
+    ----------
+    time_series : np.ndarray
+        Timeseries of shape (n_timepoints, n_regions)
+    window : int
+        Number of volumes of each window
+    step : int
+        Number of volumes between the onsets of consecutive windows
+    taper : Optional[str], optional
+        Name of the (symmetric) window of ``scipy.signal.get_window`` weighting
+        the volumes of each window, by default None (rectangular windows)
+    dtype : type, optional
+        Data type of the output, by default np.float32
+    sample_mask : Optional[np.ndarray], optional
+        Indices of the volumes of the run kept in the censored timeseries, by
+        default None (no volume is censored)
+    n_timepoints : Optional[int], optional
+        Number of volumes of the run before censoring, required with
+        ``sample_mask``, by default None
+
+    Returns
+    -------
+    np.ndarray
+        Correlations of shape (n_windows, n_edges), with the edges in the order of
+        ``np.triu_indices(n_regions, k=1)``.
+    """
+    # Centering the whole run keeps the running sums well conditioned
+    x = np.asarray(time_series, dtype=float)
+    x = x - x.mean(axis=0)
+
+    # Censored volumes are put back as zeros, and the number of censored volumes
+    # up to each volume gives the windows containing any of them
+    n_censored = np.zeros(x.shape[0] + 1, dtype=int)
+    if sample_mask is not None:
+        if n_timepoints is None:
+            raise ValueError(
+                "The number of volumes of the run is required to slide the windows "
+                "over censored timeseries."
+            )
+        uncensored = x
+        x = np.zeros((n_timepoints, uncensored.shape[1]))
+        x[sample_mask] = uncensored
+        kept = np.zeros(n_timepoints, dtype=bool)
+        kept[sample_mask] = True
+        n_censored = np.concatenate([[0], np.cumsum(~kept)])
+
+    onsets = sliding_window_onsets(x.shape[0], window, step)
+    n_area = x.shape[1]
+    upper_triangle_indices = np.triu_indices(n_area, k=1)
+    out = np.empty((len(onsets), len(upper_triangle_indices[0])), dtype=dtype)
+
+    # Normalized weights of the volumes of tapered windows
+    scale = 1.0 / window
+    if taper is not None:
+        from scipy.signal import get_window
+
+        weights = get_window(taper, window, fftbins=False)
+        weights /= weights.sum()
+        scale = 1.0
+
+    first_moment, second_moment = None, None
+    for k, onset in enumerate(onsets):
+        if n_censored[onset + window] > n_censored[onset]:
+            out[k] = np.nan
+            first_moment = None
+            continue
+
+        x_window = x[onset : onset + window]
+        if taper is not None:
+            first_moment = weights @ x_window
+            second_moment = (x_window * weights[:, np.newaxis]).T @ x_window
+        elif first_moment is None or 2 * step >= window:
+            # Summing the window again is cheaper without much overlap
+            first_moment = x_window.sum(axis=0)
+            second_moment = x_window.T @ x_window
+        else:
+            leaving = x[onset - step : onset]
+            entering = x_window[-step:]
+            first_moment += entering.sum(axis=0) - leaving.sum(axis=0)
+            second_moment += entering.T @ entering - leaving.T @ leaving
+
+        mean = first_moment * scale
+        covariance = second_moment * scale - np.outer(mean, mean)
+        std = np.sqrt(np.clip(np.diag(covariance), 0, None))
+        std[std < np.finfo(float).eps] = np.inf
+        correlation = covariance / std[:, np.newaxis] / std[np.newaxis, :]
+        out[k] = correlation[upper_triangle_indices]
+
+    return out
@@ -0,0 +1,340 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+#
+# Copyright 2023 The Axon Lab <theaxonlab@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# We support and encourage derived works from this project, please read
+# about our expectations at
+#
+#     https://www.nipreps.org/community/licensing/
+#
+"""Python module for the batched interpolation and denoising of regional signals
+
+Runs of equal length are stacked so that the detrending, the Butterworth filtering
+(with coefficients computed once) and the confound regression of all of them are
+computed together, as ``nilearn.signal.clean`` would for each run.
+"""
+
+import logging
+import warnings
+from collections import defaultdict
+from typing import Optional
+
+import numpy as np
+
+DENOISING_BATCH_SIZE: int = 32
+BUTTERWORTH_ORDER: int = 5
+
+
+def butterworth_coefficients(
+    t_r: float,
+    low_pass: Optional[float] = None,
+    high_pass: Optional[float] = None,
+    order: int = BUTTERWORTH_ORDER,
+) -> Optional[tuple[np.ndarray, np.ndarray]]:
+    """Coefficients of the Butterworth filter of NiLearn's ``clean``.
+
+    Parameters
+    ----------
+    t_r : float
+        Repetition time of the signals
+    low_pass : Optional[float], optional
+        Low-pass filtering cutoff frequency, by default None
+    high_pass : Optional[float], optional
+        High-pass filtering cutoff frequency, by default None
+    order : int, optional
+        Order of the filter, by default BUTTERWORTH_ORDER
+
+    Returns
+    -------
+    Optional[tuple[np.ndarray, np.ndarray]]
+        Numerator and denominator of the filter (None without cutoff frequency).
+    """
+    from scipy.signal import butter
+
+    if low_pass is None and high_pass is None:
+        return None
+    if low_pass is not None and high_pass is not None and high_pass >= low_pass:
+        raise ValueError(
+            f"High pass cutoff frequency ({high_pass}) is greater than or equal to "
+            f"low pass filter frequency ({low_pass})."
+        )
+
+    # Same bounds on the critical frequencies as NiLearn
+    nyquist = 0.5 / t_r
+    critical_freq = []
+    for btype, freq in [("high", high_pass), ("low", low_pass)]:
+        if freq is None:
+            continue
+        if freq >= nyquist:
+            freq = nyquist - nyquist * 10 * np.finfo(1.0).eps
+            warnings.warn(
+                f"The {btype}-pass frequency is above the Nyquist frequency, it "
+                f"has been lowered to {freq}."
+            )
+        critical_freq.append(freq)
+
+    if len(critical_freq) == 2:
+        btype = "band"
+    else:
+        btype = "high" if high_pass is not None else "low"
+        critical_freq = critical_freq[0]
+
+    return butter(order, critical_freq, btype=btype, output="ba", fs=1.0 / t_r)
+
+
+def interpolate_censored(
+    signals: np.ndarray, sample_mask: np.ndarray, t_r: float
+) -> np.ndarray:
+    """Interpolate the censored volumes of stacked signals sharing a sample mask.
+
+    The censored volumes are replaced by the cubic spline through the kept volumes
+    (extrapolated at the edges), as NiLearn does before a Butterworth filter.
+
+    Parameters
+    ----------
+    signals : np.ndarray
+        Signals of shape (n_runs, n_timepoints, n_columns)
+    sample_mask : np.ndarray
+        Indices of the kept volumes
+    t_r : float
+        Repetition time of the signals
+
+    Returns
+    -------
+    np.ndarray
+        Interpolated signals (in double precision).
+    """
+    from scipy.interpolate import CubicSpline
+
+    signals = np.array(signals, dtype=float)
+    frame_times = np.arange(signals.shape[1]) * t_r
+    censored = np.ones(signals.shape[1], dtype=bool)
+    censored[sample_mask] = False
+    if not censored.any():
+        return signals
+
+    spline = CubicSpline(
+        frame_times[~censored], signals[:, ~censored], axis=1, extrapolate=True
+    )
+    signals[:, censored] = spline(frame_times[censored])
+    return signals
+
+
+def detrend_batch(signals: np.ndarray) -> np.ndarray:
+    """Remove the mean and the linear trend of stacked signals (in place).
+
+    Parameters
+    ----------
+    signals : np.ndarray
+        Signals of shape (n_runs, n_timepoints, n_columns)
+
+    Returns
+    -------
+    np.ndarray
+        Detrended signals.
+    """
+    signals -= signals.mean(axis=1, keepdims=True)
+    regressor = np.arange(signals.shape[1], dtype=float)
+    regressor -= regressor.mean()
+    norm = np.sqrt((regressor**2).sum())
+    if norm >= np.finfo(np.float64).eps:
+        regressor /= norm
+    trend = np.einsum("t,stc->sc", regressor, signals)
+    signals -= trend[:, np.newaxis, :] * regressor[:, np.newaxis]
+    return signals
+
+
+def zscore_batch(signals: np.ndarray, ddof: int = 1) -> np.ndarray:
+    """Z-score stacked signals over time (in place).
+
+    Parameters
+    ----------
+    signals : np.ndarray
+        Signals of shape (n_runs, n_timepoints, n_columns)
+    ddof : int, optional
+        Delta degrees of freedom of the standard deviation, by default 1
+
+    Returns
+    -------
+    np.ndarray
+        Standardized signals (constant signals are only centered).
+    """
+    signals -= signals.mean(axis=1, keepdims=True)
+    std = signals.std(axis=1, ddof=ddof, keepdims=True)
+    std[std < np.finfo(np.float64).eps] = 1.0
+    signals /= std
+    return signals
+
+
+def regress_confounds_batch(signals: np.ndarray, confounds: np.ndarray) -> np.ndarray:
+    """Project stacked signals on the orthogonal of their confounds (in place).
+
+    Parameters
+    ----------
+    signals : np.ndarray
+        Signals of shape (n_runs, n_timepoints, n_regions)
+    confounds : np.ndarray
+        Standardized confounds of shape (n_runs, n_timepoints, n_confounds)
+
+    Returns
+    -------
+    np.ndarray
+        Residuals of the signals.
+    """
+    from scipy.linalg import qr
+
+    # The (rank-revealing) decompositions are small; the projections of the
+    # signals are computed together. Dependent confounds leave null columns.
+    basis = np.zeros_like(confounds)
+    for run_confounds, run_basis in zip(confounds, basis):
+        q, r, _ = qr(run_confounds, mode="economic", pivoting=True)
+        independent = np.abs(np.diag(r)) > np.finfo(np.float64).eps * 100.0
+        run_basis[:, : independent.sum()] = q[:, independent]
+
+    signals -= basis @ (basis.transpose(0, 2, 1) @ signals)
+    return signals
+
+
+def clean_batch(
+    signals: np.ndarray,
+    confounds: Optional[np.ndarray] = None,
+    coefficients: Optional[tuple[np.ndarray, np.ndarray]] = None,
+) -> np.ndarray:
+    """Denoise stacked signals of equal length as NiLearn's ``clean``.
+
+    This is ``clean(signals, confounds=confounds, standardize="zscore_sample")``
+    (with the default detrending and Butterworth filter) applied to each run.
+
+    Parameters
+    ----------
+    signals : np.ndarray
+        Signals of shape (n_runs, n_timepoints, n_regions)
+    confounds : Optional[np.ndarray], optional
+        Confounds of shape (n_runs, n_timepoints, n_confounds), by default None
+    coefficients : Optional[tuple[np.ndarray, np.ndarray]], optional
+        Coefficients of the Butterworth filter (see butterworth_coefficients), by
+        default None (no filtering)
+
+    Returns
+    -------
+    np.ndarray
+        Denoised and standardized signals (in double precision).
+    """
+    from scipy.signal import filtfilt
+
+    signals = detrend_batch(np.array(signals, dtype=float))
+    if coefficients is not None:
+        signals = filtfilt(*coefficients, signals, axis=1)
+
+    if confounds is not None and confounds.shape[2]:
+        confounds = detrend_batch(np.array(confounds, dtype=float))
+        if coefficients is not None:
+            # Filter the confounds as the signals to keep the filters orthogonal
+            confounds = filtfilt(*coefficients, confounds, axis=1)
+        signals = regress_confounds_batch(signals, zscore_batch(confounds, ddof=0))
+
+    return zscore_batch(signals)
+
+
+def interpolate_and_clean(
+    time_series: list[np.ndarray],
+    confounds: list[Optional[np.ndarray]],
+    sample_mask: list[Optional[np.ndarray]],
+    t_r: float,
+    low_pass: Optional[float] = None,
+    high_pass: Optional[float] = None,
+    batch_size: int = DENOISING_BATCH_SIZE,
+) -> tuple[list[np.ndarray], list[np.ndarray], list[Optional[np.ndarray]]]:
+    """Interpolate the censored volumes of runs and denoise them by batches.
+
+    Runs of equal length (and number of confounds) are stacked: the signals and
+    confounds of runs sharing their sample mask are interpolated together, and the
+    filtering and confound regression of each batch are computed at once with
+    filter coefficients shared by all the runs.
+
+    Parameters
+    ----------
+    time_series : list[np.ndarray]
+        List of timeseries of shape (n_timepoints, n_regions)
+    confounds : list[Optional[np.ndarray]]
+        List of confounds of shape (n_timepoints, n_confounds)
+    sample_mask : list[Optional[np.ndarray]]
+        List of the indices of the kept volumes (None if no volume is censored)
+    t_r : float
+        Repetition time of the runs
+    low_pass : Optional[float], optional
+        Low-pass filtering cutoff frequency, by default None
+    high_pass : Optional[float], optional
+        High-pass filtering cutoff frequency, by default None
+    batch_size : int, optional
+        Maximum number of runs denoised together, by default DENOISING_BATCH_SIZE
+
+    Returns
+    -------
+    tuple[list[np.ndarray], list[np.ndarray], list[Optional[np.ndarray]]]
+        Denoised timeseries, interpolated timeseries and interpolated confounds of
+        each run (in double precision).
+    """
+    coefficients = butterworth_coefficients(t_r, low_pass, high_pass)
+
+    # Runs are stacked by length and number of regions and confounds
+    indices_by_shape = defaultdict(list)
+    for i, (ts, conf) in enumerate(zip(time_series, confounds)):
+        n_confounds = 0 if conf is None else conf.shape[1]
+        indices_by_shape[(*ts.shape, n_confounds)].append(i)
+
+    n_runs = len(time_series)
+    denoised, interpolated, interpolated_confounds = (
+        [None] * n_runs,
+        [None] * n_runs,
+        [None] * n_runs,
+    )
+    for (n_timepoints, n_regions, n_confounds), indices in indices_by_shape.items():
+        logging.debug(
+            f"Denoising {len(indices)} timeseries with {n_timepoints} timepoints."
+        )
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start : start + batch_size]
+            stacked = np.empty((len(batch), n_timepoints, n_regions + n_confounds))
+            for j, i in enumerate(batch):
+                stacked[j, :, :n_regions] = time_series[i]
+                if n_confounds:
+                    stacked[j, :, n_regions:] = confounds[i]
+
+            # Runs sharing their sample mask are interpolated with a single spline
+            positions_by_mask = defaultdict(list)
+            for j, i in enumerate(batch):
+                if sample_mask[i] is not None:
+                    mask = np.asarray(sample_mask[i])
+                    positions_by_mask[mask.tobytes()].append((j, mask))
+            for positions in positions_by_mask.values():
+                rows = [j for j, _ in positions]
+                stacked[rows] = interpolate_censored(
+                    stacked[rows], positions[0][1], t_r
+                )
+
+            cleaned = clean_batch(
+                stacked[:, :, :n_regions],
+                stacked[:, :, n_regions:] if n_confounds else None,
+                coefficients,
+            )
+            for j, i in enumerate(batch):
+                denoised[i] = cleaned[j]
+                interpolated[i] = stacked[j, :, :n_regions]
+                if confounds[i] is not None:
+                    interpolated_confounds[i] = stacked[j, :, n_regions:]
+
+    return denoised, interpolated, interpolated_confounds
@@ -32,40 +32,105 @@ In the context of HCPh (pilot), it would be:
     python funconn.py /data/datasets/hcph-pilot/derivatives/fmriprep-23.1.4/
 """
 
+from __future__ import annotations
+
 import argparse
 import csv
+import json
 import logging
 import os
 import os.path as op
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from itertools import chain
-from typing import Optional, Union
+from typing import TYPE_CHECKING, Optional, Union
 
 import numpy as np
-from nilearn_patcher import MultiNiftiMapsMasker as MultiNiftiMapsMasker_patched
-from sklearn.covariance import GraphicalLassoCV, LedoitWolf
-
-from nilearn._utils import stringify_path
-from nilearn.connectome import ConnectivityMeasure, vec_to_sym_matrix
-from nilearn.interfaces.fmriprep import load_confounds
-from nilearn.maskers import MultiNiftiMapsMasker
-from nilearn.signal import _handle_scrubbed_volumes, _sanitize_confound_dtype, clean
 
-from reports import plot_interpolation, visual_report_timeserie, visual_report_fc
+# NiLearn, Scikit-Learn, PyBIDS and the reports (Matplotlib, Seaborn) are imported
+# by the stages that need them, so that planning a run starts fast
+if TYPE_CHECKING:
+    from sklearn.covariance import GraphicalLassoCV, LedoitWolf
+
+from atlas_cache import ATLAS_CACHE_DIR, transform_cached
+from connectivity import (
+    SPARSE_N_FOLDS,
+    batched_connectivity,
+    sliding_window_connectivity,
+    sparse_precision,
+)
+from denoising import interpolate_and_clean
+from ledger import (
+    LEDGER_FILE,
+    file_hash,
+    find_outdated,
+    hash_parameters,
+    inputs_hash,
+    open_ledger,
+    open_shard_ledger,
+    record_outputs,
+)
+from profiling import PROFILE_DIR, PROFILE_FILE, PROFILER, run_profiled, span
 from load_save import (
     find_derivative,
     check_existing_output,
+    find_atlas_maps,
     get_atlas_data,
+    get_bids_savename,
+    get_confounds_filename,
     get_confounds_manually,
+    shared_confounds_files,
     get_func_filenames_bids,
+    get_output_fills,
+    get_shard_filename,
+    load_output,
+    read_nifti_header,
+    export_tsv,
     save_output,
     load_timeseries,
+    parse_shard,
+    select_shard,
+    DYNAMIC_FC_FILLS,
+    DYNAMIC_FC_PATTERN,
     FC_FILLS,
     FC_PATTERN,
+    OUTPUT_EXTENSIONS,
     TIMESERIES_FILLS,
     TIMESERIES_PATTERN,
+    CONFOUNDS_CACHE_DIR,
 )
 
 NETWORK_MAPPING: str = "yeo_networks7"  # Also yeo_networks17
+DURATION_FILE: str = "fMRI_duration_after_censoring.csv"
+CONVERGENCE_FILE: str = "FC_sparse_convergence.csv"
+PRECISION_FILE: str = "precision_validation.csv"
+PRECISION_COLUMNS: tuple = (
+    "timeseries_max_abs",
+    "timeseries_relative",
+    "connectivity_max_abs",
+    "connectivity_relative",
+)
+SWEEP_PARAMETERS: tuple = (
+    "denoising_strategy",
+    "motion",
+    "fd_threshold",
+    "std_dvars_threshold",
+    "scrub",
+    "low_pass",
+    "interpolate",
+)
+# Parameters of the confounds (as given to load_denoising_confounds)
+CONFOUNDS_PARAMETERS: tuple = (
+    "denoising_strategy",
+    "motion",
+    "fd_threshold",
+    "std_dvars_threshold",
+    "scrub",
+    "confounds_cache",
+)
+# Share of the processes rendering the visual reports while the outputs are computed
+REPORT_PROCS_FRACTION: float = 0.25
+# Parameters of the extraction that do not change its outputs
+EXTRACTION_PARAMETERS: tuple = ("verbose", "atlas_cache", "chunk_mb", "confounds_cache")
 
 
 def get_arguments() -> argparse.Namespace:
@@ -89,6 +154,22 @@ def get_arguments() -> argparse.Namespace:
         "(will be followed by the name and dimension of the atlas)",
     )
 
+    parser.add_argument(
+        "--output-format",
+        default="tsv",
+        action="store",
+        choices=list(OUTPUT_EXTENSIONS),
+        type=str,
+        help="""format of the timeseries and connectivity matrices ('npy' saves
+        memory-mappable binary arrays with a JSON sidecar)""",
+    )
+    parser.add_argument(
+        "--export-tsv",
+        default=False,
+        action="store_true",
+        help="export binary outputs to BIDS-compliant TSV files as a final step",
+    )
+
     # Script specific options
     parser.add_argument(
         "--overwrite",
@@ -96,6 +177,27 @@ def get_arguments() -> argparse.Namespace:
         action="store_true",
         help="force computation",
     )
+    parser.add_argument(
+        "--plan",
+        default=False,
+        action="store_true",
+        help="""print the runs, atlases and outputs that would be computed (from the
+        discovery index and the ledger or the existing outputs) and exit""",
+    )
+    parser.add_argument(
+        "--ledger",
+        default=None,
+        action="store",
+        help=f"""SQLite ledger recording the inputs and parameters of every output,
+        used to recompute only the missing and stale outputs (by default
+        '{LEDGER_FILE}' in the output directory)""",
+    )
+    parser.add_argument(
+        "--no-ledger",
+        default=False,
+        action="store_true",
+        help="only recompute the outputs that do not exist (ignoring the ledger)",
+    )
     parser.add_argument(
         "--ses",
         default=[],
@@ -121,9 +223,12 @@ def get_arguments() -> argparse.Namespace:
     # fMRI and denoising specific options
     parser.add_argument(
         "--atlas-dimension",
-        default=64,
+        default=[64],
+        action="store",
+        nargs="+",
         type=int,
-        help="dimension of the atlas (usually 64, 128 or 512)",
+        help="""a space delimited list of atlas dimension(s) (usually 64, 128 or
+        512); several dimensions are extracted from a single read of each file""",
     )
     parser.add_argument(
         "--low-pass",
@@ -189,6 +294,134 @@ def get_arguments() -> argparse.Namespace:
         help="""type of connectivity to compute (can be 'correlation', 'covariance' or
         'sparse')""",
     )
+    parser.add_argument(
+        "--shared-alpha",
+        default=False,
+        action="store_true",
+        help="""select a single regularization of the sparse inverse covariance
+        for all the runs (the connectivity is then computed once all the
+        timeseries are extracted)""",
+    )
+    parser.add_argument(
+        "--atlas-cache",
+        default=ATLAS_CACHE_DIR,
+        action="store",
+        help="""directory where the atlas projection operators are cached for each
+        BOLD grid""",
+    )
+    parser.add_argument(
+        "--no-atlas-cache",
+        default=False,
+        action="store_true",
+        help="extract the timeseries with NiLearn's maskers instead of the cache",
+    )
+    parser.add_argument(
+        "--confounds-cache",
+        default=CONFOUNDS_CACHE_DIR,
+        action="store",
+        help="""directory where the parsed fMRIPrep confounds files are cached in a
+        binary columnar format""",
+    )
+    parser.add_argument(
+        "--no-confounds-cache",
+        default=False,
+        action="store_true",
+        help="parse the fMRIPrep confounds files again for every run",
+    )
+    parser.add_argument(
+        "--chunk-mb",
+        default=None,
+        action="store",
+        type=float,
+        help="""stream the BOLD volumes by chunks of at most this size (in MB) through
+        the atlas projection cache, bounding the memory of each extraction job""",
+    )
+    parser.add_argument(
+        "--dfc-window",
+        default=60.0,
+        action="store",
+        type=float,
+        help="""length (in s) of the sliding windows of the dynamic functional
+        connectivity""",
+    )
+    parser.add_argument(
+        "--dfc-step",
+        default=10.0,
+        action="store",
+        type=float,
+        help="""time (in s) between the onsets of consecutive sliding windows of the
+        dynamic functional connectivity""",
+    )
+    parser.add_argument(
+        "--dfc-taper",
+        default=None,
+        action="store",
+        choices=["hann", "hamming", "tukey", "blackman"],
+        help="""taper weighting the volumes of each sliding window of the dynamic
+        functional connectivity, by default rectangular windows""",
+    )
+    parser.add_argument(
+        "--no-dfc",
+        default=False,
+        action="store_true",
+        help="""do not compute the dynamic functional connectivity (correlations
+        within sliding windows) next to the static one""",
+    )
+    parser.add_argument(
+        "--precision",
+        default="float64",
+        action="store",
+        choices=["float64", "float32"],
+        help="""floating point precision of the atlas projection, the regional
+        signals and the connectivity matrices (single precision halves their memory
+        and bandwidth)""",
+    )
+    parser.add_argument(
+        "--validate-precision",
+        default=1,
+        action="store",
+        type=int,
+        help=f"""number of runs of each group computed again in double precision
+        to report the deviation of the single precision outputs in
+        '{PRECISION_FILE}'""",
+    )
+    parser.add_argument(
+        "--sweep",
+        default=None,
+        action="store",
+        help="""JSON file with a list of denoising configurations, each with a
+        'name' and any of the following parameters overriding the command line: """
+        + ", ".join(SWEEP_PARAMETERS)
+        + """. The regional signals are extracted once and each configuration is
+        written to its own output directory.""",
+    )
+    parser.add_argument(
+        "--reports",
+        default="now",
+        action="store",
+        choices=["now", "defer", "skip"],
+        help=f"""render the visual reports of each group of files as soon as its
+        outputs are saved ('now', in a separate pool of processes taking
+        {REPORT_PROCS_FRACTION * 100:.0f}%% of --n-procs), once all the connectivity outputs
+        are computed ('defer') or not at all ('skip')""",
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        action="store",
+        type=parse_shard,
+        help="""process only one shard 'i/N' (1 <= i <= N) of the runs, partitioned
+        deterministically by subject and session. The files shared by all the runs
+        are written per shard and consolidated afterwards with funconn_merge.py""",
+    )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        help=f"""dump the cProfile statistics of the extraction and connectivity
+        jobs in the '{PROFILE_DIR}' folder of the output (the timing and memory of
+        each stage are always saved in '{PROFILE_FILE}')""",
+    )
     parser.add_argument(
         "--no-censor",
         default=False,
@@ -196,6 +429,22 @@ def get_arguments() -> argparse.Namespace:
         help="interpolate volumes with high motion without censoring",
     )
 
+    parser.add_argument(
+        "--n-procs",
+        default=8,
+        action="store",
+        type=int,
+        help="""maximum number of processes shared between the groups of files
+        (similar FoV and TR), their extraction jobs and the visual reports""",
+    )
+    parser.add_argument(
+        "--mem-gb",
+        default=None,
+        action="store",
+        type=float,
+        help="maximum memory (in GB) used by the concurrent extraction jobs",
+    )
+
     parser.add_argument(
         "-v",
         "--verbosity",
@@ -212,33 +461,79 @@ def get_arguments() -> argparse.Namespace:
 
 def fit_transform_patched(
     func_filename: list[str],
-    atlas_filename: str,
+    atlas_filename: Union[str, list[str]],
     confounds: Optional[list] = None,
     sample_mask: Optional[list] = None,
+    atlas_cache: Optional[str] = None,
+    chunk_mb: Optional[float] = None,
+    dtype: Optional[type] = None,
     **kwargs,
-) -> list[np.ndarray]:
+) -> Union[list[np.ndarray], list[list[np.ndarray]]]:
     """Attempt to use NiLearn's MultiNiftiMapsMaskers, if it fails it will use the
     patched version of the maskers (to be implemented into NiLearn in the future).
+    If a cache directory is given, the cached atlas projection is used instead.
 
     Parameters
     ----------
     func_filename : list[str]
         List of BIDS functional filenames
-    atlas_filename : str
-        Path to the atlas file
+    atlas_filename : Union[str, list[str]]
+        Path to the atlas file (or list of paths, in which case each file is read
+        once for all the atlases with the cached projection)
     confounds : Optional[list], optional
         List of confounds (usually from nilearn.interface.fmriprep.load_confounds),
         by default None
     sample_mask : Optional[list], optional
         List of sample masks (usually from nilearn.interface.fmriprep.load_confounds),
         by default None
+    atlas_cache : Optional[str], optional
+        Directory of the atlas projection cache, by default None
+    chunk_mb : Optional[float], optional
+        Memory budget (in MB) of the chunks of volumes streamed through the atlas
+        projection cache, by default None (the whole files are loaded)
+    dtype : Optional[type], optional
+        Data type of the extraction and of the timeseries, by default None (double
+        precision)
 
     Returns
     -------
-    list[np.ndarray]
-        List of extracted and denoised timeseries
+    Union[list[np.ndarray], list[list[np.ndarray]]]
+        List of extracted and denoised timeseries (one list per atlas if a list of
+        atlases is given)
     """
-    masker = MultiNiftiMapsMasker(maps_img=atlas_filename, **kwargs)
+    if atlas_cache is not None:
+        return transform_cached(
+            func_filename,
+            atlas_filename,
+            confounds=confounds,
+            sample_mask=sample_mask,
+            cache_dir=atlas_cache,
+            chunk_mb=chunk_mb,
+            dtype=dtype or np.float64,
+            **kwargs,
+        )
+
+    if chunk_mb is not None:
+        logging.warning(
+            "The volumes are only streamed by chunks with the projection cache: the "
+            "files are loaded whole."
+        )
+
+    if not isinstance(atlas_filename, str):
+        logging.warning(
+            "Several atlases are extracted without the projection cache: the files "
+            "are read once per atlas."
+        )
+        return [
+            fit_transform_patched(
+                func_filename, filename, confounds, sample_mask, dtype=dtype, **kwargs
+            )
+            for filename in atlas_filename
+        ]
+
+    from nilearn.maskers import MultiNiftiMapsMasker
+
+    masker = MultiNiftiMapsMasker(maps_img=atlas_filename, dtype=dtype, **kwargs)
 
     try:
         time_series = masker.fit_transform(
@@ -248,34 +543,45 @@ def fit_transform_patched(
         if "Number of sample_mask" not in msg:
             raise
         # See nilearn issue #3967 for more details
+        from nilearn_patcher import MultiNiftiMapsMasker as MultiNiftiMapsMasker_patched
+
         logging.warning("Using patched version of 'MultiNiftiMapsMasker ...'")
-        masker = MultiNiftiMapsMasker_patched(maps_img=atlas_filename, **kwargs)
+        masker = MultiNiftiMapsMasker_patched(
+            maps_img=atlas_filename, dtype=dtype, **kwargs
+        )
 
         time_series = masker.fit_transform(
             func_filename, confounds=confounds, sample_mask=sample_mask
         )
 
+    if dtype is not None:
+        time_series = [ts.astype(dtype, copy=False) for ts in time_series]
+
     return time_series
 
 
 def interpolate_and_denoise_timeseries(
     func_filename: list[str],
-    atlas_filename: str,
+    atlas_filename: Union[str, list[str]],
     confounds: list,
     sample_mask: list,
     t_r: Optional[float] = None,
     low_pass: Optional[float] = None,
-    output: Optional[str] = None,
+    output: Optional[Union[str, list[str]]] = None,
     verbose: int = 2,
-) -> tuple[list[np.ndarray], list]:
+    atlas_cache: Optional[str] = None,
+    chunk_mb: Optional[float] = None,
+    n_jobs: int = 8,
+    dtype: Optional[type] = None,
+) -> tuple[Union[list[np.ndarray], list[list[np.ndarray]]], list]:
     """Interpolate and denoise the timeseries without censoring high motion volumes.
 
     Parameters
     ----------
     func_filename : list[str]
         List of BIDS functional filenames
-    atlas_filename : str
-        Path to the atlas filename
+    atlas_filename : Union[str, list[str]]
+        Path to the atlas filename (or list of paths)
     confounds : list
         List of confounds (usually from nilearn.interface.fmriprep.load_confounds).
     sample_mask : list
@@ -284,119 +590,205 @@ def interpolate_and_denoise_timeseries(
         Repetition time of the MRI acquisition, by default None
     low_pass : Optional[float], optional
         Low-pass filtering cutoff frequency, by default None
-    output : Optional[str], optional
-        Path to the output directory, by default None
+    output : Optional[Union[str, list[str]]], optional
+        Path to the output directory (or one per atlas), by default None
     verbose : int, optional
         Amount of verbosity, by default 2
+    atlas_cache : Optional[str], optional
+        Directory of the atlas projection cache, by default None
+    chunk_mb : Optional[float], optional
+        Memory budget (in MB) of the chunks of streamed volumes, by default None
+    n_jobs : int, optional
+        Number of parallel extraction jobs, by default 8
+    dtype : Optional[type], optional
+        Data type of the extraction and of the timeseries, by default None (double
+        precision)
 
     Returns
     -------
-    tuple[list[np.ndarray], list]
-        Two lists, one with the denoised timeseries and one with the corresponding
-        confounds.
+    tuple[Union[list[np.ndarray], list[list[np.ndarray]]], list]
+        Two lists, one with the denoised timeseries (one list per atlas if a list
+        of atlases is given) and one with the corresponding confounds.
     """
     logging.info("Interpolating signal (no censoring) ...")
     # Extract the regional signals
     extracted_time_series = fit_transform_patched(
         func_filename,
         atlas_filename,
+        atlas_cache=atlas_cache,
+        chunk_mb=chunk_mb,
         standardize="zscore_sample",
         verbose=verbose,
-        n_jobs=8,
+        n_jobs=n_jobs,
+        dtype=dtype,
     )
 
-    interpolated_signals = []
-    interpolated_confounds = []
-    denoised_signals = []
-    for ts, conf, sm, fn in zip(
-        extracted_time_series, confounds, sample_mask, func_filename
-    ):
-        logging.debug(
-            f"Timeserie has length {ts.shape[0]} and sample mask has "
-            f"length {len(sm)}"
-        )
+    # The figures of the interpolation are rendered once all the atlases are
+    # denoised
+    plots = []
+    if not isinstance(atlas_filename, str):
+        outputs = output if isinstance(output, list) else [output] * len(atlas_filename)
+        denoised_signals = []
+        for atlas_time_series, atlas_output in zip(extracted_time_series, outputs):
+            atlas_denoised_signals, interpolated_confounds = interpolate_and_denoise(
+                atlas_time_series,
+                confounds,
+                sample_mask,
+                func_filename,
+                t_r=t_r,
+                low_pass=low_pass,
+                output=atlas_output,
+                plots=plots,
+            )
+            denoised_signals.append(atlas_denoised_signals)
+        plot_interpolations(plots)
+        return denoised_signals, interpolated_confounds
 
-        # This is required as we are manually doing some internal Nilearn machinery
-        conf = _sanitize_confound_dtype(ts.shape[0], confound=conf)
-        conf = stringify_path(conf)
+    denoised_signals, interpolated_confounds = interpolate_and_denoise(
+        extracted_time_series,
+        confounds,
+        sample_mask,
+        func_filename,
+        t_r=t_r,
+        low_pass=low_pass,
+        output=output,
+        plots=plots,
+    )
+    plot_interpolations(plots)
+    return denoised_signals, interpolated_confounds
 
-        ts_to_interpolate = ts.copy()
 
-        inter_sig, inter_conf = _handle_scrubbed_volumes(
-            signals=ts_to_interpolate,
-            confounds=conf,
-            sample_mask=sm,
-            filter_type="butterworth",
-            t_r=t_r,
-        )
+def interpolate_and_denoise(
+    extracted_time_series: list[np.ndarray],
+    confounds: list,
+    sample_mask: list,
+    func_filename: list[str],
+    t_r: Optional[float] = None,
+    low_pass: Optional[float] = None,
+    output: Optional[str] = None,
+    plots: Optional[list] = None,
+) -> tuple[list[np.ndarray], list]:
+    """Interpolate the censored volumes of extracted timeseries and denoise them.
 
-        if output is not None:
-            plot_interpolation(ts, inter_sig, fn, output)
+    Runs of equal length are interpolated and denoised together, with filter
+    coefficients shared by all the runs.
 
-        # Denoise the signals
-        denoised_sig = clean(
-            inter_sig,
-            standardize="zscore_sample",
-            confounds=inter_conf,
-            low_pass=low_pass,
-            t_r=t_r,
-        )
+    Parameters
+    ----------
+    extracted_time_series : list[np.ndarray]
+        List of extracted (standardized) timeseries
+    confounds : list
+        List of confounds (usually from nilearn.interface.fmriprep.load_confounds).
+    sample_mask : list
+        List of sample_masks (usually from nilearn.interface.fmriprep.load_confounds).
+    func_filename : list[str]
+        List of BIDS functional filenames
+    t_r : Optional[float], optional
+        Repetition time of the MRI acquisition, by default None
+    low_pass : Optional[float], optional
+        Low-pass filtering cutoff frequency, by default None
+    output : Optional[str], optional
+        Path to the output directory, by default None
+    plots : Optional[list], optional
+        List to which the figures of the interpolation are appended, to be
+        rendered later with plot_interpolations, by default None (the figures are
+        rendered once all the runs are denoised)
+
+    Returns
+    -------
+    tuple[list[np.ndarray], list]
+        Two lists, one with the denoised timeseries and one with the corresponding
+        confounds.
+    """
+    from nilearn._utils import stringify_path
+    from nilearn.signal import _sanitize_confound_dtype
+
+    # This is required as we are manually doing some internal Nilearn machinery
+    confounds = [
+        stringify_path(_sanitize_confound_dtype(ts.shape[0], confound=conf))
+        for ts, conf in zip(extracted_time_series, confounds)
+    ]
 
-        interpolated_signals.append(inter_sig)
-        interpolated_confounds.append(inter_conf)
-        denoised_signals.append(denoised_sig)
+    denoised_signals, interpolated_signals, interpolated_confounds = (
+        interpolate_and_clean(
+            extracted_time_series, confounds, sample_mask, t_r=t_r, low_pass=low_pass
+        )
+    )
 
+    if output is not None:
+        jobs = [
+            (ts, interpolated_ts, filename, output)
+            for ts, interpolated_ts, filename in zip(
+                extracted_time_series, interpolated_signals, func_filename
+            )
+        ]
+        if plots is None:
+            plot_interpolations(jobs)
+        else:
+            plots.extend(jobs)
+
+    # The interpolation is computed in double precision
+    denoised_signals = [
+        denoised_ts.astype(ts.dtype, copy=False)
+        for ts, denoised_ts in zip(extracted_time_series, denoised_signals)
+    ]
     return denoised_signals, interpolated_confounds
 
 
-def extract_and_denoise_timeseries(
+def plot_interpolations(jobs: list[tuple]):
+    """Render the figures of the interpolation of the censored volumes.
+
+    Parameters
+    ----------
+    jobs : list[tuple]
+        Timeseries before and after interpolation, BIDS functional filename and
+        output directory of each figure
+    """
+    if not jobs:
+        return
+
+    from reports import plot_interpolation
+
+    with span("plot_interpolation", files=len(jobs)):
+        for ts, interpolated_ts, filename, output in jobs:
+            plot_interpolation(ts, interpolated_ts, filename, output)
+
+
+def load_denoising_confounds(
     func_filename: list[str],
-    atlas_filename: str,
-    verbose: int = 2,
-    interpolate: bool = False,
-    low_pass: Optional[float] = None,
     denoising_strategy: Optional[tuple] = (),
     motion: Optional[str] = None,
-    t_r: Optional[float] = None,
-    output: Optional[str] = None,
+    confounds_cache: Optional[str] = None,
     **kwargs,
-) -> tuple[list[np.ndarray], list, list[np.ndarray]]:
-    """Extract and denoise regional timeseries for a given atlas.
+) -> tuple[list, list]:
+    """Load the confounds and sample masks of a denoising strategy.
 
     Parameters
     ----------
     func_filename : list[str]
         List of BIDS functional filenames
-    atlas_filename : str
-        Path to the atlas filename
-    verbose : int, optional
-        Amount of verbosity, by default 2
-    interpolate : bool, optional
-        Condition to ONLY interpolate the timeseries (without censoring),
-        by default False
-    low_pass : Optional[float], optional
-        Low-pass filtering cutoff frequency, by default None
     denoising_strategy = Optional[tuple], optional,
         the type of noise regressors to include.
     motion: Optional[str], optional,
         type of confounds extracted from head motion estimates
-    t_r : Optional[float], optional
-        Repetition time of the MRI, by default None
-    output : Optional[str], optional
-        Path to the output directory, by default None
+    confounds_cache : Optional[str], optional
+        Directory of the persistent confounds cache, by default None
 
     Returns
     -------
-    tuple[list[np.ndarray], list]
-        Two lists, one with the extracted and denoised timeseries and one with the
-        corresponding confounds.
+    tuple[list, list]
+        Two lists, with the confounds and the sample masks of each file.
     """
-    if not len(func_filename):
-        return [], [], []
+    if confounds_cache is not None:
+        with shared_confounds_files(confounds_cache):
+            return load_denoising_confounds(
+                func_filename,
+                denoising_strategy=denoising_strategy,
+                motion=motion,
+                **kwargs,
+            )
 
-    logging.info(f"Extracting and denoising timeseries for {len(func_filename)} files.")
-    logging.debug(f"Denoising strategy includes : {' '.join(denoising_strategy)}")
-    logging.debug(f"Denoising parameters are: {kwargs}")
+    from nilearn.interfaces.fmriprep import load_confounds
 
     # There is currently a bug in nilearn that prevents "load_confounds" from finding
     # the confounds file if it contains any other BIDS entity than "ses" and "run".
@@ -435,106 +827,1520 @@ def extract_and_denoise_timeseries(
     if not isinstance(sample_mask, list):
         sample_mask = [sample_mask]
 
-    if interpolate:
-        time_series, confounds = interpolate_and_denoise_timeseries(
-            func_filename,
-            atlas_filename,
-            confounds,
-            sample_mask,
-            t_r=t_r,
-            low_pass=low_pass,
-            output=output,
-            verbose=verbose,
-        )
-        return time_series, confounds
-
-    time_series = fit_transform_patched(
-        func_filename,
-        atlas_filename,
-        confounds,
-        sample_mask,
-        low_pass=low_pass,
-        t_r=t_r,
-        standardize="zscore_sample",
-        verbose=verbose,
-        reports=True,
-        n_jobs=8,
-    )
-
-    return time_series, confounds, sample_mask
+    return confounds, sample_mask
 
 
-def get_fc_strategy(
-    strategy: str = "sparse inverse covariance",
-) -> tuple[Union[GraphicalLassoCV, LedoitWolf], str, str]:
-    """Get the strategy to compute functional connectivity.
+def get_censoring(
+    confounds: list, sample_mask: list, interpolate: bool = False
+) -> tuple[Optional[list], Optional[list[int]]]:
+    """Get the sample masks of the censored timeseries and the number of volumes of
+    their runs.
 
     Parameters
     ----------
-    strategy : str, optional
-        Name of the strategy, could be "correlation", "covariance" or "sparse",
-        by default "sparse inverse covariance"
+    confounds : list
+        Confounds of each file (with all the volumes of the run)
+    sample_mask : list
+        Sample mask of each file
+    interpolate : bool, optional
+        Condition indicating that the censored volumes were interpolated, by
+        default False
 
     Returns
     -------
-    tuple[Union[GraphicalLassoCV, LedoitWolf], str, str]
-        Returns the covariance estimator, the name of the metric (covariance or
-        precision) as well as standardized label for file naming.
+    tuple[Optional[list], Optional[list[int]]]
+        Sample masks and numbers of volumes (None for interpolated timeseries, which
+        keep all the volumes).
     """
-    connectivity_kind = "precision"
-    connectivity_label = "sparseinversecovariance"
-    estimator = GraphicalLassoCV(alphas=6, max_iter=1000)
-
-    if strategy in ["cor", "corr", "correlation"]:
-        connectivity_kind = "correlation"
-        connectivity_label = "correlation"
-        estimator = LedoitWolf(store_precision=False)
-    elif strategy not in ["sparse", "sparse inverse covariance"]:
-        connectivity_kind = "covariance"
-        connectivity_label = "covariance"
-
-    return estimator, connectivity_kind, connectivity_label
+    if interpolate:
+        return None, None
+    return sample_mask, [
+        None if file_confounds is None else len(file_confounds)
+        for file_confounds in confounds
+    ]
 
 
-def compute_connectivity(
-    time_series: list[np.ndarray],
-    estimator: Union[LedoitWolf, GraphicalLassoCV] = LedoitWolf(store_precision=False),
-    connectivity_kind: str = "correlation",
-) -> list[np.ndarray]:
-    """Compute the functional connectivity using the specified estimator and
-    connectivity kind.
+def denoise_extracted_timeseries(
+    raw_time_series: list[np.ndarray],
+    func_filename: list[str],
+    confounds: list,
+    sample_mask: list,
+    interpolate: bool = False,
+    low_pass: Optional[float] = None,
+    t_r: Optional[float] = None,
+    output: Optional[str] = None,
+    plots: Optional[list] = None,
+) -> tuple[list[np.ndarray], list]:
+    """Denoise raw regional signals, as the maskers do after the extraction.
+
+    Parameters
+    ----------
+    raw_time_series : list[np.ndarray]
+        List of raw (neither standardized nor denoised) regional signals
+    func_filename : list[str]
+        List of BIDS functional filenames
+    confounds : list
+        List of confounds (usually from nilearn.interface.fmriprep.load_confounds).
+    sample_mask : list
+        List of sample_masks (usually from nilearn.interface.fmriprep.load_confounds).
+    interpolate : bool, optional
+        Condition to ONLY interpolate the timeseries (without censoring),
+        by default False
+    low_pass : Optional[float], optional
+        Low-pass filtering cutoff frequency, by default None
+    t_r : Optional[float], optional
+        Repetition time of the MRI, by default None
+    output : Optional[str], optional
+        Path to the output directory, by default None
+    plots : Optional[list], optional
+        List to which the figures of the interpolation are appended, by default
+        None (see interpolate_and_denoise)
+
+    Returns
+    -------
+    tuple[list[np.ndarray], list]
+        Two lists, one with the denoised timeseries and one with the corresponding
+        confounds.
+    """
+    from nilearn.signal import clean
+
+    if interpolate:
+        standardized_time_series = [
+            clean(ts, detrend=False, standardize="zscore_sample")
+            for ts in raw_time_series
+        ]
+        return interpolate_and_denoise(
+            standardized_time_series,
+            confounds,
+            sample_mask,
+            func_filename,
+            t_r=t_r,
+            low_pass=low_pass,
+            output=output,
+            plots=plots,
+        )
+
+    time_series = [
+        clean(
+            ts,
+            detrend=False,
+            standardize="zscore_sample",
+            confounds=conf,
+            sample_mask=sm,
+            low_pass=low_pass,
+            t_r=t_r,
+        ).astype(ts.dtype, copy=False)
+        for ts, conf, sm in zip(raw_time_series, confounds, sample_mask)
+    ]
+    return time_series, confounds
+
+
+def extract_and_denoise_timeseries(
+    func_filename: list[str],
+    atlas_filename: Union[str, list[str]],
+    verbose: int = 2,
+    interpolate: bool = False,
+    low_pass: Optional[float] = None,
+    denoising_strategy: Optional[tuple] = (),
+    motion: Optional[str] = None,
+    t_r: Optional[float] = None,
+    output: Optional[Union[str, list[str]]] = None,
+    atlas_cache: Optional[str] = None,
+    chunk_mb: Optional[float] = None,
+    n_jobs: int = 8,
+    sweep: Optional[list[dict]] = None,
+    precision: str = "float64",
+    **kwargs,
+) -> Union[tuple, list[tuple]]:
+    """Extract and denoise regional timeseries for a given atlas (or several
+    atlases, from a single read of each file).
+
+    In sweep mode, the raw regional signals are extracted once and every
+    configuration of the sweep (confounds, censoring, low-pass filtering and
+    interpolation) is then applied to these in memory.
+
+    Parameters
+    ----------
+    func_filename : list[str]
+        List of BIDS functional filenames
+    atlas_filename : Union[str, list[str]]
+        Path to the atlas filename (or list of paths)
+    verbose : int, optional
+        Amount of verbosity, by default 2
+    interpolate : bool, optional
+        Condition to ONLY interpolate the timeseries (without censoring),
+        by default False
+    low_pass : Optional[float], optional
+        Low-pass filtering cutoff frequency, by default None
+    denoising_strategy = Optional[tuple], optional,
+        the type of noise regressors to include.
+    motion: Optional[str], optional,
+        type of confounds extracted from head motion estimates
+    t_r : Optional[float], optional
+        Repetition time of the MRI, by default None
+    output : Optional[Union[str, list[str]]], optional
+        Path to the output directory (or one per atlas), by default None
+    atlas_cache : Optional[str], optional
+        Directory of the atlas projection cache, by default None
+    chunk_mb : Optional[float], optional
+        Memory budget (in MB) of the chunks of streamed volumes, by default None
+    n_jobs : int, optional
+        Number of parallel extraction jobs, by default 8
+    sweep : Optional[list[dict]], optional
+        Denoising configurations, each overriding the denoising parameters above
+        (and ``kwargs``), by default None
+    precision : str, optional
+        Floating point precision of the extraction and of the timeseries,
+        "float64" or "float32", by default "float64"
+
+    Returns
+    -------
+    Union[tuple, list[tuple]]
+        Three lists, with the extracted and denoised timeseries (one list per atlas
+        if a list of atlases is given), the corresponding confounds and the
+        corresponding sample masks (one such tuple per configuration in sweep
+        mode).
+    """
+    if not len(func_filename):
+        empty = ([[] for _ in atlas_filename], [], [])
+        if isinstance(atlas_filename, str):
+            empty = ([], [], [])
+        return empty if sweep is None else [empty] * len(sweep)
+
+    logging.info(f"Extracting and denoising timeseries for {len(func_filename)} files.")
+
+    if sweep is not None:
+        return sweep_denoising(
+            func_filename,
+            atlas_filename,
+            sweep,
+            t_r=t_r,
+            atlas_cache=atlas_cache,
+            chunk_mb=chunk_mb,
+            verbose=verbose,
+            n_jobs=n_jobs,
+            precision=precision,
+            interpolate=interpolate,
+            low_pass=low_pass,
+            denoising_strategy=denoising_strategy,
+            motion=motion,
+            output=output,
+            **kwargs,
+        )
+
+    logging.debug(f"Denoising strategy includes : {' '.join(denoising_strategy)}")
+    logging.debug(f"Denoising parameters are: {kwargs}")
+
+    with span("confounds", files=len(func_filename)):
+        confounds, sample_mask = load_denoising_confounds(
+            func_filename,
+            denoising_strategy=denoising_strategy,
+            motion=motion,
+            **kwargs,
+        )
+
+    if interpolate:
+        with span("extraction", files=len(func_filename)):
+            time_series, confounds = interpolate_and_denoise_timeseries(
+                func_filename,
+                atlas_filename,
+                confounds,
+                sample_mask,
+                t_r=t_r,
+                low_pass=low_pass,
+                output=output,
+                verbose=verbose,
+                atlas_cache=atlas_cache,
+                chunk_mb=chunk_mb,
+                n_jobs=n_jobs,
+                dtype=np.dtype(precision),
+            )
+        return time_series, confounds, sample_mask
+
+    with span("extraction", files=len(func_filename)):
+        time_series = fit_transform_patched(
+            func_filename,
+            atlas_filename,
+            confounds,
+            sample_mask,
+            atlas_cache=atlas_cache,
+            chunk_mb=chunk_mb,
+            low_pass=low_pass,
+            t_r=t_r,
+            standardize="zscore_sample",
+            verbose=verbose,
+            reports=True,
+            n_jobs=n_jobs,
+            dtype=np.dtype(precision),
+        )
+
+    return time_series, confounds, sample_mask
+
+
+def sweep_denoising(
+    func_filename: list[str],
+    atlas_filename: Union[str, list[str]],
+    sweep: list[dict],
+    t_r: Optional[float] = None,
+    atlas_cache: Optional[str] = None,
+    chunk_mb: Optional[float] = None,
+    confounds_cache: Optional[str] = None,
+    verbose: int = 2,
+    n_jobs: int = 8,
+    precision: str = "float64",
+    **defaults,
+) -> list[tuple]:
+    """Extract the raw regional signals once and denoise them with each
+    configuration of a sweep.
+
+    Parameters
+    ----------
+    func_filename : list[str]
+        List of BIDS functional filenames
+    atlas_filename : Union[str, list[str]]
+        Path to the atlas filename (or list of paths)
+    sweep : list[dict]
+        Denoising configurations, each overriding the ``defaults``
+    t_r : Optional[float], optional
+        Repetition time of the MRI, by default None
+    atlas_cache : Optional[str], optional
+        Directory of the atlas projection cache, by default None
+    chunk_mb : Optional[float], optional
+        Memory budget (in MB) of the chunks of streamed volumes, by default None
+    confounds_cache : Optional[str], optional
+        Directory of the persistent confounds cache, by default None
+    verbose : int, optional
+        Amount of verbosity, by default 2
+    n_jobs : int, optional
+        Number of parallel extraction jobs, by default 8
+    precision : str, optional
+        Floating point precision of the extraction and of the timeseries,
+        "float64" or "float32", by default "float64"
+
+    Returns
+    -------
+    list[tuple]
+        For each configuration, the denoised timeseries (one list per atlas if a
+        list of atlases is given), the corresponding confounds and the
+        corresponding sample masks.
+    """
+    with span("extraction", files=len(func_filename)):
+        raw_time_series = fit_transform_patched(
+            func_filename,
+            atlas_filename,
+            atlas_cache=atlas_cache,
+            chunk_mb=chunk_mb,
+            standardize=False,
+            verbose=verbose,
+            n_jobs=n_jobs,
+            dtype=np.dtype(precision),
+        )
+    single_atlas = isinstance(atlas_filename, str)
+    if single_atlas:
+        raw_time_series = [raw_time_series]
+
+    results = []
+    plots = []
+    # The confounds files are parsed once for all the configurations
+    with shared_confounds_files(confounds_cache):
+        for configuration in sweep:
+            configuration = defaults | configuration
+            logging.debug(f"Denoising configuration: {configuration}")
+
+            interpolate = configuration.pop("interpolate", False)
+            low_pass = configuration.pop("low_pass", None)
+            output = configuration.pop("output", None)
+            if not isinstance(output, list):
+                output = [output] * len(raw_time_series)
+
+            with span("confounds", files=len(func_filename)):
+                confounds, sample_mask = load_denoising_confounds(
+                    func_filename, **configuration
+                )
+
+            time_series = []
+            with span("denoising", files=len(func_filename)):
+                for atlas_raw_time_series, atlas_output in zip(
+                    raw_time_series, output
+                ):
+                    atlas_time_series, atlas_confounds = denoise_extracted_timeseries(
+                        atlas_raw_time_series,
+                        func_filename,
+                        confounds,
+                        sample_mask,
+                        interpolate=interpolate,
+                        low_pass=low_pass,
+                        t_r=t_r,
+                        output=atlas_output,
+                        plots=plots,
+                    )
+                    time_series.append(atlas_time_series)
+
+            if single_atlas:
+                time_series = time_series[0]
+            results.append((time_series, atlas_confounds, sample_mask))
+
+    # The figures of the interpolation are rendered once all the configurations
+    # are denoised
+    plot_interpolations(plots)
+
+    return results
+
+
+def get_sweep_configurations(filename: str) -> list[dict]:
+    """Load the denoising configurations of a sweep.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the JSON file with the list of configurations
+
+    Returns
+    -------
+    list[dict]
+        List of configurations, each with a name and the denoising parameters it
+        overrides.
+    """
+    with open(filename) as f:
+        configurations = json.load(f)
+
+    names = set()
+    for configuration in configurations:
+        name = configuration.get("name")
+        if not name or name in names:
+            raise ValueError(
+                f"Each configuration of the sweep needs a unique name, got '{name}'."
+            )
+        names.add(name)
+
+        unknown = set(configuration) - set(SWEEP_PARAMETERS) - {"name"}
+        if unknown:
+            raise ValueError(
+                f"Unknown parameters in the sweep configuration '{name}': "
+                f"{', '.join(sorted(unknown))}."
+            )
+        if "denoising_strategy" in configuration:
+            configuration["denoising_strategy"] = tuple(
+                configuration["denoising_strategy"]
+            )
+
+    return configurations
+
+
+def get_fc_kind(strategy: str = "sparse inverse covariance") -> tuple[str, str]:
+    """Get the kind and label of the functional connectivity of a strategy.
+
+    Parameters
+    ----------
+    strategy : str, optional
+        Name of the strategy, could be "correlation", "covariance" or "sparse",
+        by default "sparse inverse covariance"
+
+    Returns
+    -------
+    tuple[str, str]
+        Returns the name of the metric (correlation, covariance or precision) as
+        well as standardized label for file naming.
+    """
+    if strategy in ["cor", "corr", "correlation"]:
+        return "correlation", "correlation"
+    elif strategy not in ["sparse", "sparse inverse covariance"]:
+        return "covariance", "covariance"
+    return "precision", "sparseinversecovariance"
+
+
+def get_fc_strategy(
+    strategy: str = "sparse inverse covariance",
+) -> tuple[Union[GraphicalLassoCV, LedoitWolf], str, str]:
+    """Get the strategy to compute functional connectivity.
+
+    Parameters
+    ----------
+    strategy : str, optional
+        Name of the strategy, could be "correlation", "covariance" or "sparse",
+        by default "sparse inverse covariance"
+
+    Returns
+    -------
+    tuple[Union[GraphicalLassoCV, LedoitWolf], str, str]
+        Returns the covariance estimator, the name of the metric (covariance or
+        precision) as well as standardized label for file naming.
+    """
+    from sklearn.covariance import GraphicalLassoCV, LedoitWolf
+
+    connectivity_kind, connectivity_label = get_fc_kind(strategy)
+    if connectivity_kind == "correlation":
+        estimator = LedoitWolf(store_precision=False)
+    else:
+        estimator = GraphicalLassoCV(alphas=6, max_iter=1000)
+
+    return estimator, connectivity_kind, connectivity_label
+
+
+def compute_connectivity(
+    time_series: list[np.ndarray],
+    estimator: Optional[Union[LedoitWolf, GraphicalLassoCV]] = None,
+    connectivity_kind: str = "correlation",
+    groups: Optional[list] = None,
+    shared_alpha: bool = False,
+    n_jobs: int = 1,
+    return_convergence: bool = False,
+    dtype: Optional[type] = None,
+) -> Union[list[np.ndarray], tuple[list[np.ndarray], list[dict]]]:
+    """Compute the functional connectivity using the specified estimator and
+    connectivity kind.
+
+    Parameters
+    ----------
+    time_series : list[np.ndarray]
+        List of timeseries
+    estimator : Optional[Union[LedoitWolf, GraphicalLassoCV]], optional
+        Covariance estimator (usually from Scikit-Learn),
+        by default None (LedoitWolf(store_precision=False))
+    connectivity_kind : str, optional
+        Type of connectivity to compute, by default "correlation"
+    groups : Optional[list], optional
+        Participant of each timeseries, used to warm-start the sparse inverse
+        covariance estimation, by default None
+    shared_alpha : bool, optional
+        Condition to select one regularization of the sparse inverse covariance
+        for all the timeseries, by default False
+    n_jobs : int, optional
+        Number of parallel jobs of the sparse inverse covariance estimation,
+        by default 1
+    return_convergence : bool, optional
+        Condition to also return the regularization, number of iterations and
+        timings of the sparse inverse covariance estimation, by default False
+    dtype : Optional[type], optional
+        Data type of the connectivity matrices, by default None (single precision
+        for the batched and sparse estimations, double precision otherwise)
+
+    Returns
+    -------
+    Union[list[np.ndarray], tuple[list[np.ndarray], list[dict]]]
+        List of functional connectivity matrices (and the convergence record of
+        each timeseries, empty for other estimators).
+    """
+    from sklearn.covariance import GraphicalLassoCV, LedoitWolf
+
+    if estimator is None:
+        estimator = LedoitWolf(store_precision=False)
+
+    convergence = []
+    if not len(time_series):
+        return ([], convergence) if return_convergence else []
+    n_ts = len(time_series)
+    n_area = time_series[0].shape[-1]
+    logging.info(
+        f"Computing functional connectivity matrices for {n_ts} timeseries ..."
+    )
+
+    if (
+        isinstance(estimator, LedoitWolf)
+        and not estimator.assume_centered
+        and connectivity_kind in ["correlation", "covariance"]
+    ):
+        # Native batched estimation of Ledoit-Wolf correlations and covariances
+        fc_matrices = batched_connectivity(
+            time_series,
+            connectivity_kind=connectivity_kind,
+            dtype=dtype or np.float32,
+        )
+    elif (
+        isinstance(estimator, GraphicalLassoCV)
+        and connectivity_kind == "precision"
+        and not np.iterable(estimator.alphas)
+    ):
+        # Warm-started and parallel sparse inverse covariance estimation
+        fc_matrices, convergence = sparse_precision(
+            time_series,
+            groups=groups,
+            n_alphas=estimator.alphas,
+            n_refinements=estimator.n_refinements,
+            n_folds=estimator.cv if isinstance(estimator.cv, int) else SPARSE_N_FOLDS,
+            max_iter=estimator.max_iter,
+            tol=estimator.tol,
+            shared_alpha=shared_alpha,
+            n_jobs=n_jobs,
+            dtype=dtype or np.float32,
+        )
+    else:
+        from nilearn.connectome import ConnectivityMeasure, vec_to_sym_matrix
+
+        connectivity_estimator = ConnectivityMeasure(
+            cov_estimator=estimator,
+            kind=connectivity_kind,
+            vectorize=True,
+            discard_diagonal=True,
+        )
+        connectivity_measures = connectivity_estimator.fit_transform(time_series)
+        fc_matrices = vec_to_sym_matrix(
+            connectivity_measures, diagonal=np.zeros((n_ts, n_area))
+        )
+        if dtype is not None:
+            fc_matrices = fc_matrices.astype(dtype, copy=False)
+
+    return (fc_matrices, convergence) if return_convergence else fc_matrices
+
+
+def split_resources(
+    func_filenames: list[list[str]],
+    n_procs: int = 8,
+    mem_gb: Optional[float] = None,
+    chunk_mb: Optional[float] = None,
+    precision: str = "float64",
+) -> tuple[int, int]:
+    """Split the process (and memory) budget between the groups of files and the
+    extraction jobs within each group.
+
+    Parameters
+    ----------
+    func_filenames : list[list[str]]
+        Groups of BIDS functional filenames
+    n_procs : int, optional
+        Maximum number of processes, by default 8
+    mem_gb : Optional[float], optional
+        Maximum memory (in GB) of the concurrent extraction jobs, by default None
+    chunk_mb : Optional[float], optional
+        Memory budget (in MB) of the chunks of volumes streamed by each extraction
+        job, by default None (the runs are loaded whole)
+    precision : str, optional
+        Floating point precision of the extraction, by default "float64"
+
+    Returns
+    -------
+    tuple[int, int]
+        Number of groups processed concurrently and number of extraction jobs
+        within each group.
+    """
+    groups = [file_group for file_group in func_filenames if len(file_group)]
+    if not groups:
+        return 1, 1
+
+    n_slots = max(n_procs, 1)
+    if mem_gb is not None:
+        # A run is loaded in the precision of the extraction by each job
+        run_gb = max(
+            np.prod(read_nifti_header(filename).get_data_shape())
+            * np.dtype(precision).itemsize
+            / 2**30
+            for filename in chain.from_iterable(groups)
+        )
+        if chunk_mb is not None:
+            run_gb = min(run_gb, chunk_mb / 2**10)
+        n_slots = max(min(n_slots, int(mem_gb // run_gb)), 1)
+
+    n_workers = min(len(groups), n_slots)
+    n_jobs = max(n_slots // n_workers, 1)
+    # Do not reserve more jobs than the largest group can use
+    n_jobs = min(n_jobs, max(len(file_group) for file_group in groups))
+
+    return n_workers, n_jobs
+
+
+def process_group(
+    func_filename: list[str], t_r: float, settings: list[dict], n_jobs: int = 1
+) -> list[tuple[list[str], dict, dict, dict]]:
+    """Extract, denoise and save the timeseries of a group of files sharing their
+    FoV and TR, then compute and save their functional connectivity.
+
+    Each file is read once for all the atlases and denoising configurations.
+
+    Parameters
+    ----------
+    func_filename : list[str]
+        List of BIDS functional filenames
+    t_r : float
+        Repetition time of the files
+    settings : list[dict]
+        Settings of the run for each atlas and denoising configuration (atlas,
+        denoising and connectivity parameters)
+    n_jobs : int, optional
+        Number of parallel extraction (and sparse estimation) jobs, by default 1
+
+    Returns
+    -------
+    list[tuple[list[str], dict, dict, dict]]
+        For each settings, list of the saved paths, duration (in s) after
+        censoring, convergence of the sparse estimation and deviation from double
+        precision (of the validated files) of each file.
+    """
+    atlas_filenames = list(
+        dict.fromkeys(atlas_settings["atlas_filename"] for atlas_settings in settings)
+    )
+    configurations = []
+    for atlas_settings in settings:
+        if atlas_settings["denoising"] not in configurations:
+            configurations.append(atlas_settings["denoising"])
+
+    # Output directory of each atlas for each denoising configuration
+    outputs = [[None] * len(atlas_filenames) for _ in configurations]
+    for atlas_settings in settings:
+        outputs[configurations.index(atlas_settings["denoising"])][
+            atlas_filenames.index(atlas_settings["atlas_filename"])
+        ] = atlas_settings["output"]
+
+    extracted = extract_group(
+        func_filename, atlas_filenames, configurations, outputs, t_r, n_jobs=n_jobs
+    )
+
+    # A few runs are computed again in double precision to measure the deviation
+    # of the single precision outputs
+    reference = None
+    n_validate = min(settings[0]["validate_precision"], len(func_filename))
+    if configurations[0].get("precision", "float64") != "float64" and n_validate:
+        logging.info(f"Validating the precision on {n_validate} file(s) ...")
+        with span("precision_validation", files=n_validate):
+            reference = extract_group(
+                func_filename[:n_validate],
+                atlas_filenames,
+                [
+                    configuration | {"precision": "float64"}
+                    for configuration in configurations
+                ],
+                [[None] * len(atlas_filenames) for _ in configurations],
+                t_r,
+                n_jobs=n_jobs,
+            )
+
+    results = []
+    for atlas_settings in settings:
+        output = atlas_settings["output"]
+        time_series_per_atlas, confounds, sample_mask = extracted[
+            configurations.index(atlas_settings["denoising"])
+        ]
+        time_series = time_series_per_atlas[
+            atlas_filenames.index(atlas_settings["atlas_filename"])
+        ]
+
+        # Saving aggregated/denoised timeseries
+        logging.info(f"Saving denoised timeseries in {output} ...")
+        os.makedirs(output, exist_ok=True)
+        with span("save_timeseries", files=len(func_filename)):
+            saved_paths = save_output(
+                time_series,
+                func_filename,
+                output,
+                patterns=TIMESERIES_PATTERN,
+                **atlas_settings["timeseries_fills"],
+            )
+
+        convergence = {}
+        if not atlas_settings["defer_fc"]:
+            censored_mask, n_volumes = get_censoring(
+                confounds, sample_mask, atlas_settings["denoising"]["interpolate"]
+            )
+            fc_paths, convergence = save_connectivity(
+                time_series,
+                func_filename,
+                atlas_settings,
+                n_jobs=n_jobs,
+                t_r=[t_r] * len(func_filename),
+                sample_mask=censored_mask,
+                n_volumes=n_volumes,
+            )
+            saved_paths += fc_paths
+
+        # Compute duration of fMRI scans after censoring
+        # (mask.shape[0] indicates the number of volumes that are not censored,
+        # there is no mask when no volume is censored)
+        durations = {
+            op.basename(filename): (ts.shape[0] if mask is None else mask.shape[0])
+            * t_r
+            for filename, ts, mask in zip(func_filename, time_series, sample_mask)
+        }
+
+        deviations = {}
+        if reference is not None:
+            with span("precision_validation", files=n_validate):
+                reference_time_series = reference[
+                    configurations.index(atlas_settings["denoising"])
+                ][0][atlas_filenames.index(atlas_settings["atlas_filename"])]
+                deviations = validate_precision(
+                    time_series[:n_validate],
+                    reference_time_series,
+                    func_filename[:n_validate],
+                    atlas_settings,
+                    n_jobs=n_jobs,
+                )
+
+        results.append((saved_paths, durations, convergence, deviations))
+
+    from joblib.externals.loky import get_reusable_executor
+
+    # The loky workers spawned by NiLearn's maskers (and the sparse estimation)
+    # would otherwise keep this worker from exiting when the pool shuts down
+    get_reusable_executor().shutdown(wait=True)
+
+    return results
+
+
+def extract_group(
+    func_filename: list[str],
+    atlas_filenames: list[str],
+    configurations: list[dict],
+    outputs: list[list[Optional[str]]],
+    t_r: float,
+    n_jobs: int = 1,
+) -> list[tuple]:
+    """Extract and denoise the timeseries of a group of files for all the atlases
+    and denoising configurations, from a single read of each file.
+
+    Parameters
+    ----------
+    func_filename : list[str]
+        List of BIDS functional filenames
+    atlas_filenames : list[str]
+        Paths to the atlas files
+    configurations : list[dict]
+        Denoising configurations
+    outputs : list[list[Optional[str]]]
+        Output directory of each atlas for each configuration
+    t_r : float
+        Repetition time of the files
+    n_jobs : int, optional
+        Number of parallel extraction jobs, by default 1
+
+    Returns
+    -------
+    list[tuple]
+        For each configuration, the denoised timeseries (one list per atlas), the
+        corresponding confounds and the corresponding sample masks.
+    """
+    if len(configurations) == 1:
+        return [
+            extract_and_denoise_timeseries(
+                func_filename,
+                atlas_filenames,
+                t_r=t_r,
+                n_jobs=n_jobs,
+                output=outputs[0],
+                **configurations[0],
+            )
+        ]
+
+    extraction = {
+        key: configurations[0][key]
+        for key in EXTRACTION_PARAMETERS + ("precision",)
+        if key in configurations[0]
+    }
+    sweep = [
+        {key: value for key, value in configuration.items() if key not in extraction}
+        | {"output": configuration_outputs}
+        for configuration, configuration_outputs in zip(configurations, outputs)
+    ]
+    return extract_and_denoise_timeseries(
+        func_filename,
+        atlas_filenames,
+        t_r=t_r,
+        n_jobs=n_jobs,
+        sweep=sweep,
+        **extraction,
+    )
+
+
+def precision_deviation(values: np.ndarray, reference: np.ndarray) -> tuple:
+    """Deviation of an array from its double precision reference.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Array computed in lower precision
+    reference : np.ndarray
+        Array computed in double precision
+
+    Returns
+    -------
+    tuple
+        Maximum absolute deviation and deviation relative to the (Frobenius) norm
+        of the reference.
+    """
+    difference = np.asarray(values, dtype=float) - reference
+    return (
+        float(np.max(np.abs(difference), initial=0)),
+        float(np.linalg.norm(difference) / np.linalg.norm(reference)),
+    )
+
+
+def validate_precision(
+    time_series: list[np.ndarray],
+    reference_time_series: list[np.ndarray],
+    func_filename: list[str],
+    settings: dict,
+    n_jobs: int = 1,
+) -> dict:
+    """Compare the outputs of a few files with their double precision reference.
+
+    Parameters
+    ----------
+    time_series : list[np.ndarray]
+        List of timeseries computed in lower precision
+    reference_time_series : list[np.ndarray]
+        List of the same timeseries computed in double precision
+    func_filename : list[str]
+        List of the BIDS functional filenames of the timeseries
+    settings : dict
+        Settings of the run (atlas and connectivity parameters)
+    n_jobs : int, optional
+        Number of parallel jobs of the sparse estimation, by default 1
+
+    Returns
+    -------
+    dict
+        Maximum absolute and relative deviations of the timeseries and of the
+        connectivity matrices (NaN if they are not computed yet) of each file.
+    """
+    from bids.layout import parse_file_entities
+
+    fc_deviations = [(np.nan, np.nan)] * len(func_filename)
+    if not settings["defer_fc"]:
+        reference_fc = compute_connectivity(
+            reference_time_series,
+            estimator=settings["covar_estimator"],
+            connectivity_kind=settings["fc_kind"],
+            groups=[
+                parse_file_entities(filename)["subject"] for filename in func_filename
+            ],
+            n_jobs=n_jobs,
+            dtype=np.float64,
+        )
+        fc_deviations = [
+            precision_deviation(
+                load_output(
+                    op.join(
+                        settings["output"],
+                        get_bids_savename(
+                            filename,
+                            patterns=FC_PATTERN,
+                            meas=settings["fc_label"],
+                            **settings["fc_fills"],
+                        ),
+                    )
+                ),
+                fc,
+            )
+            for filename, fc in zip(func_filename, reference_fc)
+        ]
+
+    deviations = {}
+    for filename, ts, reference_ts, fc_deviation in zip(
+        func_filename, time_series, reference_time_series, fc_deviations
+    ):
+        deviations[op.basename(filename)] = {
+            "precision": str(np.asarray(ts).dtype),
+            **dict(
+                zip(
+                    PRECISION_COLUMNS,
+                    precision_deviation(ts, reference_ts) + fc_deviation,
+                )
+            ),
+        }
+    return deviations
+
+
+def save_connectivity(
+    time_series: list[np.ndarray],
+    func_filename: list[str],
+    settings: dict,
+    n_jobs: int = 1,
+    t_r: Optional[list[float]] = None,
+    kinds: tuple = ("connectivity", "dynamic"),
+    sample_mask: Optional[list] = None,
+    n_volumes: Optional[list[int]] = None,
+) -> tuple[list[str], dict]:
+    """Compute and save the functional connectivity matrices (and the dynamic
+    functional connectivity).
 
     Parameters
     ----------
     time_series : list[np.ndarray]
         List of timeseries
-    estimator : Union[LedoitWolf, GraphicalLassoCV], optional
-        Covariance estimator (usually from Scikit-Learn),
-        by default LedoitWolf(store_precision=False)
-    connectivity_kind : str, optional
-        Type of connectivity to compute, by default "correlation"
+    func_filename : list[str]
+        List of the BIDS functional filenames of the timeseries
+    settings : dict
+        Settings of the run (atlas and connectivity parameters)
+    n_jobs : int, optional
+        Number of parallel jobs of the sparse estimation, by default 1
+    t_r : Optional[list[float]], optional
+        Repetition time of each file, required by the dynamic functional
+        connectivity, by default None
+    kinds : tuple, optional
+        Kinds of connectivity to compute, by default ("connectivity", "dynamic")
+        (the dynamic connectivity is only computed if enabled in the settings)
+    sample_mask : Optional[list], optional
+        Sample mask of each censored timeseries, by default None (the timeseries
+        are not censored)
+    n_volumes : Optional[list[int]], optional
+        Number of volumes of each file before censoring, by default None
 
     Returns
     -------
-    list[np.ndarray]
-        List of functional connectivity matrices
+    tuple[list[str], dict]
+        List of the saved paths and convergence of the sparse estimation of each
+        file.
     """
-    if not len(time_series):
-        return []
-    n_ts = len(time_series)
-    n_area = time_series[0].shape[-1]
-    logging.info(
-        f"Computing functional connectivity matrices for {n_ts} timeseries ..."
+    from bids.layout import parse_file_entities
+
+    output = settings["output"]
+    saved_paths, convergence = [], []
+
+    if "connectivity" in kinds and len(time_series):
+        with span("connectivity", files=len(func_filename)):
+            fc_matrices, convergence = compute_connectivity(
+                time_series,
+                estimator=settings["covar_estimator"],
+                connectivity_kind=settings["fc_kind"],
+                groups=[
+                    parse_file_entities(filename)["subject"]
+                    for filename in func_filename
+                ],
+                shared_alpha=settings["shared_alpha"],
+                n_jobs=n_jobs,
+                return_convergence=True,
+                dtype=np.dtype(settings["denoising"].get("precision", "float64")),
+            )
+
+        logging.info("Saving connectivity matrices ...")
+        with span("save_connectivity", files=len(func_filename)):
+            saved_paths += save_output(
+                fc_matrices,
+                func_filename,
+                output,
+                patterns=FC_PATTERN,
+                meas=settings["fc_label"],
+                **settings["fc_fills"],
+            )
+
+    if "dynamic" in kinds and settings["dynamic"] is not None:
+        saved_paths += save_dynamic_connectivity(
+            time_series,
+            func_filename,
+            settings,
+            t_r,
+            sample_mask=sample_mask,
+            n_volumes=n_volumes,
+        )
+
+    convergence = {
+        op.basename(filename): record
+        for filename, record in zip(func_filename, convergence)
+    }
+    return saved_paths, convergence
+
+
+def save_dynamic_connectivity(
+    time_series: list[np.ndarray],
+    func_filename: list[str],
+    settings: dict,
+    t_r: list[float],
+    sample_mask: Optional[list] = None,
+    n_volumes: Optional[list[int]] = None,
+) -> list[str]:
+    """Compute and save the correlations within sliding windows of each file.
+
+    The windows of each file are stored as an array of shape (n_windows, n_edges)
+    next to its static connectivity. The windows of censored timeseries slide
+    over all the volumes of the run, and those containing censored volumes are
+    NaN (their number is recorded in the JSON sidecar).
+
+    Parameters
+    ----------
+    time_series : list[np.ndarray]
+        List of timeseries
+    func_filename : list[str]
+        List of the BIDS functional filenames of the timeseries
+    settings : dict
+        Settings of the run (with the length, step and taper of the windows)
+    t_r : list[float]
+        Repetition time of each file
+    sample_mask : Optional[list], optional
+        Sample mask of each censored timeseries, by default None (the timeseries
+        are not censored)
+    n_volumes : Optional[list[int]], optional
+        Number of volumes of each file before censoring, by default None
+
+    Returns
+    -------
+    list[str]
+        List of the saved paths.
+    """
+    dynamic = settings["dynamic"]
+    logging.info("Computing the dynamic connectivity ...")
+    if sample_mask is None:
+        sample_mask = [None] * len(func_filename)
+    if n_volumes is None:
+        n_volumes = [None] * len(func_filename)
+
+    saved_paths = []
+    with span("dynamic_connectivity", files=len(func_filename)):
+        for ts, filename, run_t_r, mask, run_n_volumes in zip(
+            time_series, func_filename, t_r, sample_mask, n_volumes
+        ):
+            window = max(int(round(dynamic["window"] / run_t_r)), 2)
+            step = max(int(round(dynamic["step"] / run_t_r)), 1)
+            dfc = sliding_window_connectivity(
+                ts,
+                window,
+                step,
+                taper=dynamic["taper"],
+                sample_mask=mask,
+                n_timepoints=run_n_volumes,
+            )
+            saved_paths += save_output(
+                [dfc],
+                [filename],
+                settings["output"],
+                metadata={
+                    "RepetitionTime": run_t_r,
+                    "WindowLength": window,
+                    "WindowStep": step,
+                    "Taper": dynamic["taper"],
+                    "CensoredWindows": int(np.isnan(dfc).any(axis=1).sum()),
+                    "NumberOfRegions": int(np.shape(ts)[1]),
+                },
+                patterns=DYNAMIC_FC_PATTERN,
+                **DYNAMIC_FC_FILLS,
+            )
+
+    return saved_paths
+
+
+def get_connectivity_kinds(settings: dict) -> tuple:
+    """Kinds of connectivity outputs of a run (see get_ledger_entries).
+
+    Parameters
+    ----------
+    settings : dict
+        Settings of the run
+
+    Returns
+    -------
+    tuple
+        "connectivity", and "dynamic" if the dynamic connectivity is enabled.
+    """
+    return ("connectivity",) + ("dynamic",) * (settings["dynamic"] is not None)
+
+
+def render_reports(
+    filename: str, settings: dict, kinds: tuple = ("timeseries", "connectivity")
+):
+    """Render the visual reports of a file from its saved outputs.
+
+    Parameters
+    ----------
+    filename : str
+        BIDS functional filename
+    settings : dict
+        Settings of the run (atlas, denoising and connectivity parameters)
+    kinds : tuple, optional
+        Kinds of outputs to report, by default ("timeseries", "connectivity")
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    from reports import visual_report_fc, visual_report_timeserie
+
+    output = settings["output"]
+
+    if "timeseries" in kinds:
+        with span("plot_timeseries", files=1):
+            (time_series,) = load_timeseries(
+                [filename], output, output_format=settings["output_format"]
+            )
+            # The confounds are loaded again (from the confounds cache if enabled)
+            confounds, _ = load_denoising_confounds(
+                [filename],
+                **{
+                    key: value
+                    for key, value in settings["denoising"].items()
+                    if key in CONFOUNDS_PARAMETERS
+                },
+            )
+            visual_report_timeserie(
+                np.asarray(time_series),
+                filename=filename,
+                output=output,
+                confounds=confounds[0],
+                labels=settings["atlas_labels"],
+                networks=settings["atlas_network"],
+            )
+
+    if "connectivity" in kinds:
+        with span("plot_connectivity", files=1):
+            fc_path = op.join(
+                output,
+                get_bids_savename(
+                    filename,
+                    patterns=FC_PATTERN,
+                    meas=settings["fc_label"],
+                    **settings["fc_fills"],
+                ),
+            )
+            visual_report_fc(
+                np.asarray(load_output(fc_path)),
+                filename=filename,
+                output=output,
+                labels=settings["atlas_labels"],
+                meas=settings["fc_label"],
+            )
+
+
+def submit_reports(executor, jobs: list[tuple]) -> list:
+    """Submit the rendering of visual reports, one task per file.
+
+    Parameters
+    ----------
+    executor : concurrent.futures.Executor
+        Pool of processes rendering the reports
+    jobs : list[tuple]
+        Files, settings of the run and kinds of outputs to report
+
+    Returns
+    -------
+    list
+        Futures of the rendering tasks
+    """
+    return [
+        executor.submit(run_profiled, render_reports, filename, settings, kinds)
+        for func_filename, settings, kinds in jobs
+        if {"timeseries", "connectivity"} & set(kinds)
+        for filename in func_filename
+    ]
+
+
+def get_ledger_entries(
+    connection, func_filename: list[str], settings: dict, hash_content: bool = True
+) -> dict[str, dict]:
+    """Get the parameters hash and output paths recorded in the ledger for each
+    kind of output of a run.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        Connection to the ledger
+    func_filename : list[str]
+        List of BIDS functional filenames
+    settings : dict
+        Settings of the run (atlas, denoising and connectivity parameters)
+    hash_content : bool, optional
+        Condition to hash the atlas if it changed since it was last hashed, by
+        default True
+
+    Returns
+    -------
+    dict[str, dict]
+        Hash of the parameters and path to the output of each file, for the
+        "timeseries", "connectivity" and (if enabled) "dynamic" outputs. The
+        hashes are None if the atlas was not hashed (see ``hash_content``).
+    """
+    # An atlas not fetched yet (see --plan) matches none of the recorded outputs
+    atlas_hash = None
+    if settings["atlas_filename"] is not None:
+        atlas_hash = file_hash(
+            connection, settings["atlas_filename"], hash_content=hash_content
+        )
+    timeseries_hash = hash_parameters(
+        {
+            "atlas": atlas_hash,
+            # The outputs recorded before the precision option stay valid
+            "denoising": {
+                key: value
+                for key, value in settings["denoising"].items()
+                if key not in EXTRACTION_PARAMETERS
+                and (key, value) != ("precision", "float64")
+            },
+            "output_format": settings["output_format"],
+        }
     )
+    connectivity_hash = hash_parameters(
+        {
+            "timeseries": timeseries_hash,
+            "fc_label": settings["fc_label"],
+            "shared_alpha": settings["shared_alpha"],
+        }
+    )
+    dynamic_hash = hash_parameters(
+        {"timeseries": timeseries_hash, "dynamic": settings["dynamic"]}
+    )
+    # Whereas the recorded outputs of an atlas not hashed are unknown
+    if settings["atlas_filename"] is not None and atlas_hash is None:
+        timeseries_hash = connectivity_hash = dynamic_hash = None
+
+    timeseries_paths, connectivity_paths, dynamic_paths = {}, {}, {}
+    for filename in func_filename:
+        timeseries_paths[filename] = op.join(
+            settings["output"],
+            get_bids_savename(
+                filename, patterns=TIMESERIES_PATTERN, **settings["timeseries_fills"]
+            ),
+        )
+        connectivity_paths[filename] = op.join(
+            settings["output"],
+            get_bids_savename(
+                filename,
+                patterns=FC_PATTERN,
+                meas=settings["fc_label"],
+                **settings["fc_fills"],
+            ),
+        )
+        dynamic_paths[filename] = op.join(
+            settings["output"],
+            get_bids_savename(
+                filename, patterns=DYNAMIC_FC_PATTERN, **DYNAMIC_FC_FILLS
+            ),
+        )
+
+    entries = {
+        "timeseries": {
+            "params_hash": timeseries_hash,
+            "output_paths": timeseries_paths,
+        },
+        "connectivity": {
+            "params_hash": connectivity_hash,
+            "output_paths": connectivity_paths,
+        },
+    }
+    if settings["dynamic"] is not None:
+        entries["dynamic"] = {
+            "params_hash": dynamic_hash,
+            "output_paths": dynamic_paths,
+        }
+    return entries
+
+
+def print_plan(
+    settings: list[dict],
+    func_filenames: list[str],
+    missing_ts: list[str],
+    missing_fc: list[list[str]],
+    missing_dfc: list[list[str]],
+    unknown: Optional[list[list[str]]] = None,
+):
+    """Print the outputs that would be computed for each atlas.
+
+    Parameters
+    ----------
+    settings : list[dict]
+        Settings of each atlas (and denoising configuration)
+    func_filenames : list[str]
+        List of BIDS functional filenames
+    missing_ts : list[str]
+        Files whose timeseries would be extracted (for all the atlases)
+    missing_fc : list[list[str]]
+        Other files whose connectivity would be computed, for each atlas
+    missing_dfc : list[list[str]]
+        Other files whose dynamic connectivity would be computed, for each atlas
+    unknown : Optional[list[list[str]]], optional
+        Other files whose inputs or atlas were not hashed, so that their existing
+        outputs may be stale, for each atlas, by default None
+    """
+    missing_ts = set(missing_ts)
+    unknown = unknown or [[] for _ in settings]
+    for atlas_settings, atlas_missing_fc, atlas_missing_dfc, atlas_unknown in zip(
+        settings, map(set, missing_fc), map(set, missing_dfc), map(set, unknown)
+    ):
+        print(
+            f"DiFuMo{atlas_settings['atlas_dimension']} "
+            f"({atlas_settings['atlas_filename'] or 'not fetched yet'})"
+            f" -> {atlas_settings['output']}"
+        )
+
+        connectivity_kinds = get_connectivity_kinds(atlas_settings)
+        n_planned, n_unknown = 0, 0
+        for filename in func_filenames:
+            if filename in missing_ts:
+                kinds = ("timeseries",) + connectivity_kinds
+            elif filename in atlas_missing_fc:
+                kinds = connectivity_kinds
+            elif filename in atlas_missing_dfc:
+                kinds = ("dynamic",)
+            elif filename in atlas_unknown:
+                n_unknown += 1
+                print(
+                    f"\t{op.basename(filename)}: unknown (inputs or atlas not hashed)"
+                )
+                continue
+            else:
+                continue
+            n_planned += 1
+            print(f"\t{op.basename(filename)}: {', '.join(kinds)}")
+        print(
+            f"\t{n_planned} of {len(func_filenames)} file(s) to compute"
+            + (f", {n_unknown} unknown." if n_unknown else ".")
+        )
+
+
+def record_ledger(
+    connection,
+    settings: dict,
+    func_filename: list[str],
+    input_hashes: dict[str, str],
+    kinds: tuple = ("timeseries", "connectivity"),
+):
+    """Record the outputs of processed files in the ledger.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        Connection to the ledger
+    settings : dict
+        Settings of the run, with its ledger entries
+    func_filename : list[str]
+        List of processed BIDS functional filenames
+    input_hashes : dict[str, str]
+        Hash of the inputs of each file
+    kinds : tuple, optional
+        Kinds of outputs produced, by default ("timeseries", "connectivity")
+    """
+    for kind in kinds:
+        entries = settings["ledger"][kind]
+        record_outputs(
+            connection,
+            kind,
+            entries["params_hash"],
+            {filename: input_hashes[filename] for filename in func_filename},
+            entries["output_paths"],
+        )
+
+
+def process_existing_timeseries(
+    func_filename: list[str],
+    settings: dict,
+    n_jobs: int = 1,
+    t_r: Optional[list[float]] = None,
+    kinds: tuple = ("connectivity", "dynamic"),
+) -> tuple[list[str], dict, dict, dict]:
+    """Compute and save the functional connectivity of existing timeseries.
+
+    Parameters
+    ----------
+    func_filename : list[str]
+        List of BIDS functional filenames with existing timeseries
+    settings : dict
+        Settings of the run (atlas and connectivity parameters)
+    n_jobs : int, optional
+        Number of parallel jobs of the sparse estimation, by default 1
+    t_r : Optional[list[float]], optional
+        Repetition time of each file, by default None
+    kinds : tuple, optional
+        Kinds of connectivity to compute, by default ("connectivity", "dynamic")
+
+    Returns
+    -------
+    tuple[list[str], dict, dict, dict]
+        List of the saved paths, (empty) durations after censoring, convergence of
+        the sparse estimation and (empty) precision deviations of each file.
+    """
+    precision = settings["denoising"].get("precision", "float64")
+    time_series = [
+        np.asarray(ts, dtype=precision)
+        for ts in load_timeseries(
+            func_filename, settings["output"], output_format=settings["output_format"]
+        )
+    ]
+
+    # The windows of the dynamic connectivity slide over all the volumes of the
+    # censored runs
+    sample_mask, n_volumes = None, None
+    if "dynamic" in kinds and settings["dynamic"] is not None:
+        confounds, sample_mask = load_denoising_confounds(
+            func_filename,
+            **{
+                key: value
+                for key, value in settings["denoising"].items()
+                if key in CONFOUNDS_PARAMETERS
+            },
+        )
+        sample_mask, n_volumes = get_censoring(
+            confounds, sample_mask, settings["denoising"].get("interpolate", False)
+        )
 
-    connectivity_estimator = ConnectivityMeasure(
-        cov_estimator=estimator,
-        kind=connectivity_kind,
-        vectorize=True,
-        discard_diagonal=True,
+    from joblib.externals.loky import get_reusable_executor
+
+    saved_paths, convergence = save_connectivity(
+        time_series,
+        func_filename,
+        settings,
+        n_jobs=n_jobs,
+        t_r=t_r,
+        kinds=kinds,
+        sample_mask=sample_mask,
+        n_volumes=n_volumes,
     )
-    connectivity_measures = connectivity_estimator.fit_transform(time_series)
-    return vec_to_sym_matrix(connectivity_measures, diagonal=np.zeros((n_ts, n_area)))
+    get_reusable_executor().shutdown(wait=True)
+
+    return saved_paths, {}, convergence, {}
+
+
+def append_csv(filename: str, header: list[str], rows: list[list]):
+    """Append rows to a CSV file, writing the header if the file is new.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the CSV file
+    header : list[str]
+        Names of the columns
+    rows : list[list]
+        Rows to append
+    """
+    with open(filename, "a", newline="") as f:
+        writer = csv.writer(f)
+        if f.tell() == 0:
+            # Write header if file is empty
+            writer.writerow(header)
+        writer.writerows(rows)
+
+
+def record_group_results(
+    output: str,
+    durations: dict,
+    convergence: dict,
+    deviations: Optional[dict] = None,
+    shard: Optional[tuple[int, int]] = None,
+):
+    """Record the duration after censoring, the convergence of the sparse
+    estimation and the deviation from double precision of the files of a group as
+    soon as it completes.
+
+    Parameters
+    ----------
+    output : str
+        Output directory
+    durations : dict
+        Duration (in s) after censoring of each file
+    convergence : dict
+        Convergence of the sparse estimation of each file
+    deviations : Optional[dict], optional
+        Deviation from double precision of the validated files, by default None
+    shard : Optional[tuple[int, int]], optional
+        Index of the shard and number of shards, whose results are recorded in
+        their own files (see funconn_merge.py), by default None
+    """
+    if durations:
+        append_csv(
+            get_shard_filename(op.join(output, DURATION_FILE), shard),
+            ["filename", "duration"],
+            list(durations.items()),
+        )
+    if convergence:
+        append_csv(
+            get_shard_filename(op.join(output, CONVERGENCE_FILE), shard),
+            ["filename", "alpha", "n_iter", "cv_time", "fit_time"],
+            [
+                [filename, *record.values()]
+                for filename, record in convergence.items()
+            ],
+        )
+    if deviations:
+        append_csv(
+            get_shard_filename(op.join(output, PRECISION_FILE), shard),
+            ["filename", "precision", *PRECISION_COLUMNS],
+            [
+                [filename, *record.values()]
+                for filename, record in deviations.items()
+            ],
+        )
 
 
 def main():
@@ -548,6 +2354,8 @@ def main():
     task_filter = args.task
     run_filter = args.run
     overwrite = args.overwrite
+    output_format = args.output_format
+    export_to_tsv = args.export_tsv and output_format != "tsv"
 
     # denoise_only = args.denoise_only
     atlas_dimension = args.atlas_dimension
@@ -559,6 +2367,7 @@ def main():
     scrub = args.n_scrub_frames
     fc_estimator = args.fc_estimator
     interpolate = args.no_censor
+    atlas_cache = None if args.no_atlas_cache else args.atlas_cache
 
     verbosity_level = args.verbosity
     nilearn_verbose = verbosity_level - 1
@@ -579,159 +2388,500 @@ def main():
 
     logging.captureWarnings(True)
 
-    func_filenames, t_r_list = get_func_filenames_bids(
-        input_path,
-        task_filter=task_filter,
-        ses_filter=ses_filter,
-        run_filter=run_filter,
-    )
-    all_filenames = list(chain.from_iterable(func_filenames))
+    with span("discovery") as record:
+        func_filenames, t_r_list = get_func_filenames_bids(
+            input_path,
+            task_filter=task_filter,
+            ses_filter=ses_filter,
+            run_filter=run_filter,
+        )
+        if args.shard is not None:
+            func_filenames, t_r_list = select_shard(
+                func_filenames, t_r_list, args.shard
+            )
+            logging.info(f"Processing shard {args.shard[0]} of {args.shard[1]}.")
+        all_filenames = list(chain.from_iterable(func_filenames))
+        record["files"] = len(all_filenames)
+    t_r_by_file = {
+        filename: t_r
+        for file_group, t_r in zip(func_filenames, t_r_list)
+        for filename in file_group
+    }
     logging.info(f"Found {len(all_filenames)} functional file(s):")
     logging.info(
         "\t" + "\n\t".join([op.basename(filename) for filename in all_filenames])
     )
 
-    atlas_data = get_atlas_data(dimension=atlas_dimension)
-    atlas_filename = getattr(atlas_data, "maps")
-    atlas_labels = getattr(atlas_data, "labels").loc[:, "difumo_names"]
-    atlas_network = getattr(atlas_data, "labels").loc[:, NETWORK_MAPPING]
-
-    if output is None:
-        run_name = f"DiFuMo{atlas_dimension:d}"
-        if study_name:
-            run_name = "-".join([study_name, run_name])
-
-        run_name += (low_pass is not None) * "-LP"
-        run_name += (interpolate) * "-noCensoring"
-
-        output = op.join(
-            find_derivative(input_path), "functional_connectivity", run_name
+    fc_kind, fc_label = get_fc_kind(fc_estimator)
+    if args.shard is not None and args.shared_alpha and fc_kind == "precision":
+        raise ValueError(
+            "A regularization shared by all the runs (--shared-alpha) cannot be "
+            "selected by a single shard (--shard)."
         )
-    logging.info(f"Output will be save as derivatives in:\n\t{output}")
-
-    covar_estimator, fc_kind, fc_label = get_fc_strategy(fc_estimator)
     logging.info(f"'{fc_label}' has been selected as connectivity metric")
 
+    denoising = {
+        "verbose": nilearn_verbose,
+        "low_pass": low_pass,
+        "denoising_strategy": denoising_strategy,
+        "motion": motion,
+        "fd_threshold": fd_threshold,
+        "std_dvars_threshold": std_dvars_threshold,
+        "scrub": scrub,
+        "interpolate": interpolate,
+        "atlas_cache": atlas_cache,
+        "chunk_mb": args.chunk_mb,
+        "confounds_cache": None if args.no_confounds_cache else args.confounds_cache,
+        "precision": args.precision,
+    }
+    configurations = [{}]
+    if args.sweep is not None:
+        configurations = get_sweep_configurations(args.sweep)
+        logging.info(f"Sweeping {len(configurations)} denoising configurations.")
+
+    # One output tree per atlas dimension and denoising configuration, all
+    # extracted from a single read. The atlases already fetched are found without
+    # NiLearn (their labels are only loaded if outputs are computed).
+    with span("atlases", atlases=len(atlas_dimension)):
+        atlas_maps = []
+        for dimension in atlas_dimension:
+            maps = find_atlas_maps(dimension)
+            if maps is None and not args.plan:
+                maps = getattr(get_atlas_data(dimension=dimension), "maps")
+            atlas_maps.append(maps)
+    settings = []
+    for configuration in configurations:
+        configuration = configuration.copy()
+        name = configuration.pop("name", None)
+        configuration_denoising = denoising | configuration
+
+        for dimension, maps in zip(atlas_dimension, atlas_maps):
+            run_name = f"DiFuMo{dimension:d}"
+            if study_name:
+                run_name = "-".join([study_name, run_name])
+
+            run_name += (configuration_denoising["low_pass"] is not None) * "-LP"
+            run_name += (configuration_denoising["interpolate"]) * "-noCensoring"
+            if name is not None:
+                run_name += f"-{name}"
+
+            if output is None:
+                atlas_output = op.join(
+                    find_derivative(input_path), "functional_connectivity", run_name
+                )
+            elif len(atlas_dimension) > 1 or name is not None:
+                atlas_output = op.join(output, run_name)
+            else:
+                atlas_output = output
+            logging.info(f"Output will be save as derivatives in:\n\t{atlas_output}")
+
+            settings.append(
+                {
+                    "output": atlas_output,
+                    "output_format": output_format,
+                    "atlas_dimension": dimension,
+                    "atlas_filename": maps,
+                    "atlas_labels": None,
+                    "atlas_network": None,
+                    "denoising": configuration_denoising,
+                    "covar_estimator": None,
+                    "fc_kind": fc_kind,
+                    "fc_label": fc_label,
+                    # A regularization shared by all the runs requires their
+                    # timeseries
+                    "shared_alpha": args.shared_alpha,
+                    "defer_fc": args.shared_alpha and fc_kind == "precision",
+                    "validate_precision": args.validate_precision,
+                    "dynamic": None
+                    if args.no_dfc
+                    else {
+                        "window": args.dfc_window,
+                        "step": args.dfc_step,
+                        "taper": args.dfc_taper,
+                    },
+                    "timeseries_fills": get_output_fills(
+                        TIMESERIES_FILLS, output_format
+                    ),
+                    "fc_fills": get_output_fills(FC_FILLS, output_format),
+                }
+            )
+
+    # The timing and memory of the stages (and optionally the cProfile statistics
+    # of the jobs) are saved next to the outputs of all the atlases
+    profile_output = op.commonpath(
+        [atlas_settings["output"] for atlas_settings in settings]
+    )
+    cprofile_dir = op.join(profile_output, PROFILE_DIR) if args.profile else None
+
+    # The ledger records the content of the inputs and the parameters of each output
+    # (the plan neither writes the ledger nor hashes the content of the inputs and
+    # atlases: files changed since they were last hashed are reported as unknown)
+    ledger = None
+    ledger_file = args.ledger or op.join(profile_output, LEDGER_FILE)
+    if not args.no_ledger:
+        with span("ledger", files=len(all_filenames)):
+            if args.plan:
+                ledger = open_ledger(
+                    ledger_file if op.exists(ledger_file) else ":memory:"
+                )
+            elif args.shard is None:
+                ledger = open_ledger(ledger_file)
+            else:
+                ledger = open_shard_ledger(
+                    ledger_file, get_shard_filename(ledger_file, args.shard)
+                )
+            input_hashes = {
+                filename: inputs_hash(
+                    ledger,
+                    [filename, get_confounds_filename(filename)],
+                    hash_content=not args.plan,
+                )
+                for filename in all_filenames
+            }
+            for atlas_settings in settings:
+                atlas_settings["ledger"] = get_ledger_entries(
+                    ledger, all_filenames, atlas_settings, hash_content=not args.plan
+                )
+
     # By default, the timeseries and FC of all filenames in input will be computed
     if not overwrite:
-        logging.debug("Looking for existing timeseries ...")
-        all_missing_ts, all_existing_ts = check_existing_output(
-            output,
-            all_filenames,
-            return_existing=True,
-            patterns=TIMESERIES_PATTERN,
-            **TIMESERIES_FILLS,
-        )
-
-        logging.info(f"{len(all_missing_ts)} files are missing timeseries.")
-        logging.debug("Looking for existing fc matrices ...")
-        missing_only_fc = check_existing_output(
-            output, all_existing_ts, patterns=FC_PATTERN, meas=fc_label, **FC_FILLS
-        )
-        logging.info(
-            f"{len(all_missing_ts + missing_only_fc)} files are missing FC matrices."
-        )
-        existing_timeseries = load_timeseries(missing_only_fc, output)
+        with span("existing_outputs", files=len(all_filenames)):
+            # Files missing the timeseries of any atlas are extracted for all of them
+            all_missing_ts = []
+            missing_only_fc = []
+            missing_only_dfc = []
+            for atlas_settings in settings:
+                logging.debug(
+                    f"Looking for existing timeseries in {atlas_settings['output']} ..."
+                )
+                if ledger is not None:
+                    entries = atlas_settings["ledger"]
+                    atlas_missing_ts = find_outdated(
+                        ledger,
+                        "timeseries",
+                        entries["timeseries"]["params_hash"],
+                        input_hashes,
+                        entries["timeseries"]["output_paths"],
+                        adopt=not args.plan,
+                    )
+                    atlas_existing_ts = [
+                        file for file in all_filenames if file not in atlas_missing_ts
+                    ]
+                else:
+                    atlas_missing_ts, atlas_existing_ts = check_existing_output(
+                        atlas_settings["output"],
+                        all_filenames,
+                        return_existing=True,
+                        patterns=TIMESERIES_PATTERN,
+                        **atlas_settings["timeseries_fills"],
+                    )
+                all_missing_ts += [
+                    file for file in atlas_missing_ts if file not in all_missing_ts
+                ]
+
+                logging.debug("Looking for existing fc matrices ...")
+                if ledger is not None:
+                    atlas_missing_fc = find_outdated(
+                        ledger,
+                        "connectivity",
+                        entries["connectivity"]["params_hash"],
+                        {file: input_hashes[file] for file in atlas_existing_ts},
+                        entries["connectivity"]["output_paths"],
+                        adopt=not args.plan,
+                    )
+                else:
+                    atlas_missing_fc = check_existing_output(
+                        atlas_settings["output"],
+                        atlas_existing_ts,
+                        patterns=FC_PATTERN,
+                        meas=fc_label,
+                        **atlas_settings["fc_fills"],
+                    )
+                missing_only_fc.append(atlas_missing_fc)
+
+                atlas_missing_dfc = []
+                if atlas_settings["dynamic"] is not None:
+                    logging.debug("Looking for existing dynamic fc ...")
+                    if ledger is not None:
+                        atlas_missing_dfc = find_outdated(
+                            ledger,
+                            "dynamic",
+                            entries["dynamic"]["params_hash"],
+                            {file: input_hashes[file] for file in atlas_existing_ts},
+                            entries["dynamic"]["output_paths"],
+                            adopt=not args.plan,
+                        )
+                    else:
+                        atlas_missing_dfc = check_existing_output(
+                            atlas_settings["output"],
+                            atlas_existing_ts,
+                            patterns=DYNAMIC_FC_PATTERN,
+                            **DYNAMIC_FC_FILLS,
+                        )
+                missing_only_dfc.append(atlas_missing_dfc)
+
+            missing_only_fc = [
+                [file for file in atlas_missing_fc if file not in all_missing_ts]
+                for atlas_missing_fc in missing_only_fc
+            ]
+            # The dynamic connectivity is computed along with the missing FC
+            missing_only_dfc = [
+                [
+                    file
+                    for file in atlas_missing_dfc
+                    if file not in all_missing_ts and file not in atlas_missing_fc
+                ]
+                for atlas_missing_dfc, atlas_missing_fc in zip(
+                    missing_only_dfc, missing_only_fc
+                )
+            ]
+            logging.info(f"{len(all_missing_ts)} files are missing timeseries.")
+            logging.info(
+                f"{len(all_missing_ts) + max(map(len, missing_only_fc))} files are "
+                "missing FC matrices."
+            )
+            logging.info(
+                f"{max(map(len, missing_only_dfc))} other files are missing dynamic "
+                "FC."
+            )
     else:
-        missing_only_fc = []
-        existing_timeseries = []
+        missing_only_fc = [[] for _ in settings]
+        missing_only_dfc = [[] for _ in settings]
         all_missing_ts = all_filenames.copy()
 
+    if args.plan:
+        unknown = None
+        if ledger is not None:
+            ledger.close()
+            unknown = [
+                [
+                    filename
+                    for filename, input_hash in input_hashes.items()
+                    if input_hash is None
+                    or atlas_settings["ledger"]["timeseries"]["params_hash"] is None
+                ]
+                for atlas_settings in settings
+            ]
+        print_plan(
+            settings,
+            all_filenames,
+            all_missing_ts,
+            missing_only_fc,
+            missing_only_dfc,
+            unknown=unknown,
+        )
+        return
+
     separated_missing_ts = [
         [file for file in file_group if file in all_missing_ts]
         for file_group in func_filenames
     ]
     sorted_missing_ts = list(chain.from_iterable(separated_missing_ts))
-    missing_something = sorted_missing_ts + missing_only_fc
-
-    time_series = []
-    all_confounds = []
-    all_sample_masks = []
-    for filenames_to_ts, t_r in zip(separated_missing_ts, t_r_list):
-        ts, conf, mask = extract_and_denoise_timeseries(
-            filenames_to_ts,
-            atlas_filename,
-            verbose=nilearn_verbose,
-            t_r=t_r,
-            low_pass=low_pass,
-            denoising_strategy=denoising_strategy,
-            motion=motion,
-            fd_threshold=fd_threshold,
-            std_dvars_threshold=std_dvars_threshold,
-            scrub=scrub,
-            interpolate=interpolate,
-            output=output,
-        )
-        time_series += ts
-        all_confounds += conf
-        all_sample_masks += mask
-
-    # Saving aggregated/denoised timeseries and visual reports
-    if len(time_series):
-        logging.info("Saving denoised timeseries ...")
-        os.makedirs(output, exist_ok=True)
-        save_output(
-            time_series,
-            sorted_missing_ts,
-            output,
-            patterns=TIMESERIES_PATTERN,
-            **TIMESERIES_FILLS,
+    missing_something = list(
+        dict.fromkeys(
+            sorted_missing_ts
+            + list(chain.from_iterable(missing_only_fc))
+            + list(chain.from_iterable(missing_only_dfc))
         )
-
-        for individual_time_serie, confounds, filename in zip(
-            time_series, all_confounds, sorted_missing_ts
-        ):
-            visual_report_timeserie(
-                individual_time_serie,
-                filename=filename,
-                output=output,
-                confounds=confounds,
-                labels=atlas_labels,
-                networks=atlas_network,
-            )
-
-    fc_matrices = compute_connectivity(
-        time_series + existing_timeseries,
-        estimator=covar_estimator,
-        connectivity_kind=fc_kind,
     )
 
-    # Compute duration of fMRI scans after censoring
-    fMRI_duration_after_censoring = {}
-    for filename, mask in zip(all_filenames, all_sample_masks):
-        fMRI_duration_after_censoring[op.basename(filename)] = mask.shape[0] * t_r
-        # mask.shape[0] indicates the number of volumes that are not censored
-    with open(
-        op.join(output, "fMRI_duration_after_censoring.csv"), "a", newline=""
-    ) as f:
-        writer = csv.writer(f)
-        if f.tell() == 0:
-            writer.writerow(["filename", "duration"])  # Write header if file is empty
-        for key, value in fMRI_duration_after_censoring.items():
-            writer.writerow([key, value])
+    # Rendering the visual reports while the outputs are computed takes processes
+    # out of the budget (with a single process, they are rendered afterwards)
+    reports = args.reports
+    n_report_procs = 0
+    if reports == "now" and args.n_procs > 1:
+        n_report_procs = max(int(args.n_procs * REPORT_PROCS_FRACTION), 1)
+    elif reports == "now":
+        reports = "defer"
+    n_procs = args.n_procs - n_report_procs
+
+    # Split the process budget between the groups and their extraction jobs
+    n_workers, n_jobs = split_resources(
+        separated_missing_ts,
+        n_procs=n_procs,
+        mem_gb=args.mem_gb,
+        chunk_mb=None if atlas_cache is None else args.chunk_mb,
+        precision=args.precision,
+    )
+    logging.info(
+        f"Processing {sum(map(bool, separated_missing_ts))} group(s) of files with "
+        f"{n_workers} worker(s) and {n_jobs} extraction job(s) per worker."
+    )
+    if n_report_procs:
+        logging.info(f"Rendering the visual reports with {n_report_procs} worker(s).")
+
+    # The covariance estimator and the labels of the atlases (only used by the
+    # visual reports) are only created if outputs are computed
+    if len(missing_something):
+        covar_estimator, _, _ = get_fc_strategy(fc_estimator)
+        atlas_labels = {}
+        if args.reports != "skip":
+            with span("atlas_labels", atlases=len(atlas_dimension)):
+                atlas_labels = {
+                    dimension: getattr(get_atlas_data(dimension=dimension), "labels")
+                    for dimension in atlas_dimension
+                }
+        for atlas_settings in settings:
+            atlas_settings["covar_estimator"] = covar_estimator
+            if atlas_settings["atlas_dimension"] in atlas_labels:
+                labels = atlas_labels[atlas_settings["atlas_dimension"]]
+                atlas_settings["atlas_labels"] = labels.loc[:, "difumo_names"]
+                atlas_settings["atlas_network"] = labels.loc[:, NETWORK_MAPPING]
+
+    # The visual reports are rendered from the saved outputs in their own pool of
+    # processes, as soon as each group is saved or once all outputs are computed
+    report_jobs, report_futures = [], []
+    report_executor = None
+    if reports == "now":
+        report_executor = ProcessPoolExecutor(max_workers=n_report_procs)
+
+    saved_paths = []
+    with span("processing", files=len(missing_something)):
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # Settings of the atlases processed by each job
+            futures = {
+                executor.submit(
+                    run_profiled,
+                    process_group,
+                    filenames_to_ts,
+                    t_r,
+                    settings,
+                    n_jobs,
+                    profile_dir=cprofile_dir,
+                ): (settings, filenames_to_ts, None)
+                for filenames_to_ts, t_r in zip(separated_missing_ts, t_r_list)
+                if len(filenames_to_ts)
+            }
+            for atlas_settings, atlas_missing_fc, atlas_missing_dfc in zip(
+                settings, missing_only_fc, missing_only_dfc
+            ):
+                jobs = [(atlas_missing_dfc, ("dynamic",))]
+                if not atlas_settings["defer_fc"]:
+                    jobs.append(
+                        (atlas_missing_fc, get_connectivity_kinds(atlas_settings))
+                    )
+                for filenames, kinds in jobs:
+                    if not len(filenames):
+                        continue
+                    future = executor.submit(
+                        run_profiled,
+                        process_existing_timeseries,
+                        filenames,
+                        atlas_settings,
+                        n_jobs,
+                        [t_r_by_file[filename] for filename in filenames],
+                        kinds,
+                        profile_dir=cprofile_dir,
+                    )
+                    futures[future] = (atlas_settings, filenames, kinds)
+
+            # Results are recorded as soon as each group completes
+            for future in as_completed(futures):
+                future_settings, filenames, future_kinds = futures[future]
+                future_results, spans = future.result()
+                PROFILER.attach(spans)
+                if isinstance(future_settings, dict):
+                    results = [(future_settings, future_results)]
+                else:
+                    results = zip(future_settings, future_results)
+
+                for atlas_settings, group_results in results:
+                    group_saved_paths, durations, convergence, deviations = (
+                        group_results
+                    )
+                    saved_paths += group_saved_paths
+                    record_group_results(
+                        atlas_settings["output"],
+                        durations,
+                        convergence,
+                        deviations,
+                        shard=args.shard,
+                    )
+
+                    if isinstance(future_settings, dict):
+                        kinds = future_kinds
+                    elif atlas_settings["defer_fc"]:
+                        kinds = ("timeseries",)
+                    else:
+                        kinds = ("timeseries",) + get_connectivity_kinds(
+                            atlas_settings
+                        )
+                    if ledger is not None:
+                        record_ledger(
+                            ledger, atlas_settings, filenames, input_hashes, kinds
+                        )
+
+                    report_job = (filenames, atlas_settings, kinds)
+                    if report_executor is not None:
+                        report_futures += submit_reports(report_executor, [report_job])
+                    else:
+                        report_jobs.append(report_job)
+
+    for atlas_settings, atlas_missing_fc in zip(settings, missing_only_fc):
+        atlas_missing_fc = sorted_missing_ts + atlas_missing_fc
+        if not atlas_settings["defer_fc"] or not len(atlas_missing_fc):
+            continue
 
-    # Saving FC matrices and visual reports
-    if len(fc_matrices):
-        logging.info("Saving connectivity matrices ...")
-        save_output(
-            fc_matrices,
-            missing_something,
-            output,
-            patterns=FC_PATTERN,
-            meas=fc_label,
-            **FC_FILLS,
+        logging.info(
+            "Computing connectivity with a regularization shared by all runs ..."
         )
-
-        # Generate session-specific figures
-        for individual_matrix, filename in zip(fc_matrices, missing_something):
-            visual_report_fc(
-                individual_matrix,
-                filename=filename,
-                output=output,
-                labels=atlas_labels,
-                meas=fc_label,
+        (group_saved_paths, _, convergence, _), spans = run_profiled(
+            process_existing_timeseries,
+            atlas_missing_fc,
+            atlas_settings,
+            n_jobs=n_procs,
+            t_r=[t_r_by_file[filename] for filename in atlas_missing_fc],
+            profile_dir=cprofile_dir,
+        )
+        PROFILER.attach(spans)
+        saved_paths += group_saved_paths
+        record_group_results(
+            atlas_settings["output"], {}, convergence, shard=args.shard
+        )
+        if ledger is not None:
+            record_ledger(
+                ledger,
+                atlas_settings,
+                atlas_missing_fc,
+                input_hashes,
+                get_connectivity_kinds(atlas_settings),
             )
 
+        report_job = (atlas_missing_fc, atlas_settings, ("connectivity",))
+        if report_executor is not None:
+            report_futures += submit_reports(report_executor, [report_job])
+        else:
+            report_jobs.append(report_job)
+
+    if ledger is not None:
+        ledger.close()
+
+    # Optional export of the binary outputs to BIDS-compliant TSV files
+    # (the dynamic connectivity is only stored in binary)
+    export_paths = [
+        path
+        for path in saved_paths
+        if f"_desc-{DYNAMIC_FC_FILLS['desc']}_" not in op.basename(path)
+    ]
+    if export_to_tsv and len(export_paths):
+        logging.info(f"Exporting {len(export_paths)} outputs to TSV ...")
+        with span("export_tsv", files=len(export_paths)):
+            export_tsv(export_paths)
+
+    if reports == "defer" and len(report_jobs):
+        report_executor = ProcessPoolExecutor(max_workers=args.n_procs)
+        report_futures += submit_reports(report_executor, report_jobs)
+
+    if report_executor is not None:
+        logging.info(f"Rendering the visual reports of {len(report_futures)} runs ...")
+        with span("reports", files=len(report_futures)):
+            for future in as_completed(report_futures):
+                if future.exception() is not None:
+                    logging.error(f"A visual report failed: {future.exception()}")
+                else:
+                    PROFILER.attach(future.result()[1])
+            report_executor.shutdown()
+
     logging.info(
         f"Computation is done for {len(missing_something)} files out of the "
         f"{len(all_filenames)} provided."
@@ -739,6 +2889,13 @@ def main():
 
     if not len(missing_something):
         logging.warning("Nothing was computed. Use --overwrite to overwrite data.")
+
+    PROFILER.save(
+        get_shard_filename(op.join(profile_output, PROFILE_FILE), args.shard),
+        n_procs=args.n_procs,
+        n_workers=n_workers,
+        n_jobs=n_jobs,
+    )
     logging.info("Functional connectivity finished successfully !")
 
 
@@ -23,27 +23,22 @@
 
 import argparse
 import logging
+import re
+from glob import glob
 
-import numpy as np
 import os.path as op
-import pandas as pd
 
-
-from itertools import chain
-from funconn import FC_FILLS, FC_PATTERN
+from atlas_cache import ATLAS_CACHE_DIR
+from funconn import DURATION_FILE, FC_FILLS
+from group_store import GROUP_STORE_DIR, GroupStore, file_signature
 
 from load_save import (
     get_atlas_data,
     find_atlas_dimension,
-    find_derivative,
-    check_existing_output,
-    get_bids_savename,
-    get_func_filenames_bids,
+    get_output_fills,
     load_iqms,
-)
-
-from reports import (
-    group_report,
+    load_output,
+    OUTPUT_EXTENSIONS,
 )
 
 
@@ -78,6 +73,27 @@ def get_arguments() -> argparse.Namespace:
         help="""type of connectivity to compute (can be 'correlation', 'covariance' or
         'sparse')""",
     )
+    parser.add_argument(
+        "--output-format",
+        default="tsv",
+        action="store",
+        choices=list(OUTPUT_EXTENSIONS),
+        type=str,
+        help="format in which the functional connectivity matrices were saved",
+    )
+    parser.add_argument(
+        "--atlas-cache",
+        default=ATLAS_CACHE_DIR,
+        action="store",
+        help="directory where the geometry of the atlas regions is cached",
+    )
+    parser.add_argument(
+        "--plan",
+        default=False,
+        action="store_true",
+        help="""print the sessions that would be appended to the group store and
+        exit""",
+    )
     parser.add_argument(
         "-v",
         "--verbosity",
@@ -98,6 +114,7 @@ def main():
     task_filter = args.task
     mriqc_path = args.mriqc_path
     fc_label = args.fc_estimator.replace(" ", "")
+    fc_fills = get_output_fills(FC_FILLS, args.output_format)
 
     verbosity_level = args.verbosity
 
@@ -117,56 +134,85 @@ def main():
 
     logging.captureWarnings(True)
 
-    # Find the atlas dimension from the output path
-    atlas_dimension = find_atlas_dimension(output)
-    atlas_data = get_atlas_data(dimension=atlas_dimension)
-    atlas_filename = getattr(atlas_data, "maps")
+    # Find the functional connectivity matrices saved in the output directory
+    fc_suffix = f"_meas-{fc_label}_{fc_fills['suffix']}{fc_fills['extension']}"
+    task_regex = re.compile(rf"_task-({'|'.join(map(re.escape, task_filter))})_")
+    existing_fc = sorted(
+        op.relpath(path, output)
+        for path in glob(
+            op.join(output, "sub-*", "**", "func", f"sub-*{fc_suffix}"),
+            recursive=True,
+        )
+        if task_regex.search(op.basename(path))
+    )
 
-    # Find all existing functional connectivity
-    input_path = find_derivative(output)
-    func_filenames, _ = get_func_filenames_bids(input_path, task_filter=task_filter)
-    all_filenames = list(chain.from_iterable(func_filenames))
+    if not existing_fc:
+        raise ValueError(
+            f"No functional connectivity of type '*{fc_suffix}' were found in "
+            f"{output}. Please revise the arguments."
+        )
 
-    existing_fc = check_existing_output(
-        output,
-        all_filenames,
-        return_existing=True,
-        return_output=True,
-        patterns=FC_PATTERN,
-        meas=fc_label,
-        **FC_FILLS,
+    # One group store per kind of connectivity and set of tasks. Only the sessions
+    # not yet in the group store are loaded and appended, unless sessions of the
+    # store were modified or removed (then the whole store is rebuilt).
+    store = GroupStore(
+        op.join(
+            output, GROUP_STORE_DIR, fc_label, f"task-{'+'.join(sorted(task_filter))}"
+        )
     )
-    if not existing_fc:
-        filename = op.join(
-            output,
-            get_bids_savename(
-                all_filenames[0], patterns=FC_PATTERN, meas=fc_label, **FC_FILLS
-            ),
+    signatures = {path: file_signature(op.join(output, path)) for path in existing_fc}
+    stale_fc = store.stale(signatures)
+    new_fc = existing_fc if stale_fc else store.missing(existing_fc)
+
+    if args.plan:
+        print(
+            f"{output}: {store.n_sessions} session(s) in the group store"
+            + (f" ({len(stale_fc)} modified or removed)" if stale_fc else "")
+            + f", {len(new_fc)} to append."
         )
-        raise ValueError(
-            f"No functional connectivity of type {filename} were found. Please revise the arguments."
+        for path in new_fc:
+            print(f"\t{path}")
+        return
+
+    if stale_fc:
+        logging.info(
+            f"{len(stale_fc)} session(s) of the group store were modified or "
+            "removed, the group store is rebuilt."
         )
+        store.clear()
 
-    # Load functional connectivity matrices
-    fc_matrices = []
-    for file_path in existing_fc:
-        fc_matrices.append(np.loadtxt(file_path, delimiter="\t"))
+    # NiLearn and the reports (Matplotlib, Seaborn) are only imported once the
+    # group report is generated
+    import pandas as pd
+    from reports import group_report
 
-    # Load fMRI duration after censoring
-    good_timepoints_df = pd.read_csv(
-        op.join(output, "fMRI_duration_after_censoring.csv")
-    )
+    # Find the atlas dimension from the output path
+    atlas_dimension = find_atlas_dimension(output)
+    atlas_data = get_atlas_data(dimension=atlas_dimension)
+    atlas_filename = getattr(atlas_data, "maps")
+
+    if new_fc:
+        new_paths = [op.join(output, path) for path in new_fc]
+        store.append(
+            new_fc,
+            [load_output(path) for path in new_paths],
+            load_iqms(output, new_paths, mriqc_path=mriqc_path),
+            signatures=[signatures[path] for path in new_fc],
+        )
 
-    # Load IQMs
-    iqms_df = load_iqms(output, existing_fc, mriqc_path=mriqc_path)
+    # Load fMRI duration after censoring
+    good_timepoints_df = pd.read_csv(op.join(output, DURATION_FILE))
 
     # Generate group figures
     group_report(
         good_timepoints_df,
-        fc_matrices,
-        iqms_df,
+        store.edges(),
+        store.iqms(),
         atlas_filename,
         output,
+        qc_fcs=store.qc_fc(),
+        fc_histograms=store.histograms(),
+        atlas_cache=args.atlas_cache,
     )
 
 
@@ -0,0 +1,311 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+#
+# Copyright 2023 The Axon Lab <theaxonlab@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# We support and encourage derived works from this project, please read
+# about our expectations at
+#
+#     https://www.nipreps.org/community/licensing/
+#
+"""
+Consolidate the files written by each shard of a sharded funconn run
+(``funconn.py --shard i/N``), once all the shards completed:
+
+- the durations after censoring, the convergence of the sparse estimation and
+  the deviations from double precision are appended to the CSV files of each
+  output directory;
+- the profiles of the shards are gathered in a single profile;
+- the ledgers of the shards are merged into the shared ledger (of each output
+  directory, by default).
+
+Run it with the output directories of the atlases (and their parent if several
+atlases were computed), e.g.:
+
+    python funconn_merge.py /data/derivatives/functional_connectivity/*
+"""
+
+import argparse
+import json
+import logging
+import os
+import os.path as op
+import re
+from collections import defaultdict
+from glob import escape, glob
+
+import pandas as pd
+
+from funconn import CONVERGENCE_FILE, DURATION_FILE, PRECISION_FILE
+from ledger import LEDGER_FILE, merge_ledger, open_ledger
+from load_save import get_tmp_filename
+from profiling import PROFILE_FILE
+
+SHARD_REGEX: str = r"_shard-(\d+)of(\d+)"
+
+
+def get_arguments() -> argparse.Namespace:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description="""Consolidate the outputs of the shards of a sharded
+        functional connectivity run.""",
+    )
+
+    parser.add_argument(
+        "output",
+        nargs="+",
+        help="""output directories of the sharded run (the shard files of their
+        direct subdirectories are also consolidated)""",
+    )
+    parser.add_argument(
+        "--ledger",
+        default=None,
+        action="store",
+        help=f"""path to the shared ledger the shards were run with (by default
+        '{LEDGER_FILE}' in each output directory)""",
+    )
+    parser.add_argument(
+        "--no-ledger",
+        default=False,
+        action="store_true",
+        help="do not merge the ledgers of the shards",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbosity",
+        action="count",
+        default=1,
+        help="""increase output verbosity (-v: standard logging infos; -vv: logging
+        infos and NiLearn verbose; -vvv: debug)""",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def find_shard_files(filename: str) -> list[str]:
+    """Find the files written by the shards in place of a shared file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the shared file
+
+    Returns
+    -------
+    list[str]
+        Paths to the files of the shards, sorted by shard
+    """
+    root, extension = op.splitext(filename)
+    shard_regex = re.escape(root) + SHARD_REGEX + re.escape(extension)
+
+    shard_files = {}
+    for path in glob(f"{escape(root)}_shard-*of*{extension}"):
+        match = re.fullmatch(shard_regex, path)
+        if match is not None:
+            shard_files[path] = (int(match.group(2)), int(match.group(1)))
+
+    return sorted(shard_files, key=shard_files.get)
+
+
+def merge_csv(filename: str) -> int:
+    """Append the rows of the CSV files of the shards to a shared CSV file.
+
+    The rows are indexed by the filename of the runs: a run computed again by a
+    shard replaces its previous row.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the shared CSV file
+
+    Returns
+    -------
+    int
+        Number of merged shard files
+    """
+    shard_files = find_shard_files(filename)
+    if not shard_files:
+        return 0
+
+    tables = [pd.read_csv(path) for path in [filename] if op.exists(path)]
+    tables += [pd.read_csv(path) for path in shard_files]
+    merged = pd.concat(tables, ignore_index=True).drop_duplicates(
+        subset="filename", keep="last"
+    )
+
+    tmp_filename = get_tmp_filename(filename)
+    merged.to_csv(tmp_filename, index=False)
+    os.replace(tmp_filename, filename)
+    for path in shard_files:
+        os.remove(path)
+
+    logging.info(f"Merged {len(shard_files)} shard(s) into {filename}")
+    return len(shard_files)
+
+
+def summarize_spans(spans: list[dict], summary: dict) -> dict:
+    """Accumulate the wall and CPU times and the peak memory of the spans by name.
+
+    Parameters
+    ----------
+    spans : list[dict]
+        Spans (and their children)
+    summary : dict
+        Summary updated in place
+
+    Returns
+    -------
+    dict
+        Number of spans, total wall and CPU times and maximum peak memory of each
+        stage
+    """
+    for span in spans:
+        stage = summary[span["name"]]
+        stage["count"] += 1
+        stage["wall_s"] += span.get("wall_s", 0)
+        stage["cpu_s"] += span.get("cpu_s", 0)
+        stage["peak_rss_mb"] = max(stage["peak_rss_mb"], span.get("peak_rss_mb", 0))
+        summarize_spans(span.get("children", []), summary)
+    return summary
+
+
+def merge_profiles(filename: str) -> int:
+    """Gather the profiles of the shards into a single profile.
+
+    The spans of each shard are nested under a span named after the shard, and
+    the stages are summarized over all the shards.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the profile of the run
+
+    Returns
+    -------
+    int
+        Number of merged shard profiles
+    """
+    shard_files = find_shard_files(filename)
+    if not shard_files:
+        return 0
+
+    spans = []
+    for path in shard_files:
+        with open(path) as f:
+            profile = json.load(f)
+        shard_spans = profile.pop("spans")
+        spans.append(
+            {
+                "name": re.search(SHARD_REGEX, path).group(0).lstrip("_"),
+                **profile,
+                "wall_s": sum(span.get("wall_s", 0) for span in shard_spans),
+                "cpu_s": sum(span.get("cpu_s", 0) for span in shard_spans),
+                "children": shard_spans,
+            }
+        )
+
+    stages = summarize_spans(
+        spans,
+        defaultdict(
+            lambda: {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0}
+        ),
+    )
+    tmp_filename = get_tmp_filename(filename)
+    with open(tmp_filename, "w") as f:
+        json.dump(
+            {"shards": len(shard_files), "stages": stages, "spans": spans},
+            f,
+            indent=2,
+        )
+    os.replace(tmp_filename, filename)
+    for path in shard_files:
+        os.remove(path)
+
+    logging.info(f"Merged {len(shard_files)} shard profile(s) into {filename}")
+    return len(shard_files)
+
+
+def merge_ledgers(filename: str) -> int:
+    """Merge the ledgers of the shards into the shared ledger.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the shared ledger
+
+    Returns
+    -------
+    int
+        Number of merged shard ledgers
+    """
+    shard_files = find_shard_files(filename)
+    if not shard_files:
+        return 0
+
+    connection = open_ledger(filename)
+    for path in shard_files:
+        merge_ledger(connection, path)
+    connection.close()
+    for path in shard_files:
+        os.remove(path)
+
+    logging.info(f"Merged {len(shard_files)} shard ledger(s) into {filename}")
+    return len(shard_files)
+
+
+def main():
+    args = get_arguments()
+
+    verbosity_level = args.verbosity
+
+    logging_level_map = {
+        0: logging.WARN,
+        1: logging.INFO,
+        2: logging.INFO,
+        3: logging.DEBUG,
+    }
+
+    logging.basicConfig(
+        format="%(levelname)s: %(message)s",
+        level=logging_level_map[min([verbosity_level, 3])],
+    )
+
+    directories = []
+    for output in args.output:
+        directories += [output] + sorted(
+            path
+            for path in glob(op.join(escape(output), "*", ""))
+            if not op.basename(op.dirname(path)).startswith("sub-")
+        )
+
+    n_merged = 0
+    for directory in dict.fromkeys(op.normpath(path) for path in directories):
+        n_merged += merge_csv(op.join(directory, DURATION_FILE))
+        n_merged += merge_csv(op.join(directory, CONVERGENCE_FILE))
+        n_merged += merge_csv(op.join(directory, PRECISION_FILE))
+        n_merged += merge_profiles(op.join(directory, PROFILE_FILE))
+        if not args.no_ledger and args.ledger is None:
+            n_merged += merge_ledgers(op.join(directory, LEDGER_FILE))
+
+    if not args.no_ledger and args.ledger is not None:
+        n_merged += merge_ledgers(args.ledger)
+
+    if not n_merged:
+        logging.warning("No shard files were found. Please revise the arguments.")
+
+
+if __name__ == "__main__":
+    main()
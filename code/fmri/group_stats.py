@@ -0,0 +1,276 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+#
+# Copyright 2023 The Axon Lab <theaxonlab@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# We support and encourage derived works from this project, please read
+# about our expectations at
+#
+#     https://www.nipreps.org/community/licensing/
+#
+"""Python module for vectorized group statistics on functional connectivity"""
+
+import logging
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+N_PERMUTATION: int = 10000
+QC_FC_BINS: np.ndarray = np.linspace(-1, 1, 2001)
+PERMUTATION_MEMORY_MB: float = 512
+
+
+def zscore(data: np.ndarray, axis: int = -1) -> np.ndarray:
+    """Standardize the data along one axis (population standard deviation).
+
+    Constant vectors are mapped to zeros so that their correlation with any other
+    vector is zero instead of NaN.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Data to standardize
+    axis : int, optional
+        Axis along which the data is standardized, by default -1
+
+    Returns
+    -------
+    np.ndarray
+        Standardized data (float64)
+    """
+    data = np.asarray(data, dtype=float)
+    centered = data - data.mean(axis=axis, keepdims=True)
+    std = np.sqrt((centered**2).mean(axis=axis, keepdims=True))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        standardized = np.where(std > 0, centered / std, 0.0)
+
+    return standardized
+
+
+def stack_upper_triangles(fc_matrices: list[np.ndarray]) -> np.ndarray:
+    """Stack the upper triangles of connectivity matrices into one edge matrix.
+
+    The edges of each matrix are copied into the preallocated output, so
+    memory-mapped matrices are read once and never stacked as full matrices. As
+    each matrix is its own file, the stack cannot be a view of them: the group
+    store (see group_store.GroupStore.edges) keeps the edges stacked on disk and
+    memory-maps them without a copy.
+
+    Parameters
+    ----------
+    fc_matrices : list[np.ndarray]
+        List of (symmetric) functional connectivity matrices
+
+    Returns
+    -------
+    np.ndarray
+        Stacked edges of shape (n_edges, n_subjects)
+    """
+    upper_triangle_indices = np.triu_indices(fc_matrices[0].shape[0], k=1)
+
+    fc_stack = np.empty(
+        (upper_triangle_indices[0].size, len(fc_matrices)),
+        dtype=np.result_type(*fc_matrices),
+    )
+    for i, fc_matrix in enumerate(fc_matrices):
+        fc_stack[:, i] = fc_matrix[upper_triangle_indices]
+
+    return fc_stack
+
+
+def compute_qc_fc(
+    fc_stack: np.ndarray, iqms_df: Union[pd.DataFrame, np.ndarray]
+) -> np.ndarray:
+    """Compute the QC-FC correlations of all the edges with all the IQMs.
+
+    Parameters
+    ----------
+    fc_stack : np.ndarray
+        Stacked connectivity edges of shape (n_edges, n_subjects)
+    iqms_df : Union[pd.DataFrame, np.ndarray]
+        Image quality metrics of shape (n_subjects, n_iqms)
+
+    Returns
+    -------
+    np.ndarray
+        Pearson correlations of shape (n_edges, n_iqms)
+    """
+    iqms = np.asarray(iqms_df, dtype=float)
+    if iqms.ndim == 1:
+        iqms = iqms[:, np.newaxis]
+
+    if iqms.shape[0] != fc_stack.shape[1]:
+        raise ValueError(
+            f"The number of subjects in the connectivity stack ({fc_stack.shape[1]}) "
+            f"and IQMs ({iqms.shape[0]}) do not match."
+        )
+
+    return zscore(fc_stack, axis=1) @ zscore(iqms, axis=0) / fc_stack.shape[1]
+
+
+def correlation_p_value(correlation: np.ndarray, n_samples: int) -> np.ndarray:
+    """Two-sided p-value of Pearson correlations (as in scipy.stats.pearsonr).
+
+    Parameters
+    ----------
+    correlation : np.ndarray
+        Pearson correlation coefficients
+    n_samples : int
+        Number of samples used to compute the correlations
+
+    Returns
+    -------
+    np.ndarray
+        Two-sided p-values.
+    """
+    from scipy.stats import beta
+
+    null_distribution = beta(n_samples / 2 - 1, n_samples / 2 - 1, loc=-1, scale=2)
+    return 2 * null_distribution.cdf(-np.abs(correlation))
+
+
+def permutation_null_qc_fc(
+    fc_stack: np.ndarray,
+    iqms: Union[pd.DataFrame, np.ndarray],
+    n_permutation: int = N_PERMUTATION,
+    bins: np.ndarray = QC_FC_BINS,
+    seed: int = 42,
+    memory_mb: float = PERMUTATION_MEMORY_MB,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Compute the binned QC-FC distribution under the null hypothesis.
+
+    The permutations of the subjects are drawn once. For each block of
+    permutations, the null correlations of all the edges with all the IQMs are
+    obtained with a single matrix product between the standardized edges and the
+    permuted standardized IQMs. Only the histogram of the null correlations is
+    kept, so memory is bounded by ``memory_mb`` regardless of the number of edges
+    and permutations.
+
+    Parameters
+    ----------
+    fc_stack : np.ndarray
+        Stacked connectivity edges of shape (n_edges, n_subjects)
+    iqms : Union[pd.DataFrame, np.ndarray]
+        Image quality metrics of shape (n_subjects, n_iqms)
+    n_permutation : int, optional
+        Number of permutations, by default N_PERMUTATION
+    bins : np.ndarray, optional
+        Edges of the histogram bins, by default QC_FC_BINS
+    seed : int, optional
+        Seed of the random generator, by default 42
+    memory_mb : float, optional
+        Memory budget (in MB) for one block of null correlations, by default
+        PERMUTATION_MEMORY_MB
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Histogram counts of shape (n_iqms, len(bins) - 1) and the bin edges.
+    """
+    iqms = np.asarray(iqms, dtype=float)
+    if iqms.ndim == 1:
+        iqms = iqms[:, np.newaxis]
+
+    n_edges, n_subjects = fc_stack.shape
+    n_iqms = iqms.shape[1]
+
+    if iqms.shape[0] != n_subjects:
+        raise ValueError(
+            f"The number of subjects in the connectivity stack ({n_subjects}) and "
+            f"IQMs ({iqms.shape[0]}) do not match."
+        )
+
+    z_fc = zscore(fc_stack, axis=1)
+    z_iqms = zscore(iqms, axis=0)
+
+    rng = np.random.default_rng(seed=seed)
+    permutations = rng.permuted(
+        np.tile(np.arange(n_subjects), (n_permutation, 1)), axis=1
+    )
+
+    block_size = int(memory_mb * 2**20 // (n_edges * n_iqms * z_fc.itemsize))
+    block_size = min(max(block_size, 1), n_permutation)
+    logging.debug(
+        f"Computing {n_permutation} permutations for {n_edges} edges by blocks of "
+        f"{block_size} permutations."
+    )
+
+    counts = np.zeros((n_iqms, len(bins) - 1), dtype=np.int64)
+    for start in range(0, n_permutation, block_size):
+        block = permutations[start : start + block_size]
+
+        # (n_subjects, block_size * n_iqms) matrix of permuted IQMs
+        permuted_iqms = z_iqms[block].transpose(1, 0, 2).reshape(n_subjects, -1)
+        null_correlations = z_fc @ permuted_iqms / n_subjects
+        np.clip(null_correlations, bins[0], bins[-1], out=null_correlations)
+
+        null_correlations = null_correlations.reshape(n_edges, len(block), n_iqms)
+        for i in range(n_iqms):
+            counts[i] += np.histogram(null_correlations[..., i], bins=bins)[0]
+
+    return counts, bins
+
+
+def histogram_summary(counts: np.ndarray, bins: np.ndarray) -> dict:
+    """Summarize a binned distribution.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Histogram counts
+    bins : np.ndarray
+        Edges of the histogram bins
+
+    Returns
+    -------
+    dict
+        Dictionary with the number of samples, the mean and the standard deviation
+        of the binned distribution.
+    """
+    centers = (bins[:-1] + bins[1:]) / 2
+    n_samples = counts.sum()
+    mean = (counts * centers).sum() / n_samples
+    std = np.sqrt((counts * (centers - mean) ** 2).sum() / n_samples)
+
+    return {"n": int(n_samples), "mean": float(mean), "std": float(std)}
+
+
+def binned_ks_statistic(
+    sample: np.ndarray, counts: np.ndarray, bins: np.ndarray
+) -> float:
+    """Two-sample Kolmogorov-Smirnov statistic between a sample and a binned
+    distribution, evaluated at the bin edges.
+
+    Parameters
+    ----------
+    sample : np.ndarray
+        Observed sample
+    counts : np.ndarray
+        Histogram counts of the reference distribution
+    bins : np.ndarray
+        Edges of the histogram bins
+
+    Returns
+    -------
+    float
+        Maximum distance between the two empirical cumulative distributions.
+    """
+    sample = np.sort(np.asarray(sample, dtype=float).ravel())
+    sample_cdf = np.searchsorted(sample, bins[1:], side="right") / sample.size
+    reference_cdf = np.cumsum(counts) / counts.sum()
+
+    return float(np.abs(sample_cdf - reference_cdf).max())
@@ -0,0 +1,442 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+#
+# Copyright 2023 The Axon Lab <theaxonlab@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# We support and encourage derived works from this project, please read
+# about our expectations at
+#
+#     https://www.nipreps.org/community/licensing/
+#
+"""Python module for the append-only store of group functional connectivity
+
+The store keeps the upper triangles of the connectivity matrices stacked on disk,
+the keys, signatures and IQMs of their sessions, the histogram of the edges of each
+session, and running statistics updated with each appended batch: the mean and
+variance of each edge and the sufficient statistics of the QC-FC correlations.
+"""
+
+import json
+import logging
+import os
+import os.path as op
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+GROUP_STORE_DIR: str = "group_store"
+EDGES_FILE: str = "edges.bin"
+HISTOGRAMS_FILE: str = "histograms.bin"
+SESSIONS_FILE: str = "sessions.tsv"
+STATS_FILE: str = "stats.npz"
+KEY_COLUMN: str = "path"
+SIGNATURE_COLUMN: str = "signature"
+FC_DIST_N_BINS: int = 200
+
+
+class GroupStore:
+    """Append-only store of the connectivity edges of a group of sessions.
+
+    Appending sessions costs O(new sessions): their edges are appended to a
+    binary file and the running statistics (stored in a small file independent
+    of the number of sessions) are updated with the new batch only. Sessions
+    cannot be removed or replaced: the store is cleared and rebuilt when any of
+    them is stale (see :meth:`stale`).
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sessions = pd.DataFrame(columns=[KEY_COLUMN, SIGNATURE_COLUMN])
+        self.iqms_names = []
+        self.stats = None
+
+        stats_file = op.join(path, STATS_FILE)
+        if not op.exists(stats_file):
+            return
+
+        with np.load(stats_file) as stats:
+            self.stats = {key: stats[key] for key in stats.files}
+        self.iqms_names = json.loads(str(self.stats.pop("iqms_names")))
+
+        # Sessions appended after the last update of the statistics (e.g., an
+        # interrupted append) are discarded
+        n_sessions = int(self.stats["n"])
+        self.sessions = pd.read_csv(
+            op.join(path, SESSIONS_FILE),
+            sep="\t",
+            dtype={KEY_COLUMN: str, SIGNATURE_COLUMN: str},
+        ).iloc[:n_sessions].fillna({SIGNATURE_COLUMN: ""})
+        edges_bytes = n_sessions * self.n_edges * np.dtype(np.float64).itemsize
+        histograms_bytes = n_sessions * self.n_bins * np.dtype(np.int64).itemsize
+        if (
+            op.getsize(op.join(path, EDGES_FILE)) != edges_bytes
+            or _getsize(op.join(path, HISTOGRAMS_FILE)) != histograms_bytes
+        ):
+            logging.warning("Discarding the edges of an interrupted append.")
+            os.truncate(op.join(path, EDGES_FILE), edges_bytes)
+            with open(op.join(path, HISTOGRAMS_FILE), "ab") as f:
+                f.truncate(histograms_bytes)
+            self.sessions.to_csv(op.join(path, SESSIONS_FILE), sep="\t", index=False)
+
+    @property
+    def n_sessions(self) -> int:
+        """Number of sessions in the store."""
+        return len(self.sessions)
+
+    @property
+    def n_edges(self) -> int:
+        """Number of edges of each connectivity matrix."""
+        return 0 if self.stats is None else self.stats["mean"].size
+
+    @property
+    def n_bins(self) -> int:
+        """Number of bins of the histograms of the edges."""
+        return 0 if self.stats is None else self.stats["fc_bins"].size - 1
+
+    def missing(self, keys: list[str]) -> list[str]:
+        """Return the keys (e.g., paths) of the sessions not yet in the store.
+
+        Parameters
+        ----------
+        keys : list[str]
+            Keys of the sessions
+
+        Returns
+        -------
+        list[str]
+            Keys not in the store (in the given order)
+        """
+        stored = set(self.sessions[KEY_COLUMN])
+        return [key for key in keys if key not in stored]
+
+    def stale(self, signatures: dict[str, str]) -> list[str]:
+        """Return the keys of the stored sessions that were removed or modified.
+
+        Parameters
+        ----------
+        signatures : dict[str, str]
+            Current signature of each session (see :func:`file_signature`)
+
+        Returns
+        -------
+        list[str]
+            Keys of the stored sessions missing from ``signatures`` or stored with
+            another signature
+        """
+        if SIGNATURE_COLUMN not in self.sessions:
+            # Stores written before the signatures cannot be checked
+            return list(self.sessions[KEY_COLUMN])
+        return [
+            key
+            for key, signature in zip(
+                self.sessions[KEY_COLUMN], self.sessions[SIGNATURE_COLUMN]
+            )
+            if signatures.get(key) != signature
+        ]
+
+    def clear(self):
+        """Remove all the sessions and statistics of the store."""
+        for filename in [STATS_FILE, EDGES_FILE, HISTOGRAMS_FILE, SESSIONS_FILE]:
+            if op.exists(op.join(self.path, filename)):
+                os.remove(op.join(self.path, filename))
+        self.sessions = pd.DataFrame(columns=[KEY_COLUMN, SIGNATURE_COLUMN])
+        self.iqms_names = []
+        self.stats = None
+
+    def append(
+        self,
+        keys: list[str],
+        fc_matrices: list[np.ndarray],
+        iqms_df: Optional[pd.DataFrame] = None,
+        signatures: Optional[list[str]] = None,
+    ):
+        """Append sessions to the store and update the running statistics.
+
+        Parameters
+        ----------
+        keys : list[str]
+            Keys of the new sessions (e.g., paths to their connectivity matrices)
+        fc_matrices : list[np.ndarray]
+            Connectivity matrices of the new sessions
+        iqms_df : Optional[pd.DataFrame], optional
+            IQMs of the new sessions (one row per session), by default None
+        signatures : Optional[list[str]], optional
+            Signatures of the new sessions (see :func:`file_signature`), by default
+            None (empty signatures)
+        """
+        if not len(keys):
+            return
+        if (
+            len(keys) != len(fc_matrices)
+            or (iqms_df is not None and len(iqms_df) != len(keys))
+            or (signatures is not None and len(signatures) != len(keys))
+        ):
+            raise ValueError(
+                f"The number of sessions ({len(keys)}), connectivity matrices "
+                f"({len(fc_matrices)}) and IQMs "
+                f"({'none' if iqms_df is None else len(iqms_df)}) do not match."
+            )
+
+        upper_triangle_indices = np.triu_indices(fc_matrices[0].shape[0], k=1)
+        edges = np.empty((len(fc_matrices), upper_triangle_indices[0].size))
+        for i, fc_matrix in enumerate(fc_matrices):
+            edges[i] = fc_matrix[upper_triangle_indices]
+
+        iqms = np.empty((len(keys), 0))
+        iqms_names = []
+        if iqms_df is not None:
+            iqms = iqms_df.to_numpy(dtype=float)
+            iqms_names = list(iqms_df.columns)
+
+        if self.stats is None:
+            self.iqms_names = iqms_names
+            self.stats = _init_stats(
+                edges.shape[1], len(iqms_names), histogram_bins(edges)
+            )
+        elif edges.shape[1] != self.n_edges or iqms_names != self.iqms_names:
+            raise ValueError(
+                f"The sessions ({edges.shape[1]} edges, IQMs {iqms_names}) do not "
+                f"match the store ({self.n_edges} edges, IQMs {self.iqms_names})."
+            )
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(op.join(self.path, EDGES_FILE), "ab") as f:
+            f.write(edges.tobytes())
+        with open(op.join(self.path, HISTOGRAMS_FILE), "ab") as f:
+            f.write(edge_histograms(edges, self.stats["fc_bins"]).tobytes())
+
+        new_sessions = pd.DataFrame(iqms, columns=iqms_names)
+        new_sessions.insert(0, KEY_COLUMN, keys)
+        new_sessions.insert(1, SIGNATURE_COLUMN, signatures or [""] * len(keys))
+        sessions_file = op.join(self.path, SESSIONS_FILE)
+        new_sessions.to_csv(
+            sessions_file,
+            sep="\t",
+            index=False,
+            mode="a",
+            header=not self.n_sessions,
+        )
+        self.sessions = pd.concat([self.sessions, new_sessions], ignore_index=True)
+
+        # The statistics are written last and commit the append
+        _update_stats(self.stats, edges, iqms)
+        tmp_stats_file = op.join(self.path, f"stats.{os.getpid()}.npz")
+        np.savez(
+            tmp_stats_file, iqms_names=json.dumps(self.iqms_names), **self.stats
+        )
+        os.replace(tmp_stats_file, op.join(self.path, STATS_FILE))
+        logging.info(f"Appended {len(keys)} sessions to the group store.")
+
+    def edges(self) -> np.ndarray:
+        """Memory-map the stacked edges of all the sessions.
+
+        Returns
+        -------
+        np.ndarray
+            Edges of shape (n_edges, n_sessions)
+        """
+        return np.memmap(
+            op.join(self.path, EDGES_FILE),
+            dtype=np.float64,
+            mode="r",
+            shape=(self.n_sessions, self.n_edges),
+        ).T
+
+    def histograms(self) -> tuple[np.ndarray, np.ndarray]:
+        """Memory-map the histograms of the edges of all the sessions.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            Histogram counts of shape (n_sessions, n_bins) and the bin edges.
+        """
+        if not self.n_sessions:
+            return np.zeros((0, self.n_bins), dtype=np.int64), self.stats["fc_bins"]
+
+        counts = np.memmap(
+            op.join(self.path, HISTOGRAMS_FILE),
+            dtype=np.int64,
+            mode="r",
+            shape=(self.n_sessions, self.n_bins),
+        )
+        return counts, self.stats["fc_bins"]
+
+    def iqms(self) -> pd.DataFrame:
+        """IQMs of all the sessions.
+
+        Returns
+        -------
+        pd.DataFrame
+            IQMs of shape (n_sessions, n_iqms)
+        """
+        return self.sessions[self.iqms_names].reset_index(drop=True)
+
+    def mean(self) -> np.ndarray:
+        """Running mean of each edge."""
+        return self.stats["mean"]
+
+    def variance(self) -> np.ndarray:
+        """Running (population) variance of each edge."""
+        return self.stats["m2"] / self.stats["n"]
+
+    def qc_fc(self) -> np.ndarray:
+        """QC-FC correlations of all the edges with all the IQMs, from the running
+        sufficient statistics.
+
+        Returns
+        -------
+        np.ndarray
+            Pearson correlations of shape (n_edges, n_iqms)
+        """
+        iqms_m2 = self.stats["iqms_m2"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            qc_fc = self.stats["comoment"] / np.sqrt(
+                self.stats["m2"][:, np.newaxis] * iqms_m2[np.newaxis, :]
+            )
+        # Constant vectors have no correlation (as in group_stats.zscore)
+        return np.nan_to_num(qc_fc, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def file_signature(path: str) -> str:
+    """Signature of a file changing whenever the file is written again.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+
+    Returns
+    -------
+    str
+        Size and modification time (in nanoseconds) of the file
+    """
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def histogram_bins(values: np.ndarray, n_bins: int = FC_DIST_N_BINS) -> np.ndarray:
+    """Fixed, symmetric bins for the distributions of connectivity edges.
+
+    Correlations are binned over [-1, 1]. Unbounded measures (e.g., covariance or
+    precision) are binned over twice the largest absolute value of ``values``, so
+    that the sessions appended later mostly fall within the same bins.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Edges of the first sessions
+    n_bins : int, optional
+        Number of bins, by default FC_DIST_N_BINS
+
+    Returns
+    -------
+    np.ndarray
+        Edges of the histogram bins
+    """
+    values = np.asarray(values)
+    bound = np.abs(values[np.isfinite(values)]).max(initial=0)
+    bound = 1.0 if bound <= 1 else 2 * float(bound)
+    return np.linspace(-bound, bound, n_bins + 1)
+
+
+def edge_histograms(edges: np.ndarray, bins: np.ndarray) -> np.ndarray:
+    """Histogram of the edges of each session over fixed, uniform bins.
+
+    All the sessions are binned with a single ``np.bincount``. Values outside the
+    bins are counted in the outermost bins and NaNs are ignored.
+
+    Parameters
+    ----------
+    edges : np.ndarray
+        Edges of shape (n_sessions, n_edges)
+    bins : np.ndarray
+        Edges of the (uniform) histogram bins
+
+    Returns
+    -------
+    np.ndarray
+        Histogram counts (int64) of shape (n_sessions, len(bins) - 1)
+    """
+    edges = np.atleast_2d(edges)
+    n_sessions, n_bins = edges.shape[0], len(bins) - 1
+
+    indices = np.floor((edges - bins[0]) * (n_bins / (bins[-1] - bins[0])))
+    valid = ~np.isnan(indices)
+    indices = np.clip(indices[valid], 0, n_bins - 1).astype(np.int64)
+    indices += np.nonzero(valid)[0] * n_bins
+
+    return np.bincount(indices, minlength=n_sessions * n_bins).reshape(
+        n_sessions, n_bins
+    )
+
+
+def _getsize(path: str) -> int:
+    """Size of a file, zero if it does not exist."""
+    return op.getsize(path) if op.exists(path) else 0
+
+
+def _init_stats(n_edges: int, n_iqms: int, fc_bins: np.ndarray) -> dict:
+    """Initialize empty running statistics."""
+    return {
+        "fc_bins": fc_bins,
+        "n": np.array(0),
+        "mean": np.zeros(n_edges),
+        "m2": np.zeros(n_edges),
+        "iqms_mean": np.zeros(n_iqms),
+        "iqms_m2": np.zeros(n_iqms),
+        "comoment": np.zeros((n_edges, n_iqms)),
+    }
+
+
+def _update_stats(stats: dict, edges: np.ndarray, iqms: np.ndarray):
+    """Merge the statistics of a batch of sessions into the running statistics
+    (pairwise update of the means, variances and co-moments).
+
+    Parameters
+    ----------
+    stats : dict
+        Running statistics, updated in place
+    edges : np.ndarray
+        Edges of the batch, of shape (n_batch, n_edges)
+    iqms : np.ndarray
+        IQMs of the batch, of shape (n_batch, n_iqms)
+    """
+    n_a, n_b = int(stats["n"]), edges.shape[0]
+    n = n_a + n_b
+
+    batch_mean = edges.mean(axis=0)
+    batch_iqms_mean = iqms.mean(axis=0)
+    centered = edges - batch_mean
+    centered_iqms = iqms - batch_iqms_mean
+
+    delta = batch_mean - stats["mean"]
+    delta_iqms = batch_iqms_mean - stats["iqms_mean"]
+
+    stats["comoment"] += centered.T @ centered_iqms + np.outer(
+        delta, delta_iqms
+    ) * (n_a * n_b / n)
+    stats["m2"] += (centered**2).sum(axis=0) + delta**2 * (n_a * n_b / n)
+    stats["iqms_m2"] += (centered_iqms**2).sum(axis=0) + delta_iqms**2 * (
+        n_a * n_b / n
+    )
+    stats["mean"] += delta * n_b / n
+    stats["iqms_mean"] += delta_iqms * n_b / n
+    stats["n"] = np.array(n)
@@ -0,0 +1,342 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+#
+# Copyright 2023 The Axon Lab <theaxonlab@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# We support and encourage derived works from this project, please read
+# about our expectations at
+#
+#     https://www.nipreps.org/community/licensing/
+#
+"""Python module for the ledger of the derivatives produced by funconn
+
+Every timeseries and connectivity output is recorded with a hash of the content of
+its inputs and a hash of the parameters that produced it, so that missing and
+stale outputs are found with a single indexed query.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import sqlite3
+from typing import Optional
+
+LEDGER_FILE: str = "funconn_ledger.sqlite"
+HASH_BLOCK_SIZE: int = 2**20
+
+LEDGER_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    output_path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    input_path TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    params_hash TEXT NOT NULL,
+    created REAL NOT NULL DEFAULT (julianday('now'))
+);
+CREATE INDEX IF NOT EXISTS outputs_params ON outputs (kind, params_hash);
+"""
+
+
+def open_ledger(filename: str) -> sqlite3.Connection:
+    """Open (and create if needed) the ledger of the derivatives.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the SQLite database (usually LEDGER_FILE in the output directory)
+
+    Returns
+    -------
+    sqlite3.Connection
+        Connection to the ledger
+    """
+    if filename != ":memory:":
+        os.makedirs(op.dirname(op.abspath(filename)), exist_ok=True)
+    connection = sqlite3.connect(filename, timeout=60)
+    connection.executescript(LEDGER_SCHEMA)
+    return connection
+
+
+def hash_parameters(parameters: dict) -> str:
+    """Hash the parameters producing an output.
+
+    Parameters
+    ----------
+    parameters : dict
+        JSON-serializable parameters (other values are converted to strings)
+
+    Returns
+    -------
+    str
+        Hexadecimal digest of the parameters
+    """
+    serialized = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode()).hexdigest()
+
+
+def file_hash(
+    connection: sqlite3.Connection, path: str, hash_content: bool = True
+) -> Optional[str]:
+    """Hash the content of a file.
+
+    The hash is stored in the ledger and only recomputed when the size or the
+    modification time of the file changed.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        Connection to the ledger
+    path : str
+        Path to the file
+    hash_content : bool, optional
+        Condition to hash the content of the file if its hash is not stored (or
+        outdated), by default True
+
+    Returns
+    -------
+    Optional[str]
+        Hexadecimal digest of the content of the file (None if it would have to be
+        hashed and ``hash_content`` is False)
+    """
+    path = op.abspath(path)
+    stat = os.stat(path)
+    row = connection.execute(
+        "SELECT hash FROM files WHERE path = ? AND size = ? AND mtime = ?",
+        (path, stat.st_size, stat.st_mtime_ns),
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    if not hash_content:
+        return None
+
+    logging.debug(f"Hashing the content of {path}")
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()),
+        )
+    return digest.hexdigest()
+
+
+def inputs_hash(
+    connection: sqlite3.Connection,
+    paths: list[Optional[str]],
+    hash_content: bool = True,
+) -> Optional[str]:
+    """Hash the content of all the input files of an output.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        Connection to the ledger
+    paths : list[Optional[str]]
+        Paths to the input files (missing inputs are given as None)
+    hash_content : bool, optional
+        Condition to hash the content of the files whose hash is not stored (or
+        outdated), by default True
+
+    Returns
+    -------
+    Optional[str]
+        Hexadecimal digest of the contents of the files (None if any of them would
+        have to be hashed and ``hash_content`` is False)
+    """
+    hashes = [
+        (
+            ""
+            if path is None or not op.exists(path)
+            else file_hash(connection, path, hash_content=hash_content)
+        )
+        for path in paths
+    ]
+    if None in hashes:
+        return None
+    return hashlib.sha1(":".join(hashes).encode()).hexdigest()
+
+
+def find_outdated(
+    connection: sqlite3.Connection,
+    kind: str,
+    params_hash: Optional[str],
+    input_hashes: dict[str, Optional[str]],
+    output_paths: dict[str, str],
+    adopt: bool = True,
+) -> list[str]:
+    """Find the inputs whose output is missing or stale.
+
+    An output is stale when it was recorded with another content of its inputs or
+    other parameters. Existing outputs that were never recorded (e.g., produced
+    before the ledger) are adopted: they are recorded with the current inputs and
+    parameters instead of being recomputed.
+
+    Inputs that were not hashed (None, see :func:`inputs_hash`) are only outdated
+    if their output is missing, and so are all the inputs when the parameters were
+    not hashed.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        Connection to the ledger
+    kind : str
+        Kind of output (e.g., "timeseries" or "connectivity")
+    params_hash : Optional[str]
+        Hash of the parameters of the outputs
+    input_hashes : dict[str, Optional[str]]
+        Hash of the inputs of each input file
+    output_paths : dict[str, str]
+        Path to the output of each input file
+    adopt : bool, optional
+        Condition to record the adopted outputs in the ledger, by default True
+
+    Returns
+    -------
+    list[str]
+        Input files (in the order of ``input_hashes``) to be processed again
+    """
+    recorded = {
+        output_path: (input_hash, output_params_hash)
+        for output_path, input_hash, output_params_hash in connection.execute(
+            "SELECT output_path, input_hash, params_hash FROM outputs WHERE kind = ?",
+            (kind,),
+        )
+    }
+
+    outdated, adopted, n_stale = [], {}, 0
+    for filename, input_hash in input_hashes.items():
+        output_path = op.abspath(output_paths[filename])
+        if not op.exists(output_path):
+            outdated.append(filename)
+        elif input_hash is None or params_hash is None:
+            continue
+        elif output_path not in recorded:
+            adopted[filename] = input_hash
+        elif recorded[output_path] != (input_hash, params_hash):
+            outdated.append(filename)
+            n_stale += 1
+
+    if n_stale:
+        logging.info(
+            f"{n_stale} {kind} output(s) were produced from other inputs or "
+            "parameters and will be recomputed."
+        )
+    if adopted:
+        logging.info(
+            f"{len(adopted)} existing {kind} output(s) were not recorded in the "
+            "ledger and are assumed to be up to date."
+        )
+        if adopt:
+            record_outputs(connection, kind, params_hash, adopted, output_paths)
+    return outdated
+
+
+def record_outputs(
+    connection: sqlite3.Connection,
+    kind: str,
+    params_hash: str,
+    input_hashes: dict[str, str],
+    output_paths: dict[str, str],
+):
+    """Record the outputs produced from the input files.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        Connection to the ledger
+    kind : str
+        Kind of output (e.g., "timeseries" or "connectivity")
+    params_hash : Optional[str]
+        Hash of the parameters of the outputs
+    input_hashes : dict[str, str]
+        Hash of the inputs of each processed input file
+    output_paths : dict[str, str]
+        Path to the output of each processed input file
+    """
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO outputs "
+            "(output_path, kind, input_path, input_hash, params_hash) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    op.abspath(output_paths[filename]),
+                    kind,
+                    op.abspath(filename),
+                    input_hash,
+                    params_hash,
+                )
+                for filename, input_hash in input_hashes.items()
+            ],
+        )
+
+
+def open_shard_ledger(filename: str, shard_filename: str) -> sqlite3.Connection:
+    """Open the ledger of one shard of a run.
+
+    The shards of a run (possibly on different hosts) never write to the shared
+    ledger. A shard starts from a snapshot of it, so that the outputs it already
+    records are not computed again, and its records are merged back afterwards
+    (see :func:`merge_ledger`).
+
+    Parameters
+    ----------
+    filename : str
+        Path to the shared ledger
+    shard_filename : str
+        Path to the ledger of the shard
+
+    Returns
+    -------
+    sqlite3.Connection
+        Connection to the ledger of the shard
+    """
+    connection = open_ledger(shard_filename)
+    if op.exists(filename):
+        # The snapshot replaces any previous content of the ledger of the shard
+        shared = sqlite3.connect(filename, timeout=60)
+        shared.backup(connection)
+        shared.close()
+    return connection
+
+
+def merge_ledger(connection: sqlite3.Connection, shard_filename: str):
+    """Merge the records of the ledger of a shard into a ledger.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        Connection to the ledger
+    shard_filename : str
+        Path to the ledger of the shard
+    """
+    connection.execute("ATTACH DATABASE ? AS shard", (shard_filename,))
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO files SELECT * FROM shard.files")
+        connection.execute(
+            "INSERT OR REPLACE INTO outputs SELECT * FROM shard.outputs"
+        )
+    connection.execute("DETACH DATABASE shard")
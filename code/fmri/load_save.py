@@ -20,25 +20,32 @@
 #
 #     https://www.nipreps.org/community/licensing/
 #
-"""Python module for loading and saving fMRI related data"""
+"""Python module for loading and saving fMRI related data
 
+PyBIDS, NiLearn, NiBabel and pandas are only imported by the functions that need
+them, so that the discovery of the files from the on-disk index stays fast.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import importlib
+import json
 import os
 import re
 import os.path as op
-import pandas as pd
+import socket
 from collections import defaultdict
+from contextlib import contextmanager
 import logging
-from typing import Optional, Union
+from typing import TYPE_CHECKING, Optional, Union
 
-from bids import BIDSLayout
 import numpy as np
 
-from pandas import read_csv
-from nibabel import loadsave
-from bids.layout import parse_file_entities
-from bids.layout.writing import build_path
-from nilearn.datasets import fetch_atlas_difumo
-from nilearn.interfaces.fmriprep.load_confounds import _load_single_confounds_file
+if TYPE_CHECKING:
+    import pandas as pd
+    from nibabel.nifti1 import Nifti1Header
 
 FC_PATTERN: list = [
     "sub-{subject}[/ses-{session}]/func/sub-{subject}"
@@ -47,6 +54,18 @@ FC_PATTERN: list = [
 ]
 FC_FILLS: dict = {"suffix": "connectivity", "extension": ".tsv"}
 
+DYNAMIC_FC_PATTERN: list = [
+    "sub-{subject}[/ses-{session}]/func/sub-{subject}"
+    "[_ses-{session}][_task-{task}][_meas-{meas}][_desc-{desc}]"
+    "_{suffix}{extension}"
+]
+DYNAMIC_FC_FILLS: dict = {
+    "meas": "correlation",
+    "desc": "slidingwindow",
+    "suffix": "connectivity",
+    "extension": ".npy",
+}
+
 TIMESERIES_PATTERN: list = [
     "sub-{subject}[/ses-{session}]/func/sub-{subject}"
     "[_ses-{session}][_task-{task}][_desc-{desc}]"
@@ -60,6 +79,44 @@ CONFOUND_PATTERN: list = [
 ]
 CONFOUND_FILLS: dict = {"desc": "confounds", "suffix": "timeseries", "extension": "tsv"}
 
+OUTPUT_EXTENSIONS: dict = {"tsv": ".tsv", "npy": ".npy"}
+# Significant digits written to text files, enough for floats to round-trip
+TEXT_FORMATS: dict = {"float32": "%.9g", "float64": "%.18e"}
+
+BIDS_INDEX_DIR: str = op.join(op.expanduser("~"), ".cache", "hcph-sops", "bids-index")
+# Version of the index entries, increased when their content changes
+BIDS_INDEX_VERSION: int = 2
+CONFOUNDS_CACHE_DIR: str = op.join(
+    op.expanduser("~"), ".cache", "hcph-sops", "confounds"
+)
+BIDS_IGNORE: tuple = ("code", "stimuli", "sourcedata", "models", "derivatives")
+NIFTI_HEADER_SIZE: int = 348
+SHARD_ENTITIES: tuple = ("subject", "session")
+
+
+def get_output_fills(fills: dict, output_format: str = "tsv") -> dict:
+    """Return a copy of the entity fills with the extension of the output format.
+
+    Parameters
+    ----------
+    fills : dict
+        Entity fills of the output (e.g. FC_FILLS or TIMESERIES_FILLS)
+    output_format : str, optional
+        Output format, either "tsv" or "npy", by default "tsv"
+
+    Returns
+    -------
+    dict
+        Entity fills with the corresponding extension.
+    """
+    if output_format not in OUTPUT_EXTENSIONS:
+        raise ValueError(
+            f"Unknown output format '{output_format}', "
+            f"expected one of {list(OUTPUT_EXTENSIONS)}."
+        )
+
+    return {**fills, "extension": OUTPUT_EXTENSIONS[output_format]}
+
 
 def separate_by_similar_values(
     input_list: list, external_value: Optional[Union[list, np.ndarray]] = None
@@ -90,11 +147,221 @@ def separate_by_similar_values(
     return data_by_value
 
 
+def read_nifti_header(filename: str) -> Nifti1Header:
+    """Read only the header of a (possibly gzipped) NIfTI-1 file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the NIfTI file
+
+    Returns
+    -------
+    Nifti1Header
+        Parsed header (the data is never decompressed).
+    """
+    from nibabel.nifti1 import Nifti1Header
+
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rb") as f:
+        binaryblock = f.read(NIFTI_HEADER_SIZE)
+
+    return Nifti1Header(binaryblock=binaryblock)
+
+
+def get_sidecar_metadata(filename: str, root: Optional[str] = None) -> dict:
+    """Gather the metadata of a BIDS file from the JSON sidecars of its
+    inheritance chain.
+
+    Following the BIDS inheritance principle, the sidecars with the same suffix
+    whose entities are a subset of the entities of the file apply to it, from the
+    directory of the file up to the root; the deepest and most specific sidecars
+    take precedence.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the BIDS file
+    root : Optional[str], optional
+        Root of the BIDS dataset, by default None (only the directory of the file)
+
+    Returns
+    -------
+    dict
+        Merged metadata of the file.
+    """
+    name = re.sub(r"\.nii(\.gz)?$", "", op.basename(filename))
+    *entities, suffix = name.split("_")
+
+    directory = op.dirname(op.abspath(filename))
+    directories = [directory]
+    if root is not None:
+        root = op.abspath(root)
+        while directory != root and op.dirname(directory) != directory:
+            directory = op.dirname(directory)
+            directories.append(directory)
+        if directory != root:
+            # The file is not under the root: only its own directory applies
+            directories = directories[:1]
+
+    metadata = {}
+    for directory in reversed(directories):
+        sidecars = []
+        for candidate in os.listdir(directory):
+            if candidate != f"{suffix}.json" and not candidate.endswith(
+                f"_{suffix}.json"
+            ):
+                continue
+            candidate_entities = candidate[: -len(f"{suffix}.json")].split("_")[:-1]
+            if set(candidate_entities) <= set(entities):
+                sidecars.append((len(candidate_entities), candidate))
+
+        for _, candidate in sorted(sidecars):
+            with open(op.join(directory, candidate)) as f:
+                metadata.update(json.load(f))
+
+    return metadata
+
+
+def index_func_file(filename: str, root: Optional[str] = None) -> dict:
+    """Build the discovery index entry of a functional file from its header and
+    JSON sidecars.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the BIDS functional file
+    root : Optional[str], optional
+        Root of the BIDS dataset, where the inheritance of the sidecars stops, by
+        default None (only the directory of the file)
+
+    Returns
+    -------
+    dict
+        Dictionary with the affine, shape, repetition time and BIDS entities.
+    """
+    from bids.layout import parse_file_entities
+
+    header = read_nifti_header(filename)
+
+    t_r = get_sidecar_metadata(filename, root).get("RepetitionTime")
+    if t_r is None:
+        # Fall back to the header, converting the time units to seconds
+        t_r = float(header.get_zooms()[3])
+        if header.get_xyzt_units()[1] == "msec":
+            t_r /= 1000
+
+    return {
+        "affine": header.get_best_affine().tolist(),
+        "shape": [int(n) for n in header.get_data_shape()],
+        "t_r": t_r,
+        "entities": {
+            key: str(value) for key, value in parse_file_entities(filename).items()
+        },
+    }
+
+
+def load_bids_index(
+    paths_to_func_dir: str, index_dir: str = BIDS_INDEX_DIR
+) -> dict[str, dict]:
+    """Index the functional files of a BIDS dataset from their headers.
+
+    The index is stored on disk and an entry is only recomputed when the size or
+    the modification time of its file changed.
+
+    Parameters
+    ----------
+    paths_to_func_dir : str
+        Path to the BIDS (usually derivatives) directory
+    index_dir : str, optional
+        Directory where the index is stored, by default BIDS_INDEX_DIR
+
+    Returns
+    -------
+    dict[str, dict]
+        Index entries (see :func:`index_func_file`) keyed by file path.
+    """
+    root = op.abspath(paths_to_func_dir)
+    index_file = op.join(
+        index_dir,
+        f"{hashlib.sha1(root.encode()).hexdigest()}-v{BIDS_INDEX_VERSION}.json",
+    )
+
+    index = {}
+    if op.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+
+    updated_index = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(
+            d for d in dirnames if not d.startswith(".") and d not in BIDS_IGNORE
+        )
+        for filename in filenames:
+            # Same files as the PyBIDS discovery (gzipped NIfTI only)
+            if not filename.endswith("_bold.nii.gz"):
+                continue
+
+            path = op.join(dirpath, filename)
+            stat = os.stat(path)
+            entry = index.get(path)
+            if (
+                entry is None
+                or entry["size"] != stat.st_size
+                or entry["mtime"] != stat.st_mtime_ns
+            ):
+                entry = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    **index_func_file(path, root),
+                }
+            updated_index[path] = entry
+
+    if updated_index != index:
+        logging.debug(f"Updating the BIDS discovery index: {index_file}")
+        os.makedirs(index_dir, exist_ok=True)
+        tmp_index_file = get_tmp_filename(index_file)
+        with open(tmp_index_file, "w") as f:
+            json.dump(updated_index, f)
+        os.replace(tmp_index_file, index_file)
+
+    return updated_index
+
+
+def match_entities(entities: dict, filters: dict) -> bool:
+    """Check whether BIDS entities match the filters (empty filters match all).
+
+    Parameters
+    ----------
+    entities : dict
+        BIDS entities of a file
+    filters : dict
+        Accepted values for each entity
+
+    Returns
+    -------
+    bool
+        True if every entity matches one of its accepted values.
+    """
+    for entity, values in filters.items():
+        if not values:
+            continue
+        if entity not in entities:
+            return False
+        # Runs are compared as integers so that "1" matches "01"
+        normalize = int if entity == "run" else str
+        if normalize(entities[entity]) not in map(normalize, values):
+            return False
+
+    return True
+
+
 def get_func_filenames_bids(
     paths_to_func_dir: str,
     task_filter: Optional[list] = None,
     ses_filter: Optional[list] = None,
     run_filter: Optional[list] = None,
+    use_index: bool = True,
 ) -> tuple[list[list[str]], list[float]]:
     """Return the BIDS functional imaging files matching the specified task and session
     filters as well as the first (if multiple) unique repetition time (TR).
@@ -109,28 +376,55 @@ def get_func_filenames_bids(
         List of session name(s) to consider, by default `None`
     run_filter : list, optional
         List of run(s) to consider, by default `None`
+    use_index : bool, optional
+        Condition to discover the files from their headers through the on-disk
+        index (see :func:`load_bids_index`) instead of PyBIDS, by default True
 
     Returns
     -------
     tuple[list[list[str]], list[float]]
         Returns two lists with: a list of sorted filenames and a list of TRs.
     """
-    logging.debug("Using BIDS to find functional files...")
+    if use_index:
+        logging.debug("Using the BIDS index to find functional files...")
 
-    layout = BIDSLayout(
-        paths_to_func_dir,
-        validate=False,
-    )
+        index = load_bids_index(paths_to_func_dir)
+        filters = {"task": task_filter, "session": ses_filter, "run": run_filter}
 
-    all_derivatives = layout.get(
-        scope="all",
-        return_type="file",
-        extension=["nii.gz", "gz"],
-        suffix="bold",
-        task=task_filter or [],
-        session=ses_filter or [],
-        run=run_filter or [],
-    )
+        all_derivatives = sorted(
+            path
+            for path, entry in index.items()
+            if match_entities(entry["entities"], filters)
+        )
+        affines = [index[file]["affine"] for file in all_derivatives]
+        repetition_times = {file: index[file]["t_r"] for file in all_derivatives}
+        for file in all_derivatives:
+            PATH_BUILDER.add_entities(file, index[file]["entities"])
+    else:
+        from bids import BIDSLayout
+        from nibabel import loadsave
+
+        logging.debug("Using BIDS to find functional files...")
+
+        layout = BIDSLayout(
+            paths_to_func_dir,
+            validate=False,
+        )
+
+        all_derivatives = layout.get(
+            scope="all",
+            return_type="file",
+            extension=["nii.gz", "gz"],
+            suffix="bold",
+            task=task_filter or [],
+            session=ses_filter or [],
+            run=run_filter or [],
+        )
+        affines = [loadsave.load(file).affine for file in all_derivatives]
+        repetition_times = {
+            file: layout.get_metadata(file)["RepetitionTime"]
+            for file in all_derivatives
+        }
 
     if not all_derivatives:
         raise ValueError(
@@ -142,10 +436,6 @@ def get_func_filenames_bids(
             f"\nRun: {run_filter or []}"
         )
 
-    affines = []
-    for file in all_derivatives:
-        affines.append(loadsave.load(file).affine)
-
     similar_fov_dict = separate_by_similar_values(
         all_derivatives, np.array(affines)[:, 0, 0]
     )
@@ -161,7 +451,7 @@ def get_func_filenames_bids(
     for file_group in similar_fov_dict.values():
         t_rs = []
         for file in file_group:
-            t_rs.append(layout.get_metadata(file)["RepetitionTime"])
+            t_rs.append(repetition_times[file])
 
         similar_tr_dict = separate_by_similar_values(file_group, t_rs)
         separated_files += list(similar_tr_dict.values())
@@ -177,6 +467,272 @@ def get_func_filenames_bids(
     return separated_files, separated_trs
 
 
+def parse_shard(shard: str) -> tuple[int, int]:
+    """Parse a shard specification of the form ``i/N`` (with 1 <= i <= N).
+
+    Parameters
+    ----------
+    shard : str
+        Shard specification
+
+    Returns
+    -------
+    tuple[int, int]
+        Index of the shard and number of shards.
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", shard)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError(f"Invalid shard '{shard}': expected i/N with 1 <= i <= N.")
+    return int(match.group(1)), int(match.group(2))
+
+
+def get_shard(filename: str, n_shards: int) -> int:
+    """Return the shard of a functional file.
+
+    The shard only depends on the subject and session of the file, so all the
+    runs of a session are processed by the same shard, and the assignment does
+    not change when other sessions are added to the dataset.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the BIDS functional file
+    n_shards : int
+        Number of shards
+
+    Returns
+    -------
+    int
+        Index of the shard (from 1 to ``n_shards``)
+    """
+    entities = PATH_BUILDER.entities(filename)
+    key = "_".join(str(entities.get(entity, "")) for entity in SHARD_ENTITIES)
+    return int(hashlib.sha1(key.encode()).hexdigest(), 16) % n_shards + 1
+
+
+def select_shard(
+    func_filenames: list[list[str]], t_r_list: list[float], shard: tuple[int, int]
+) -> tuple[list[list[str]], list[float]]:
+    """Keep the functional files of one shard (see :func:`get_shard`).
+
+    Parameters
+    ----------
+    func_filenames : list[list[str]]
+        Groups of BIDS functional filenames
+    t_r_list : list[float]
+        Repetition time of each group
+    shard : tuple[int, int]
+        Index of the shard and number of shards
+
+    Returns
+    -------
+    tuple[list[list[str]], list[float]]
+        Groups of the files of the shard (empty groups are dropped) and their
+        repetition times.
+    """
+    index, n_shards = shard
+
+    shard_filenames, shard_t_rs = [], []
+    for file_group, t_r in zip(func_filenames, t_r_list):
+        file_group = [
+            filename
+            for filename in file_group
+            if get_shard(filename, n_shards) == index
+        ]
+        if file_group:
+            shard_filenames.append(file_group)
+            shard_t_rs.append(t_r)
+
+    return shard_filenames, shard_t_rs
+
+
+def get_shard_filename(filename: str, shard: Optional[tuple[int, int]]) -> str:
+    """Return the name of a file shared by all the runs (e.g., a summary CSV file)
+    as written by one shard, so that the shards never write to the same file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the shared file
+    shard : Optional[tuple[int, int]]
+        Index of the shard and number of shards (None if not sharded)
+
+    Returns
+    -------
+    str
+        Path to the file of the shard (e.g., ``name_shard-1of4.csv``)
+    """
+    if shard is None:
+        return filename
+
+    root, extension = op.splitext(filename)
+    return f"{root}_shard-{shard[0]}of{shard[1]}{extension}"
+
+
+def get_tmp_filename(filename: str) -> str:
+    """Return a temporary name for a file written atomically, unique across the
+    processes and hosts sharing a file system.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the final file
+
+    Returns
+    -------
+    str
+        Path to the temporary file (with the same extension)
+    """
+    root, extension = op.splitext(filename)
+    return f"{root}.{socket.gethostname()}-{os.getpid()}{extension}"
+
+
+class BIDSPathBuilder:
+    """Build BIDS output paths from the entities of input files.
+
+    The BIDS entity definitions are loaded once, the entities of each input file
+    are parsed once and the output patterns are compiled once into string
+    templates, so that rendering a path only formats strings. Patterns with value
+    selectors or defaults (e.g. ``{suffix<bold>}``) and list-valued entities are
+    delegated to PyBIDS' ``build_path``.
+    """
+
+    def __init__(self):
+        self._config_entities = None
+        self._entities = {}
+        self._patterns = {}
+
+    def entities(self, filename: str) -> dict:
+        """Return (a copy of) the BIDS entities of a file.
+
+        Parameters
+        ----------
+        filename : str
+            BIDS filename
+
+        Returns
+        -------
+        dict
+            BIDS entities of the file
+        """
+        if filename not in self._entities:
+            from bids.layout import parse_file_entities
+            from bids.layout.models import Config
+
+            if self._config_entities is None:
+                config_entities = {}
+                for config in ["bids", "derivatives"]:
+                    config_entities.update(Config.load(config).entities)
+                self._config_entities = list(config_entities.values())
+
+            self._entities[filename] = parse_file_entities(
+                filename, entities=self._config_entities
+            )
+        return self._entities[filename].copy()
+
+    def add_entities(self, filename: str, entities: dict):
+        """Register the BIDS entities of a file parsed beforehand (e.g., by the
+        discovery index), so that PyBIDS does not parse them again.
+
+        Parameters
+        ----------
+        filename : str
+            BIDS filename
+        entities : dict
+            BIDS entities of the file
+        """
+        self._entities.setdefault(filename, dict(entities))
+
+    def compile(self, pattern: str) -> Optional[tuple]:
+        """Compile a BIDS path pattern into string templates.
+
+        Parameters
+        ----------
+        pattern : str
+            BIDS path pattern with ``{entity}`` fields and ``[optional]`` parts
+
+        Returns
+        -------
+        Optional[tuple]
+            Whether the extension follows a dot in the pattern and the parts of
+            the pattern, each as a (optional, template, fields) tuple (None if the
+            pattern cannot be compiled).
+        """
+        if pattern not in self._patterns:
+            compiled = None
+            if not re.search(r"\{[^}]*[<|]", pattern):
+                parts = tuple(
+                    (
+                        part.startswith("["),
+                        part.strip("[]"),
+                        tuple(re.findall(r"\{(\w*)\}", part)),
+                    )
+                    for part in re.split(r"(\[[^\]]*\])", pattern)
+                    if part
+                )
+                compiled = (bool(re.search(r"\.\{extension", pattern)), parts)
+            self._patterns[pattern] = compiled
+        return self._patterns[pattern]
+
+    def build(self, filename: str, patterns: list, **kwargs) -> Optional[str]:
+        """Return the BIDS path following the first matching pattern, with the
+        entities of a file modified by the keyword arguments.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the original BIDS file
+        patterns : list
+            Patterns for the output file
+
+        Returns
+        -------
+        Optional[str]
+            BIDS output path (None if no pattern matches).
+        """
+        entities = self.entities(filename)
+        entities.update(kwargs)
+        # Drop None and empty-strings, keep zeros (as in build_path)
+        entities = {
+            key: value for key, value in entities.items() if value or value == 0
+        }
+
+        patterns = [patterns] if isinstance(patterns, str) else patterns
+        compiled_patterns = [self.compile(pattern) for pattern in patterns]
+        if None in compiled_patterns or any(
+            isinstance(value, (list, tuple)) for value in entities.values()
+        ):
+            from bids.layout.writing import build_path
+
+            return build_path(entities, patterns)
+
+        if "extension" in entities:
+            entities["extension"] = str(entities["extension"]).lstrip(".")
+
+        for dot_extension, parts in compiled_patterns:
+            values = entities
+            if "extension" in entities and not dot_extension:
+                values = entities | {"extension": f".{entities['extension']}"}
+
+            path = []
+            for optional, template, fields in parts:
+                present = [field in values for field in fields]
+                if optional and not any(present):
+                    continue
+                if not all(present):
+                    break
+                path.append(
+                    template.format(**{field: values[field] for field in fields})
+                )
+            else:
+                return "".join(path)
+
+        return None
+
+
+PATH_BUILDER = BIDSPathBuilder()
+
+
 def get_bids_savename(filename: str, patterns: list, **kwargs) -> str:
     """Return the BIDS filename following the specified patterns and modifying the
     entities from the keywords arguments.
@@ -193,14 +749,7 @@ def get_bids_savename(filename: str, patterns: list, **kwargs) -> str:
     str
         BIDS output filename.
     """
-    entity = parse_file_entities(filename)
-
-    for key, value in kwargs.items():
-        entity[key] = value
-
-    bids_savename = build_path(entity, patterns)
-
-    return str(bids_savename)
+    return str(PATH_BUILDER.build(filename, patterns, **kwargs))
 
 
 def get_atlas_data(atlas_name: str = "DiFuMo", **kwargs) -> dict:
@@ -216,6 +765,8 @@ def get_atlas_data(atlas_name: str = "DiFuMo", **kwargs) -> dict:
     dict
         Dictionary with keys "maps" (filename) and "labels" (ROI labels).
     """
+    from nilearn.datasets import fetch_atlas_difumo
+
     logging.info("Fetching the DiFuMo atlas ...")
 
     if kwargs["dimension"] not in [64, 128, 512]:
@@ -227,6 +778,53 @@ def get_atlas_data(atlas_name: str = "DiFuMo", **kwargs) -> dict:
     return fetch_atlas_difumo(legacy_format=False, **kwargs)
 
 
+def find_atlas_maps(
+    dimension: int, resolution_mm: int = 2, data_dir: Optional[str] = None
+) -> Optional[str]:
+    """Find the maps of a DiFuMo atlas already fetched by NiLearn, without
+    importing NiLearn.
+
+    The data directories are searched in the order of NiLearn's
+    ``get_dataset_dir``.
+
+    Parameters
+    ----------
+    dimension : int
+        Dimension of the atlas
+    resolution_mm : int, optional
+        Resolution of the maps in mm, by default 2
+    data_dir : Optional[str], optional
+        NiLearn data directory, by default None (NiLearn's default directories)
+
+    Returns
+    -------
+    Optional[str]
+        Path to the maps of the atlas (None if the atlas was not fetched yet).
+    """
+    if data_dir is not None:
+        data_dirs = str(data_dir).split(os.pathsep)
+    else:
+        data_dirs = []
+        for variable in ["NILEARN_SHARED_DATA", "NILEARN_DATA"]:
+            if os.getenv(variable) is not None:
+                data_dirs += os.getenv(variable).split(os.pathsep)
+        data_dirs.append(op.expanduser("~/nilearn_data"))
+
+    for path in data_dirs:
+        dataset_dir = op.join(path, "difumo_atlases")
+        if op.islink(dataset_dir):
+            # NiLearn resolves the link to the dataset directory
+            dataset_dir = op.join(path, os.readlink(dataset_dir))
+        if op.isdir(dataset_dir):
+            # NiLearn only looks for the atlases in the first existing directory
+            maps = op.join(
+                dataset_dir, str(dimension), f"{resolution_mm}mm", "maps.nii.gz"
+            )
+            return maps if op.exists(maps) else None
+
+    return None
+
+
 def find_atlas_dimension(path: str, atlas_name: str = "DiFuMo") -> int:
     """Fetch the atlas dimension from the path where the functional connectivity are saved.
     Parameters
@@ -329,6 +927,9 @@ def reorder_iqms(iqms_df: pd.DataFrame, fc_paths: list[str]):
     panda.df
         Dataframe containing the IQMs dataframe with reordered rows.
     """
+    import pandas as pd
+    from bids.layout import parse_file_entities
+
     iqms_df = iqms_df.assign(
         subject=iqms_df["bids_name"].str.extract(r"sub-(\d+)_"),
         session=iqms_df["bids_name"].str.extract(r"ses-(\w+)_"),
@@ -369,6 +970,8 @@ def load_iqms(
     panda.df
         Dataframe containing the IQMs loaded from the derivatives folder.
     """
+    from pandas import read_csv
+
     # Find the MRIQC folder
     if mriqc_path is None:
         mriqc_path = find_mriqc(derivative_path)
@@ -423,10 +1026,11 @@ def check_existing_output(
             "Setting return_output=True in check_existing_output requires return_existing=True."
         )
 
-    missing_data_filter = [
-        not op.exists(op.join(output, get_bids_savename(filename, **kwargs)))
+    output_paths = [
+        op.join(output, get_bids_savename(filename, **kwargs))
         for filename in func_filename
     ]
+    missing_data_filter = [not op.exists(path) for path in output_paths]
 
     missing_data = np.array(func_filename)[missing_data_filter]
     logging.debug(
@@ -437,9 +1041,9 @@ def check_existing_output(
     if return_existing:
         if return_output:
             existing_output = [
-                op.join(output, get_bids_savename(filename, **kwargs))
-                for filename in func_filename
-                if op.exists(op.join(output, get_bids_savename(filename, **kwargs)))
+                path
+                for path, missing in zip(output_paths, missing_data_filter)
+                if not missing
             ]
             return existing_output
         else:
@@ -451,8 +1055,32 @@ def check_existing_output(
     return missing_data.tolist()
 
 
-def load_timeseries(func_filename: list[str], output: str) -> list[np.ndarray]:
-    """Load existing timeseries from .csv files.
+def load_output(path: str, mmap: bool = True) -> np.ndarray:
+    """Load an output array (timeseries or matrix) saved by :func:`save_output`.
+
+    Parameters
+    ----------
+    path : str
+        Path to the output file (.npy or .tsv)
+    mmap : bool, optional
+        Condition to memory-map binary outputs instead of reading them, by default
+        True
+
+    Returns
+    -------
+    np.ndarray
+        Loaded (or memory-mapped) array.
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r" if mmap else None)
+
+    return np.loadtxt(path, delimiter="\t", ndmin=2)
+
+
+def load_timeseries(
+    func_filename: list[str], output: str, output_format: str = "tsv"
+) -> list[np.ndarray]:
+    """Load existing timeseries from .tsv or .npy files.
 
     Parameters
     ----------
@@ -460,6 +1088,8 @@ def load_timeseries(func_filename: list[str], output: str) -> list[np.ndarray]:
         List of timeseries filenames.
     output : str
         Path to the output folder.
+    output_format : str, optional
+        Format of the saved timeseries, by default "tsv"
 
     Returns
     -------
@@ -472,16 +1102,35 @@ def load_timeseries(func_filename: list[str], output: str) -> list[np.ndarray]:
     loaded_ts = []
     for filename in func_filename:
         path_to_ts = get_bids_savename(
-            filename, patterns=TIMESERIES_PATTERN, **TIMESERIES_FILLS
+            filename,
+            patterns=TIMESERIES_PATTERN,
+            **get_output_fills(TIMESERIES_FILLS, output_format),
         )
         logging.debug(f"\t{op.join(output, path_to_ts)}")
-        loaded_ts.append(
-            np.genfromtxt(op.join(output, path_to_ts), float, delimiter="\t")
-        )
+        loaded_ts.append(load_output(op.join(output, path_to_ts)))
 
     return loaded_ts
 
 
+def get_confounds_filename(filename: str) -> str:
+    """Get the path to the fMRIPrep confounds file of a functional file.
+
+    Parameters
+    ----------
+    filename : str
+        BIDS functional filename
+
+    Returns
+    -------
+    str
+        Path to the confounds TSV file (next to the functional file)
+    """
+    return op.join(
+        op.dirname(filename),
+        get_bids_savename(filename, patterns=CONFOUND_PATTERN, **CONFOUND_FILLS),
+    )
+
+
 def get_confounds_manually(func_filename: list[str], **kwargs) -> tuple[list, list]:
     """Manually load the fMRIPrep confounds.
 
@@ -496,14 +1145,14 @@ def get_confounds_manually(func_filename: list[str], **kwargs) -> tuple[list, li
         Two lists, one with the loaded confounds (for each input file) and one with the
         corresponding sample mask.
     """
+    from nilearn.interfaces.fmriprep.load_confounds import (
+        _load_single_confounds_file,
+    )
+
     confounds, sample_mask = [], []
 
     for filename in func_filename:
-        dir_name = op.dirname(filename)
-        confounds_file = op.join(
-            dir_name,
-            get_bids_savename(filename, patterns=CONFOUND_PATTERN, **CONFOUND_FILLS),
-        )
+        confounds_file = get_confounds_filename(filename)
 
         # confounds_json_file = load_confounds._get_json(confounds_file)
         confounds_json_file = confounds_file.replace("tsv", "json")
@@ -518,14 +1167,136 @@ def get_confounds_manually(func_filename: list[str], **kwargs) -> tuple[list, li
     return confounds, sample_mask
 
 
+def load_confounds_cached(
+    confounds_file: str,
+    cache_dir: str = CONFOUNDS_CACHE_DIR,
+    load_dataframe: Optional[callable] = None,
+) -> pd.DataFrame:
+    """Load an fMRIPrep confounds file through a persistent columnar cache.
+
+    The TSV file is parsed once and its columns are stored as a binary array keyed
+    by the path, size and modification time of the file. Later loads memory-map the
+    array, so only the columns selected by a denoising strategy are read.
+
+    Parameters
+    ----------
+    confounds_file : str
+        Path to the confounds TSV file
+    cache_dir : str, optional
+        Directory of the persistent cache, by default CONFOUNDS_CACHE_DIR
+    load_dataframe : Optional[callable], optional
+        Function parsing the TSV file, by default NiLearn's
+        load_confounds_file_as_dataframe
+
+    Returns
+    -------
+    pd.DataFrame
+        Confounds of the file (read-only when loaded from the cache)
+    """
+    import pandas as pd
+
+    if load_dataframe is None:
+        from nilearn.interfaces.fmriprep.load_confounds_utils import (
+            load_confounds_file_as_dataframe as load_dataframe,
+        )
+
+    path = op.abspath(confounds_file)
+    stat = os.stat(path)
+    key = hashlib.sha1(
+        f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    ).hexdigest()
+    values_file = op.join(cache_dir, f"{key}.npy")
+    columns_file = op.join(cache_dir, f"{key}.json")
+
+    if op.exists(values_file) and op.exists(columns_file):
+        with open(columns_file) as f:
+            columns = json.load(f)
+        # The array is stored column-major so each column is contiguous on disk
+        return pd.DataFrame(np.load(values_file, mmap_mode="r"), columns=columns)
+
+    confounds = load_dataframe(confounds_file)
+    if not all(pd.api.types.is_numeric_dtype(dtype) for dtype in confounds.dtypes):
+        logging.debug(f"Non-numeric confounds are not cached: {confounds_file}")
+        return confounds
+
+    logging.debug(f"Caching the confounds of {confounds_file}")
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_values_file = get_tmp_filename(values_file)
+    np.save(
+        tmp_values_file, np.asfortranarray(confounds.to_numpy(dtype=np.float64))
+    )
+    os.replace(tmp_values_file, values_file)
+    tmp_columns_file = get_tmp_filename(columns_file)
+    with open(tmp_columns_file, "w") as f:
+        json.dump(list(confounds.columns), f)
+    os.replace(tmp_columns_file, columns_file)
+
+    return confounds
+
+
+@contextmanager
+def shared_confounds_files(cache_dir: Optional[str] = None):
+    """Parse each fMRIPrep confounds file only once while the context is active.
+
+    NiLearn's load_confounds reads the confounds file again for every strategy,
+    so the parsed files are kept in memory and a copy is handed to each call. With
+    a cache directory, the files are loaded through the persistent columnar cache
+    (see :func:`load_confounds_cached`) so that they are never parsed again.
+
+    Parameters
+    ----------
+    cache_dir : Optional[str], optional
+        Directory of the persistent confounds cache, by default None (the files
+        are only shared in memory)
+    """
+    # NiLearn has no public entry point taking parsed confounds, so its private
+    # loader is replaced: fail loudly rather than silently parse every file again
+    # if a NiLearn release renames it
+    nilearn_load_confounds = importlib.import_module(
+        "nilearn.interfaces.fmriprep.load_confounds"
+    )
+    load_dataframe = getattr(
+        nilearn_load_confounds, "load_confounds_file_as_dataframe", None
+    )
+    if not callable(load_dataframe):
+        raise ValueError(
+            "The confounds files cannot be shared with this version of NiLearn: "
+            "nilearn.interfaces.fmriprep.load_confounds has no "
+            "load_confounds_file_as_dataframe."
+        )
+    parsed = {}
+
+    def _load_shared_dataframe(confounds_raw):
+        if confounds_raw not in parsed:
+            parsed[confounds_raw] = (
+                load_dataframe(confounds_raw)
+                if cache_dir is None
+                else load_confounds_cached(
+                    confounds_raw, cache_dir, load_dataframe=load_dataframe
+                )
+            )
+        return parsed[confounds_raw].copy(deep=cache_dir is None)
+
+    nilearn_load_confounds.load_confounds_file_as_dataframe = _load_shared_dataframe
+    try:
+        yield
+    finally:
+        nilearn_load_confounds.load_confounds_file_as_dataframe = load_dataframe
+
+
 def save_output(
     data_list: list[np.ndarray],
     original_filenames: list[str],
     output: str,
+    metadata: Optional[dict] = None,
     **kwargs,
-) -> None:
+) -> list[str]:
     """Save the output files.
 
+    The format is chosen from the extension in the keyword arguments: ".npy" files
+    are saved in binary with a JSON sidecar, any other extension is saved as
+    tab-separated text.
+
     Parameters
     ----------
     data_list : list[np.ndarray]
@@ -534,10 +1305,79 @@ def save_output(
         List of original filenames
     output : Optional[str], optional
         Path to the output directory, by default None
+    metadata : Optional[dict], optional
+        Additional fields of the JSON sidecars of binary files, by default None
+
+    Returns
+    -------
+    list[str]
+        List of the saved paths.
     """
+    saved_paths = []
     for data, filename in zip(data_list, original_filenames):
         path_to_save = get_bids_savename(filename, **kwargs)
         saveloc = op.join(output, path_to_save)
         logging.debug(f"Saving data of type {type(data)} to: {saveloc}")
         os.makedirs(op.dirname(saveloc), exist_ok=True)
-        np.savetxt(saveloc, data, delimiter="\t")
+
+        if saveloc.endswith(".npy"):
+            np.save(saveloc, np.asarray(data))
+            with open(saveloc.replace(".npy", ".json"), "w") as f:
+                json.dump(
+                    {
+                        "Shape": list(np.shape(data)),
+                        "DType": str(np.asarray(data).dtype),
+                        "Sources": [op.basename(filename)],
+                        **(metadata or {}),
+                    },
+                    f,
+                    indent=2,
+                )
+        else:
+            save_text(saveloc, data)
+
+        saved_paths.append(saveloc)
+
+    return saved_paths
+
+
+def save_text(path: str, data: np.ndarray):
+    """Save an array as tab-separated text, with as many digits as its precision.
+
+    Parameters
+    ----------
+    path : str
+        Path to the text file
+    data : np.ndarray
+        Array to save
+    """
+    data = np.asarray(data)
+    np.savetxt(
+        path,
+        data,
+        delimiter="\t",
+        fmt=TEXT_FORMATS.get(data.dtype.name, TEXT_FORMATS["float64"]),
+    )
+
+
+def export_tsv(paths: list[str]) -> list[str]:
+    """Export binary outputs to tab-separated text files next to them.
+
+    Parameters
+    ----------
+    paths : list[str]
+        List of .npy outputs to export
+
+    Returns
+    -------
+    list[str]
+        List of the exported .tsv paths.
+    """
+    exported_paths = []
+    for path in paths:
+        tsv_path = re.sub(r"\.npy$", ".tsv", path)
+        logging.debug(f"Exporting {path} to: {tsv_path}")
+        save_text(tsv_path, load_output(path))
+        exported_paths.append(tsv_path)
+
+    return exported_paths
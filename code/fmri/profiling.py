@@ -0,0 +1,191 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+#
+# Copyright 2023 The Axon Lab <theaxonlab@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# We support and encourage derived works from this project, please read
+# about our expectations at
+#
+#     https://www.nipreps.org/community/licensing/
+#
+"""Python module for the timing and memory instrumentation of the pipeline
+
+Stages are instrumented with nested spans recording their wall and CPU times,
+the peak resident memory of the process and item counts. Spans opened in worker
+processes are returned with the results of the jobs and attached to the span of
+the parent process that collects them.
+"""
+
+import json
+import logging
+import os
+import os.path as op
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+PROFILE_FILE: str = "funconn_profile.json"
+PROFILE_DIR: str = "profile"
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory (in MB) of the current process so far."""
+    if resource is None:
+        return float("nan")
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kB on Linux
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+class Profiler:
+    """Collect nested spans of the stages of a process."""
+
+    def __init__(self):
+        self.spans = []
+        self._stack = []
+
+    @contextmanager
+    def span(self, name: str, **counts) -> Iterator[dict]:
+        """Record the duration and memory of a stage.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage
+        **counts
+            Number of items (e.g., files) processed by the stage, which can also
+            be set on the yielded record
+
+        Yields
+        ------
+        dict
+            Record of the span
+        """
+        record = {"name": name, "pid": os.getpid(), **counts, "children": []}
+        (self._stack[-1]["children"] if self._stack else self.spans).append(record)
+        self._stack.append(record)
+
+        start_peak = peak_rss_mb()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall_s"] = time.perf_counter() - start_wall
+            record["cpu_s"] = time.process_time() - start_cpu
+            record["peak_rss_mb"] = peak_rss_mb()
+            record["peak_rss_increase_mb"] = record["peak_rss_mb"] - start_peak
+            record["children"] = record.pop("children")
+            self._stack.pop()
+            logging.debug(
+                f"{name}: {record['wall_s']:.2f} s (CPU {record['cpu_s']:.2f} s), "
+                f"peak memory {record['peak_rss_mb']:.0f} MB"
+            )
+
+    def attach(self, spans: list[dict]):
+        """Attach spans recorded in another process to the current span.
+
+        Parameters
+        ----------
+        spans : list[dict]
+            Spans returned by ``run_profiled``
+        """
+        (self._stack[-1]["children"] if self._stack else self.spans).extend(spans)
+
+    def save(self, filename: str, **metadata):
+        """Write the recorded spans in a JSON file.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the JSON profile
+        **metadata
+            Additional fields of the profile
+        """
+        os.makedirs(op.dirname(op.abspath(filename)), exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump(
+                {"command": sys.argv, **metadata, "spans": self.spans}, f, indent=2
+            )
+        logging.info(f"Profile of the run saved in: {filename}")
+
+
+# Profiler of the current process, used by the instrumented stages
+PROFILER = Profiler()
+
+
+def span(name: str, **counts):
+    """Record a stage in the profiler of the current process (see Profiler.span)."""
+    return PROFILER.span(name, **counts)
+
+
+def run_profiled(
+    function: Callable, *args, profile_dir: Optional[str] = None, **kwargs
+) -> tuple:
+    """Run a job (e.g., in a worker process) and return its spans with its result.
+
+    Parameters
+    ----------
+    function : Callable
+        Job to run
+    *args
+        Positional arguments of the job
+    profile_dir : Optional[str], optional
+        Directory where the cProfile statistics of the job are dumped (as
+        ``<function>-<pid>-<time>.prof`` files, readable with ``pstats``), by
+        default None (no cProfile)
+    **kwargs
+        Keyword arguments of the job
+
+    Returns
+    -------
+    tuple
+        Result of the job and its spans.
+    """
+    # The spans of the job are recorded apart from those of the caller (or of the
+    # previous jobs of a reused worker process)
+    caller_spans = PROFILER.spans, PROFILER._stack
+    PROFILER.spans, PROFILER._stack = [], []
+
+    profile = None
+    if profile_dir is not None:
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+    try:
+        with span(function.__name__):
+            result = function(*args, **kwargs)
+    finally:
+        spans = PROFILER.spans
+        PROFILER.spans, PROFILER._stack = caller_spans
+        if profile is not None:
+            profile.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            profile.dump_stats(
+                op.join(
+                    profile_dir,
+                    f"{function.__name__}-{os.getpid()}-{time.time_ns()}.prof",
+                )
+            )
+
+    return result, spans
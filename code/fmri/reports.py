@@ -28,19 +28,28 @@ import os.path as op
 from typing import Optional, Union
 
 import matplotlib.pyplot as plt
-import nibabel as nib
 import numpy as np
 import pandas as pd
 import plotly.offline as pyo
 import seaborn as sns
 from matplotlib.axes import Axes
+from matplotlib.collections import LineCollection
 from matplotlib.lines import Line2D
 from nireports.assembler.report import Report
 from nilearn.plotting import plot_design_matrix, plot_matrix
-from scipy.stats import pearsonr, ks_2samp
 from time import strftime
 from uuid import uuid4
 
+from atlas_cache import ATLAS_CACHE_DIR, get_atlas_geometry
+from group_stats import (
+    binned_ks_statistic,
+    compute_qc_fc,
+    correlation_p_value,
+    histogram_summary,
+    permutation_null_qc_fc,
+    stack_upper_triangles,
+)
+from group_store import edge_histograms, histogram_bins
 from load_save import get_bids_savename
 
 
@@ -57,10 +66,106 @@ TS_FIGURE_SIZE: tuple = (50, 25)
 FC_FIGURE_SIZE: tuple = (70, 45)
 LABELSIZE: int = 42
 NETWORK_CMAP: str = "turbo"
-N_PERMUTATION: int = 10000
 ALPHA = 0.05
 PERCENT_MATCH_CUT_OFF = 95
 DURATION_CUT_OFF = 300
+# Level of detail of the timeseries reports, bounding their size and rendering
+# time regardless of the atlas dimension and number of timepoints
+MAX_SIGNAL_POINTS: int = 1000
+MAX_CARPET_SHAPE: tuple = (2000, 512)
+MAX_TICK_LABELS: int = 128
+MAX_VECTOR_POINTS: int = 100000
+
+
+def block_average(data: np.ndarray, shape: tuple) -> np.ndarray:
+    """Average the blocks of contiguous elements of a 2D array so that it does
+    not exceed a given shape.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        2D array
+    shape : tuple
+        Maximum shape of the averaged array
+
+    Returns
+    -------
+    np.ndarray
+        Averaged array (the input if already small enough)
+    """
+    for axis, max_size in enumerate(shape):
+        if data.shape[axis] > max_size:
+            starts = np.linspace(0, data.shape[axis], max_size, endpoint=False)
+            starts = np.unique(starts.astype(int))
+            counts = np.diff(np.append(starts, data.shape[axis]))
+            sums = np.add.reduceat(data, starts, axis=axis)
+            data = sums / np.expand_dims(counts, 1 - axis)
+    return data
+
+
+def signal_envelope(
+    timeseries: np.ndarray, max_points: int = MAX_SIGNAL_POINTS
+) -> tuple[np.ndarray, np.ndarray]:
+    """Reduce the signals to their envelope when they have more timepoints than
+    the budget of points.
+
+    The timepoints are binned and each bin is drawn as its minimum and maximum,
+    so the peaks of the signals are preserved.
+
+    Parameters
+    ----------
+    timeseries : np.ndarray
+        Timeseries of shape (n_timepoints, n_regions)
+    max_points : int, optional
+        Maximum number of points of each signal, by default MAX_SIGNAL_POINTS
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Timepoints of the points and the reduced signals of shape
+        (n_points, n_regions).
+    """
+    n_timepoints = timeseries.shape[0]
+    if n_timepoints <= max_points:
+        return np.arange(n_timepoints), timeseries
+
+    starts = np.unique(
+        np.linspace(0, n_timepoints, max_points // 2, endpoint=False).astype(int)
+    )
+    stops = np.append(starts[1:], n_timepoints) - 1
+
+    envelope = np.empty((2 * starts.size, timeseries.shape[1]))
+    envelope[0::2] = np.minimum.reduceat(timeseries, starts, axis=0)
+    envelope[1::2] = np.maximum.reduceat(timeseries, starts, axis=0)
+    x_plot = np.repeat((starts + stops) / 2, 2)
+
+    return x_plot, envelope
+
+
+def set_region_ticks(
+    ax: Axes,
+    labels: Union[list[str], np.ndarray],
+    scale: float = 1,
+    max_labels: int = MAX_TICK_LABELS,
+    **kwargs,
+):
+    """Label the regions on the y-axis, showing at most a given number of labels.
+
+    Parameters
+    ----------
+    ax : Axes
+        Axes to label
+    labels : Union[list[str], np.ndarray]
+        Labels of the regions (in plotting order)
+    scale : float, optional
+        Vertical space between the regions, by default 1
+    max_labels : int, optional
+        Maximum number of labels, by default MAX_TICK_LABELS
+    """
+    labels = np.asarray(labels)
+    step = int(np.ceil(labels.size / max_labels))
+    ax.set_yticks(np.arange(0, labels.size, step) * scale)
+    ax.set_yticklabels(labels[::step], **kwargs)
 
 
 def plot_timeseries_carpet(
@@ -132,17 +237,19 @@ def plot_timeseries_carpet(
             fontsize=LABELSIZE,
         )
 
+    # The carpet is averaged down to the pixel budget and drawn as a raster image
     image = ax_carpet.imshow(
-        timeseries.T[sorting_index],
+        block_average(np.asarray(timeseries).T[sorting_index], MAX_CARPET_SHAPE[::-1]),
         cmap="binary_r",
         aspect="auto",
         interpolation="antialiased",
+        extent=(-0.5, n_timepoints - 0.5, n_area - 0.5, -0.5),
+        rasterized=True,
     )
     cbar = plt.colorbar(image, pad=0, aspect=40)
     cbar.ax.tick_params(labelsize=LABELSIZE)
 
-    ax_net.set_yticks(np.arange(n_area))
-    ax_net.set_yticklabels(labels)
+    set_region_ticks(ax_net, labels)
     ax_net.tick_params(bottom=False, labelbottom=False, labelsize=LABELSIZE)
     ax_carpet.set_xlabel("time", fontsize=LABELSIZE)
     ax_carpet.tick_params(left=False, labelleft=False, labelsize=LABELSIZE)
@@ -231,12 +338,24 @@ def plot_timeseries_signal(
             fontsize=LABELSIZE,
         )
 
-    x_plot = np.arange(n_timepoints)
-    for i, (roi_signal, col) in enumerate(zip(timeseries.T[sorting_index], colors)):
-        ax.plot(x_plot, i * vert_scale + roi_signal, color=col, linewidth=linewidth)
+    # All the signals are drawn as a single collection of (reduced) lines, which
+    # is rasterized when too many points would be drawn as vectors
+    x_plot, signals = signal_envelope(np.asarray(timeseries)[:, sorting_index])
+    offsets = np.arange(n_area) * vert_scale
+    segments = np.stack(
+        np.broadcast_arrays(x_plot[:, np.newaxis], signals + offsets), axis=-1
+    )
+    ax.add_collection(
+        LineCollection(
+            segments.swapaxes(0, 1),
+            colors=colors,
+            linewidths=linewidth,
+            rasterized=segments.shape[0] * segments.shape[1] > MAX_VECTOR_POINTS,
+        )
+    )
+    ax.autoscale_view()
 
-    ax.set_yticks(np.arange(n_area) * vert_scale)
-    ax.set_yticklabels(labels, fontsize=LABELSIZE)
+    set_region_ticks(ax, labels, scale=vert_scale, fontsize=LABELSIZE)
     ax.set_xlabel("time", fontsize=LABELSIZE)
 
     ax.grid(visible=True, axis="y")
@@ -467,6 +586,9 @@ def group_report_fc_dist(
 ) -> None:
     """Plot and save the functional connectivity density distributions.
 
+    The matrices are binned one at a time, so only their histograms are kept in
+    memory.
+
     Parameters
     ----------
     fc_matrices : list[np.ndarray]
@@ -474,59 +596,81 @@ def group_report_fc_dist(
     output : str
         Path to the output directory
     """
+    upper_triangle_indices = np.triu_indices(fc_matrices[0].shape[0], k=1)
+    bins = histogram_bins(fc_matrices[0][upper_triangle_indices])
 
-    _, ax = plt.subplots(figsize=FC_FIGURE_SIZE)
-
-    for fc_matrix in fc_matrices:
-        sns.displot(
-            fc_matrix,
-            kind="kde",
-            fill=True,
-            linewidth=0.5,
-            legend=False,
-            palette="ch:s=.25,rot=-.25",
-        )
-
-    ax.tick_params(labelsize=LABELSIZE)
-
-    # Ensure the labels are within the figure
-    plt.tight_layout()
-
-    savename = op.join("reportlets", "group_desc-fcdist_bold.svg")
-
-    logging.debug("Saving functional connectivity distribution visual report at:")
-    logging.debug(f"\t{op.join(output, savename)}")
+    fc_counts = np.empty((len(fc_matrices), len(bins) - 1), dtype=np.int64)
+    for i, fc_matrix in enumerate(fc_matrices):
+        fc_counts[i] = edge_histograms(fc_matrix[upper_triangle_indices], bins)
 
-    plt.savefig(op.join(output, savename))
-    plt.close()
+    group_reportlet_fc_dist(fc_counts, bins, output)
 
 
 def group_reportlet_fc_dist(
-    fc_matrices: list[np.ndarray],
+    fc_counts: np.ndarray,
+    bins: np.ndarray,
     output: str,
 ) -> None:
     """Plot and save the functional connectivity density distributions.
 
+    The density of each session and the group envelope (range and median of the
+    densities) are drawn from the binned counts, so the cost of the figure does
+    not depend on the number of edges.
+
     Parameters
     ----------
-    fc_matrices : list[np.ndarray]
-        List of functional connectivity matrices
+    fc_counts : np.ndarray
+        Histogram counts of the edges of each session, of shape
+        (n_sessions, len(bins) - 1)
+    bins : np.ndarray
+        Edges of the histogram bins
     output : str
         Path to the output directory
     """
+    centers = (bins[:-1] + bins[1:]) / 2
+    fc_counts = np.asarray(fc_counts, dtype=float)
+    densities = fc_counts / (
+        fc_counts.sum(axis=1, keepdims=True).clip(min=1) * np.diff(bins)
+    )
+
+    # Only the range where any session has edges is shown
+    nonzero = np.flatnonzero(fc_counts.sum(axis=0))
+    shown = slice(nonzero[0], nonzero[-1] + 1) if nonzero.size else slice(None)
+    centers, densities = centers[shown], densities[:, shown]
 
     _, ax = plt.subplots(figsize=FC_FIGURE_SIZE)
 
-    for fc_matrix in fc_matrices:
-        sns.displot(
-            fc_matrix,
-            kind="kde",
-            fill=True,
-            linewidth=0.5,
-            legend=False,
-            palette="ch:s=.25,rot=-.25",
+    ax.fill_between(
+        centers,
+        densities.min(axis=0),
+        densities.max(axis=0),
+        color=sns.color_palette("ch:s=.25,rot=-.25")[2],
+        alpha=0.4,
+        linewidth=0,
+        label="Group range",
+    )
+    ax.add_collection(
+        LineCollection(
+            np.stack(
+                [np.broadcast_to(centers, densities.shape), densities], axis=-1
+            ),
+            colors=sns.color_palette("ch:s=.25,rot=-.25")[4],
+            linewidths=0.5,
+            alpha=0.5,
         )
+    )
+    ax.plot(
+        centers,
+        np.median(densities, axis=0),
+        color="black",
+        linewidth=3,
+        label="Group median",
+    )
+    ax.autoscale_view()
 
+    ax.set_xlabel("Functional connectivity", fontsize=LABELSIZE + 2)
+    ax.set_ylabel("Density", fontsize=LABELSIZE + 2)
+    ax.legend(fontsize=LABELSIZE)
     ax.tick_params(labelsize=LABELSIZE)
 
     # Ensure the labels are within the figure
@@ -542,28 +686,30 @@ def group_reportlet_fc_dist(
 
 
 def group_reportlet_qc_fc(
-    fc_matrices: list[np.ndarray],
+    fc_matrices: Union[list[np.ndarray], np.ndarray],
     iqms_df: pd.DataFrame,
     output: str,
+    qc_fcs: Optional[np.ndarray] = None,
 ) -> dict:
     """Plot and save the QC-FC distributions.
 
     Parameters
     ----------
-    fc_matrices : list[np.ndarray]
-        List of functional connectivity matrices
+    fc_matrices : Union[list[np.ndarray], np.ndarray]
+        List of functional connectivity matrices (or their stacked upper triangles
+        of shape (n_edges, n_subjects))
     iqms_df : pd.Dataframe
         Dataframe containing the image quality metrics to correlate with
     output : str
         Path to the output directory
+    qc_fcs : Optional[np.ndarray], optional
+        Precomputed QC-FC correlations of shape (n_edges, n_iqms) (e.g., from the
+        running statistics of the group store), by default None
     """
 
-    # Stack the list of arrays into a 3D matrix
-    fc_matrices = np.stack(fc_matrices, axis=2)
-
-    # Keep only upper triangle as the matrix is symmetric
-    upper_triangle_indices = np.triu_indices(fc_matrices.shape[0], k=1)
-    fc_matrices = fc_matrices[upper_triangle_indices]
+    # Stack the upper triangles (the matrices are symmetric) into a 2D matrix
+    if not isinstance(fc_matrices, np.ndarray):
+        fc_matrices = stack_upper_triangles(fc_matrices)
 
     if fc_matrices.shape[1] != iqms_df.shape[0]:
         raise ValueError(
@@ -575,57 +721,54 @@ def group_reportlet_qc_fc(
             "We need at least two functional connectivity matrices to be able to compute its correlation with IQMs."
         )
 
+    ## Permutation analyses
+    logging.debug("Compute QC-FC distribution under the null hypothesis.")
+    null_counts, null_bins = permutation_null_qc_fc(fc_matrices, iqms_df)
+    null_centers = (null_bins[:-1] + null_bins[1:]) / 2
+    null_width = np.diff(null_bins)
+
     fig, axs = plt.subplots(1, 3, figsize=FC_FIGURE_SIZE)
 
+    if qc_fcs is None:
+        logging.debug("Compute QC-FC correlation for each edge.")
+        qc_fcs = compute_qc_fc(fc_matrices, iqms_df)
+
     # Iterate over each IQM
     qc_fc_dict = dict()
     for i, iqm_column in enumerate(iqms_df.columns):
-        # Create an empty list to store correlations for each edge
-        qc_fcs = []
-
-        # Iterate over each edge
-        logging.debug("Compute QC-FC correlation for each edge.")
-        for e in range(fc_matrices.shape[0]):
-            qc_fc = np.corrcoef(fc_matrices[e, :], iqms_df[iqm_column])[0, 1]
-            qc_fcs.append(qc_fc)
-
         # Create a density distribution plot for the current IQM
         logging.debug("Create the density distribution plot.")
         sns.kdeplot(
-            qc_fcs, fill=True, label="QC-FC distribution", linewidth=3, ax=axs[i]
+            qc_fcs[:, i],
+            fill=True,
+            label="QC-FC distribution",
+            linewidth=3,
+            ax=axs[i],
         )
 
         # Save the QC-FC distributions in a dictionary
-        qc_fc_dict[iqm_column] = qc_fcs
-
-        ## Permutation analyses
-        logging.debug("Compute QC-FC distribution under the null hypothesis.")
-        correlations_null = []
-        for e in range(fc_matrices.shape[0]):
-            for _ in range(N_PERMUTATION):
-                permuted_fc = fc_matrices[
-                    e, np.random.default_rng(seed=42).permutation(fc_matrices.shape[1])
-                ]
-                # Correlation under null hypothesis
-                correlation = np.corrcoef(permuted_fc, iqms_df[iqm_column])[0, 1]
-                correlations_null.append(correlation)
-
-        # Create a density distribution plot for null distribution
+        qc_fc_dict[iqm_column] = qc_fcs[:, i]
+
+        logging.debug(
+            f"Null QC-FC distribution of {iqm_column}: "
+            f"{histogram_summary(null_counts[i], null_bins)}"
+        )
+
+        # Plot the density of the binned null distribution
         logging.debug("Create the density distribution plot for the null distribution.")
-        sns.kdeplot(
-            correlations_null,
-            fill=False,
+        axs[i].plot(
+            null_centers,
+            null_counts[i] / (null_counts[i].sum() * null_width),
             color="red",
             label="Dist under null hypothesis",
             linewidth=3,
             linestyle="dashed",
-            ax=axs[i],
         )
         plt.legend(fontsize=LABELSIZE + 2)
 
         # Compute percent match between the two distributions
         logging.debug("Compute percent match between the two distributions.")
-        ks_statistic, _ = ks_2samp(qc_fcs, correlations_null)
+        ks_statistic = binned_ks_statistic(qc_fcs[:, i], null_counts[i], null_bins)
         percent_match_ks = (1 - ks_statistic) * 100
 
         # Plot the box in red if the correlation is significant
@@ -659,38 +802,37 @@ def group_reportlet_qc_fc(
     return qc_fc_dict
 
 
-def compute_distance(atlas_path: str) -> np.array:
+def compute_distance(
+    atlas_path: str, atlas_cache: str = ATLAS_CACHE_DIR
+) -> np.ndarray:
     """Compute the euclidean distance between the center of mass of the atlas regions.
 
+    The centers of mass and distances are cached per atlas.
+
     Parameters
     ----------
     atlas_path : str
         Path to the atlas Nifti
+    atlas_cache : str, optional
+        Directory of the persistent atlas cache, by default ATLAS_CACHE_DIR
+
     Returns
     -------
-    np.array
-        Distance matrix
+    np.ndarray
+        Condensed distance vector (in mm), in the order of the upper triangle of
+        the distance matrix
     """
-    from scipy.ndimage.measurements import center_of_mass
-
     logging.debug("Compute distance matrix from atlas centers of mass")
 
-    atlas_img = nib.load(atlas_path)
-    atlas_data = atlas_img.get_fdata()
-    # Array to store the center of mass of each region
-    centroids = np.zeros((atlas_data.shape[3], 3), dtype=float)
-    for r in range(atlas_data.shape[3]):
-        centroids[r, ...] = np.array(center_of_mass(atlas_data[..., r]))
-
-    # Compute Euclidean distance matrix using broadcasting
-    diff = centroids[:, np.newaxis, :] - centroids
-    distance_matrix = np.sqrt(np.sum(diff**2, axis=-1))
-
-    return distance_matrix
+    _, _, distances = get_atlas_geometry(atlas_path, cache_dir=atlas_cache)
+    return distances
 
 
 def group_reportlet_qc_fc_euclidean(
-    qc_fc_dict: dict, atlas_path: str, output: str
+    qc_fc_dict: dict,
+    atlas_path: str,
+    output: str,
+    atlas_cache: str = ATLAS_CACHE_DIR,
 ) -> None:
     """Plot and save the correlations between QC-FC and euclidean distance.
     The euclidean distance is computed from the centers of mass of each region.
@@ -703,19 +845,22 @@ def group_reportlet_qc_fc_euclidean(
         Path to the atlas Nifti
     output : str
         Path to the output directory
+    atlas_cache : str, optional
+        Directory of the persistent atlas cache, by default ATLAS_CACHE_DIR
     """
-    d = compute_distance(atlas_path)
-    # Keep only upper triangle as the matrix is symmetric
-    upper_triangle_indices = np.triu_indices(d.shape[0], k=1)
-    d = d[upper_triangle_indices]
+    # Distances of the upper triangle, as the matrix is symmetric
+    d = compute_distance(atlas_path, atlas_cache=atlas_cache)
+
+    logging.debug("Compute the correlation between QC-FC and euclidean distance.")
+    qc_fc_matrix = np.column_stack(list(qc_fc_dict.values()))
+    correlations = compute_qc_fc(d[np.newaxis, :], qc_fc_matrix)[0]
+    p_values = correlation_p_value(correlations, d.size)
 
     # Iterate over the IQMs
     fig, axs = plt.subplots(1, 3, figsize=FC_FIGURE_SIZE)
     for i, iqm in enumerate(qc_fc_dict.keys()):
-        qc_fc = qc_fc_dict[iqm]
-
-        logging.debug("Compute the correlation between QC-FC and euclidean distance.")
-        correlation, p_value = pearsonr(qc_fc, d)
+        qc_fc = qc_fc_matrix[:, i]
+        correlation, p_value = correlations[i], p_values[i]
 
         # Plot the box in red if the correlation is significant
         facecolor = "red" if p_value < ALPHA else "grey"
@@ -758,19 +903,38 @@ def group_reportlet_qc_fc_euclidean(
 
 def group_report(
     good_timepoints_df: pd.DataFrame,
-    fc_matrices: list[np.ndarray],
+    fc_matrices: Union[list[np.ndarray], np.ndarray],
     iqms_df: pd.DataFrame,
     atlas_filename: str,
     output: str,
+    qc_fcs: Optional[np.ndarray] = None,
+    fc_histograms: Optional[tuple[np.ndarray, np.ndarray]] = None,
+    atlas_cache: str = ATLAS_CACHE_DIR,
 ) -> None:
-    """Generate a group report."""
+    """Generate a group report.
 
+    The connectivity is given either as a list of matrices or as their stacked
+    upper triangles of shape (n_edges, n_subjects) (e.g., from the group store,
+    together with the histograms of the edges of each session).
+    """
     # Generate each reportlets
     os.makedirs(op.join(output, "reportlets"), exist_ok=True)
     group_report_censoring(good_timepoints_df, output)
-    group_reportlet_fc_dist(fc_matrices, output)
-    qc_fc_dict = group_reportlet_qc_fc(fc_matrices, iqms_df, output)
-    group_reportlet_qc_fc_euclidean(qc_fc_dict, atlas_filename, output)
+
+    if isinstance(fc_matrices, np.ndarray):
+        fc_stack = fc_matrices
+        if fc_histograms is None:
+            bins = histogram_bins(fc_stack)
+            fc_histograms = (edge_histograms(fc_stack.T, bins), bins)
+        group_reportlet_fc_dist(*fc_histograms, output)
+    else:
+        fc_stack = stack_upper_triangles(fc_matrices)
+        group_report_fc_dist(fc_matrices, output)
+
+    qc_fc_dict = group_reportlet_qc_fc(fc_stack, iqms_df, output, qc_fcs=qc_fcs)
+    group_reportlet_qc_fc_euclidean(
+        qc_fc_dict, atlas_filename, output, atlas_cache=atlas_cache
+    )
 
     # Assemble reportlets into a single HTML report
     logging.debug("Assemble the group report into a single HTML report.")
@@ -0,0 +1,50 @@
+import importlib
+import importlib.abc
+import importlib.util
+import os.path as op
+import sys
+
+import matplotlib
+import pytest
+
+# The reports are rendered without display
+matplotlib.use("Agg")
+
+FMRI_DIR = op.dirname(op.dirname(op.abspath(__file__)))
+
+
+class SiblingModuleFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """Resolve the flat imports of the scripts (e.g., ``from load_save import``)
+    to the modules of the ``fmri`` package, so that each module is only loaded
+    once whichever way it is imported.
+    """
+
+    def find_spec(self, name, path=None, target=None):
+        if path is not None or not op.exists(op.join(FMRI_DIR, f"{name}.py")):
+            return None
+        return importlib.util.spec_from_loader(name, self)
+
+    def create_module(self, spec):
+        return importlib.import_module(f"fmri.{spec.name}")
+
+    def exec_module(self, module):
+        pass
+
+
+sys.meta_path.insert(0, SiblingModuleFinder())
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: microbenchmark, only run with ``pytest -m benchmark``"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    # The benchmarks are slow and only run when selected
+    if "benchmark" in config.getoption("markexpr"):
+        return
+    skip = pytest.mark.skip(reason="only run with pytest -m benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
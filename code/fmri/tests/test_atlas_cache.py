@@ -0,0 +1,157 @@
+import os
+import pytest
+import nibabel as nib
+import numpy as np
+import fmri.atlas_cache as fa
+
+
+def _fake_images(tmp_path):
+    rng = np.random.default_rng(seed=0)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+
+    maps = np.zeros((6, 6, 6, 3))
+    maps[:3, :, :, 0] = rng.uniform(size=(3, 6, 6))
+    maps[2:, :3, :, 1] = rng.uniform(size=(4, 3, 6))
+    maps[:, 3:, 3:, 2] = rng.uniform(size=(6, 3, 3))
+    atlas_filename = str(tmp_path / "maps.nii.gz")
+    nib.save(nib.Nifti1Image(maps, affine), atlas_filename)
+
+    bold = rng.normal(size=(6, 6, 6, 15))
+    bold_filename = str(tmp_path / "sub-1_task-rest_bold.nii.gz")
+    nib.save(nib.Nifti1Image(bold, affine), bold_filename)
+
+    return atlas_filename, bold_filename, maps, bold
+
+
+def test_project_img(tmp_path):
+    atlas_filename, bold_filename, maps, bold = _fake_images(tmp_path)
+    cache_dir = str(tmp_path / "cache")
+
+    signals = fa.project_img(bold_filename, atlas_filename, cache_dir=cache_dir)
+    expected = np.linalg.lstsq(maps.reshape(-1, 3), bold.reshape(-1, 15), rcond=None)
+    assert np.allclose(signals, expected[0].T)
+
+    # The operator is stored once and reused
+    entries = os.listdir(cache_dir)
+    assert len(entries) == 1
+    fa.project_img(bold_filename, atlas_filename, cache_dir=cache_dir)
+    assert os.listdir(cache_dir) == entries
+
+    voxels, operator = fa.get_atlas_projection(
+        atlas_filename, np.diag([2.0, 2.0, 2.0, 1.0]), (6, 6, 6), cache_dir
+    )
+    assert isinstance(operator, np.memmap)
+    assert operator.shape == (3, voxels.size)
+
+
+def test_project_img_float32(tmp_path):
+    atlas_filename, bold_filename, _, _ = _fake_images(tmp_path)
+    cache_dir = str(tmp_path / "cache")
+
+    expected = fa.project_img(bold_filename, atlas_filename, cache_dir=cache_dir)
+    for chunk_mb in [None, 0.01]:
+        signals = fa.project_img(
+            bold_filename,
+            atlas_filename,
+            cache_dir=cache_dir,
+            chunk_mb=chunk_mb,
+            dtype=np.float32,
+        )
+        assert signals.dtype == np.float32
+        assert np.allclose(signals, expected, atol=1e-5)
+
+    # The single precision operator is stored next to the double precision one
+    (entry,) = os.listdir(cache_dir)
+    assert "operator.float32.npy" in os.listdir(os.path.join(cache_dir, entry))
+
+    signals = fa.transform_cached(
+        [bold_filename], atlas_filename, cache_dir=cache_dir, dtype=np.float32
+    )
+    assert signals[0].dtype == np.float32
+
+
+def test_transform_cached(tmp_path):
+    from nilearn.maskers import NiftiMapsMasker
+
+    atlas_filename, bold_filename, _, _ = _fake_images(tmp_path)
+    confounds = np.random.default_rng(seed=1).normal(size=(15, 2))
+
+    signals = fa.transform_cached(
+        [bold_filename],
+        atlas_filename,
+        confounds=[confounds],
+        cache_dir=str(tmp_path / "cache"),
+        standardize="zscore_sample",
+    )
+
+    masker = NiftiMapsMasker(atlas_filename, standardize="zscore_sample")
+    expected = masker.fit_transform(bold_filename, confounds=confounds)
+    assert np.allclose(signals[0], expected)
+
+
+def test_transform_cached_multi_atlas(tmp_path):
+    atlas_filename, bold_filename, maps, _ = _fake_images(tmp_path)
+    other_filename = str(tmp_path / "other_maps.nii.gz")
+    nib.save(
+        nib.Nifti1Image(maps[..., :2], np.diag([2.0, 2.0, 2.0, 1.0])), other_filename
+    )
+    cache_dir = str(tmp_path / "cache")
+
+    signals = fa.transform_cached(
+        [bold_filename, bold_filename],
+        [atlas_filename, other_filename],
+        cache_dir=cache_dir,
+    )
+    assert len(signals) == 2
+    for filename, atlas_signals in zip([atlas_filename, other_filename], signals):
+        expected = fa.transform_cached([bold_filename], filename, cache_dir=cache_dir)
+        assert len(atlas_signals) == 2
+        assert np.allclose(atlas_signals[1], expected[0])
+
+
+@pytest.mark.parametrize("chunk_mb", [1e-6, 0.01, 512])
+def test_project_img_chunked(tmp_path, chunk_mb):
+    atlas_filename, bold_filename, _, bold = _fake_images(tmp_path)
+    cache_dir = str(tmp_path / "cache")
+
+    chunks = list(fa.iter_volume_chunks(bold_filename, chunk_mb))
+    assert np.array_equal(
+        np.concatenate([data for _, data in chunks], axis=1),
+        bold.reshape((-1, 15), order="F"),
+    )
+
+    signals = fa.project_img(
+        bold_filename, [atlas_filename], cache_dir=cache_dir, chunk_mb=chunk_mb
+    )
+    expected = fa.project_img(bold_filename, [atlas_filename], cache_dir=cache_dir)
+    assert np.allclose(signals[0], expected[0])
+
+
+def test_get_atlas_geometry(tmp_path):
+    from scipy.ndimage import center_of_mass
+    from scipy.spatial.distance import squareform
+
+    atlas_filename, _, maps, _ = _fake_images(tmp_path)
+    cache_dir = str(tmp_path / "cache")
+
+    expected = np.array([center_of_mass(maps[..., r]) for r in range(3)])
+    for chunk_mb in [1e-6, 512]:
+        centroids, centroids_world = fa.compute_centroids(atlas_filename, chunk_mb)
+        assert np.allclose(centroids, expected)
+        assert np.allclose(centroids_world, 2 * expected)
+
+    centroids, centroids_world, distances = fa.get_atlas_geometry(
+        atlas_filename, cache_dir=cache_dir
+    )
+    assert np.allclose(centroids, expected)
+    distance_matrix = np.linalg.norm(
+        centroids_world[:, np.newaxis] - centroids_world, axis=-1
+    )
+    assert np.allclose(squareform(distances), distance_matrix)
+    assert np.allclose(distances, distance_matrix[np.triu_indices(3, k=1)])
+
+    # The geometry is stored once and reused
+    entries = os.listdir(cache_dir)
+    assert len(entries) == 1
+    fa.get_atlas_geometry(atlas_filename, cache_dir=cache_dir)
+    assert os.listdir(cache_dir) == entries
@@ -0,0 +1,164 @@
+import warnings
+
+import pytest
+import numpy as np
+from sklearn.exceptions import ConvergenceWarning
+import fmri.connectivity as fc
+
+
+@pytest.mark.parametrize("kind", ["correlation", "covariance"])
+def test_batched_connectivity(kind):
+    from nilearn.connectome import ConnectivityMeasure
+    from sklearn.covariance import LedoitWolf
+
+    rng = np.random.default_rng(seed=0)
+    mixing = rng.normal(size=(6, 6))
+    time_series = [
+        rng.normal(size=(n_timepoints, 6)) @ mixing
+        for n_timepoints in [40, 40, 25, 40, 25]
+    ]
+
+    connectivity = fc.batched_connectivity(
+        time_series, connectivity_kind=kind, dtype=np.float64, batch_size=2
+    )
+
+    expected = ConnectivityMeasure(
+        cov_estimator=LedoitWolf(store_precision=False), kind=kind
+    ).fit_transform(time_series)
+    diagonal = np.arange(6)
+    expected[:, diagonal, diagonal] = 0
+    # In double precision, the baseline is reproduced up to rounding errors
+    assert connectivity.dtype == np.float64
+    assert np.allclose(connectivity, expected, rtol=1e-12, atol=1e-12)
+
+    out = np.zeros((5, 6, 6), dtype=np.float32)
+    fc.batched_connectivity(time_series, connectivity_kind=kind, out=out)
+    assert np.allclose(out, expected, atol=1e-5 * np.abs(expected).max())
+
+    with pytest.raises(ValueError):
+        fc.batched_connectivity(time_series, connectivity_kind="precision")
+
+
+def test_sparse_precision():
+    from nilearn.connectome import ConnectivityMeasure
+    from sklearn.covariance import GraphicalLassoCV
+
+    rng = np.random.default_rng(seed=0)
+    mixing = np.eye(8) + 0.3 * rng.normal(size=(8, 8))
+    time_series = [rng.normal(size=(120, 8)) @ mixing for _ in range(3)]
+
+    # Runs on their own reproduce GraphicalLassoCV
+    precision, convergence = fc.sparse_precision(
+        time_series, n_alphas=3, n_refinements=2, dtype=np.float64
+    )
+    estimator = GraphicalLassoCV(alphas=3, n_refinements=2)
+    expected = ConnectivityMeasure(
+        cov_estimator=estimator, kind="precision"
+    ).fit_transform(time_series)
+    diagonal = np.arange(8)
+    expected[:, diagonal, diagonal] = 0
+    assert precision.dtype == np.float64
+    assert np.allclose(precision, expected, atol=1e-6 * np.abs(expected).max())
+    assert all(record["n_iter"] > 0 for record in convergence)
+
+    # Runs of a participant share their grid, and all runs share one alpha
+    _, convergence = fc.sparse_precision(
+        time_series, groups=["a", "a", "b"], n_alphas=3, n_refinements=2,
+        shared_alpha=True, n_jobs=2,
+    )
+    assert len({record["alpha"] for record in convergence}) == 1
+
+
+def test_sparse_precision_warm_start():
+    from sklearn.covariance import empirical_covariance, graphical_lasso
+
+    # Runs of a participant with very different variances
+    rng = np.random.default_rng(seed=3)
+    time_series = []
+    for _ in range(2):
+        mixing = np.eye(12) + 0.4 * rng.normal(size=(12, 12))
+        time_series += [
+            rng.normal(size=(90, 12)) @ mixing * rng.uniform(0.2, 5, size=12)
+            for _ in range(3)
+        ]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", ConvergenceWarning)
+        precision, convergence = fc.sparse_precision(
+            time_series, groups=[0, 0, 0, 1, 1, 1], dtype=np.float64
+        )
+
+        # Warm starts give the solution of a cold start at the selected alpha
+        assert np.all(np.isfinite(precision))
+        diagonal = np.arange(12)
+        for ts, run_precision, record in zip(time_series, precision, convergence):
+            covariance, _ = graphical_lasso(
+                empirical_covariance(ts), record["alpha"]
+            )
+            expected = np.linalg.inv(covariance)
+            expected[diagonal, diagonal] = 0
+            assert np.allclose(
+                run_precision, expected, atol=1e-6 * np.abs(expected).max()
+            )
+
+
+@pytest.mark.parametrize("window,step", [(20, 3), (20, 12), (10, 25)])
+@pytest.mark.parametrize("taper", [None, "hann"])
+def test_sliding_window_connectivity(window, step, taper):
+    rng = np.random.default_rng(seed=0)
+    time_series = rng.normal(size=(100, 5)).cumsum(axis=0)
+
+    connectivity = fc.sliding_window_connectivity(
+        time_series, window, step, taper=taper, dtype=np.float64
+    )
+
+    onsets = fc.sliding_window_onsets(100, window, step)
+    assert connectivity.shape == (len(onsets), 10)
+    weights = np.ones(window)
+    if taper is not None:
+        from scipy.signal import get_window
+
+        weights = get_window(taper, window, fftbins=False)
+    upper_triangle_indices = np.triu_indices(5, k=1)
+    for onset, window_connectivity in zip(onsets, connectivity):
+        expected = np.cov(
+            time_series[onset : onset + window], rowvar=False, aweights=weights
+        )
+        std = np.sqrt(np.diag(expected))
+        expected /= np.outer(std, std)
+        assert np.allclose(window_connectivity, expected[upper_triangle_indices])
+
+    with pytest.raises(ValueError):
+        fc.sliding_window_onsets(100, 1, 1)
+
+
+def test_sliding_window_connectivity_censored():
+    rng = np.random.default_rng(seed=0)
+    time_series = rng.normal(size=(100, 5)).cumsum(axis=0)
+    sample_mask = np.setdiff1d(np.arange(100), [30, 31, 97])
+
+    # The windows slide over all the volumes of the run
+    connectivity = fc.sliding_window_connectivity(
+        time_series[sample_mask],
+        20,
+        5,
+        dtype=np.float64,
+        sample_mask=sample_mask,
+        n_timepoints=100,
+    )
+    expected = fc.sliding_window_connectivity(time_series, 20, 5, dtype=np.float64)
+    assert connectivity.shape == expected.shape
+
+    # Windows containing censored volumes are NaN, the other windows are those
+    # of the uncensored run (up to its centering)
+    censored = np.isnan(connectivity).all(axis=1)
+    onsets = fc.sliding_window_onsets(100, 20, 5)
+    assert np.array_equal(
+        censored, ((onsets <= 31) & (onsets + 20 > 30)) | (onsets + 20 > 97)
+    )
+    assert np.allclose(connectivity[~censored], expected[~censored])
+
+    with pytest.raises(ValueError):
+        fc.sliding_window_connectivity(
+            time_series[sample_mask], 20, 5, sample_mask=sample_mask
+        )
@@ -0,0 +1,54 @@
+import pytest
+import numpy as np
+import fmri.denoising as fd
+
+
+@pytest.mark.parametrize("low_pass", [None, 0.1])
+def test_interpolate_and_clean(low_pass):
+    from nilearn.signal import clean
+    from scipy.interpolate import CubicSpline
+
+    rng = np.random.default_rng(seed=0)
+    t_r = 2.0
+    shapes = [(60, 4, 3), (60, 4, 3), (45, 4, 3), (60, 4, 3), (60, 4, 2)]
+    time_series = [rng.normal(size=(n, r)).cumsum(axis=0) for n, r, _ in shapes]
+    confounds = [rng.normal(size=(n, k)) for n, _, k in shapes]
+    # Linearly dependent confounds are discarded by the regression
+    confounds[1][:, 2] = confounds[1][:, 0] + confounds[1][:, 1]
+    sample_mask = [
+        np.setdiff1d(np.arange(60), [0, 10, 11, 30]),
+        None,
+        np.setdiff1d(np.arange(45), [44]),
+        np.setdiff1d(np.arange(60), [0, 10, 11, 30]),
+        np.setdiff1d(np.arange(60), [5]),
+    ]
+
+    denoised, interpolated, interpolated_confounds = fd.interpolate_and_clean(
+        time_series, confounds, sample_mask, t_r=t_r, low_pass=low_pass, batch_size=2
+    )
+
+    for ts, conf, sm, denoised_ts, interpolated_ts, interpolated_conf in zip(
+        time_series,
+        confounds,
+        sample_mask,
+        denoised,
+        interpolated,
+        interpolated_confounds,
+    ):
+        expected = np.hstack([ts, conf])
+        if sm is not None:
+            frame_times = np.arange(ts.shape[0]) * t_r
+            censored = np.setdiff1d(np.arange(ts.shape[0]), sm)
+            spline = CubicSpline(frame_times[sm], expected[sm])
+            expected[censored] = spline(frame_times[censored])
+        assert np.allclose(interpolated_ts, expected[:, : ts.shape[1]])
+        assert np.allclose(interpolated_conf, expected[:, ts.shape[1] :])
+
+        expected_ts = clean(
+            expected[:, : ts.shape[1]],
+            confounds=expected[:, ts.shape[1] :],
+            standardize="zscore_sample",
+            low_pass=low_pass,
+            t_r=t_r,
+        )
+        assert np.allclose(denoised_ts, expected_ts)
@@ -0,0 +1,222 @@
+import json
+import os.path as op
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+import fmri.funconn as fc
+from fmri.load_save import (
+    FC_FILLS,
+    FC_PATTERN,
+    TIMESERIES_FILLS,
+    TIMESERIES_PATTERN,
+    get_output_fills,
+    save_output,
+)
+
+
+def test_render_reports(tmp_path):
+    func_dir = tmp_path / "fmriprep" / "sub-01" / "ses-1" / "func"
+    func_dir.mkdir(parents=True)
+    filename = str(
+        func_dir / "sub-01_ses-1_task-rest_space-MNI152NLin2009cAsym_desc-preproc_"
+        "bold.nii.gz"
+    )
+    open(filename, "w").close()
+
+    rng = np.random.default_rng(seed=0)
+    motion = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+    pd.DataFrame(rng.normal(size=(50, 6)), columns=motion).to_csv(
+        func_dir / "sub-01_ses-1_task-rest_desc-confounds_timeseries.tsv",
+        sep="\t",
+        index=False,
+    )
+    (func_dir / "sub-01_ses-1_task-rest_desc-confounds_timeseries.json").write_text(
+        "{}"
+    )
+
+    # The outputs are saved by the extraction stage...
+    output = str(tmp_path / "output")
+    labels = pd.Series([f"region {i}" for i in range(8)])
+    time_series = rng.normal(size=(50, 8))
+    save_output(
+        [time_series],
+        [filename],
+        output,
+        patterns=TIMESERIES_PATTERN,
+        **get_output_fills(TIMESERIES_FILLS, "npy"),
+    )
+    save_output(
+        [np.corrcoef(time_series, rowvar=False)],
+        [filename],
+        output,
+        patterns=FC_PATTERN,
+        meas="correlation",
+        **get_output_fills(FC_FILLS, "npy"),
+    )
+
+    # ...and read back from the disk by the report stage
+    settings = {
+        "output": output,
+        "output_format": "npy",
+        "denoising": {"denoising_strategy": ("motion",), "motion": "basic"},
+        "atlas_labels": labels,
+        "atlas_network": pd.Series(["network"] * 8),
+        "fc_label": "correlation",
+        "fc_fills": get_output_fills(FC_FILLS, "npy"),
+    }
+    fc.render_reports(filename, settings)
+
+    figures = sorted(
+        op.basename(path).split("_desc-")[1]
+        for path in (tmp_path / "output").glob("**/*.png")
+    )
+    assert figures == [
+        "carpetplot_bold.png",
+        "designmatrix_bold.png",
+        "heatmap_bold.png",
+        "timeseries_bold.png",
+    ]
+
+
+def _fake_derivatives(tmp_path, n_runs=2, n_timepoints=40):
+    rng = np.random.default_rng(seed=0)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    func_dir = tmp_path / "fmriprep" / "sub-01" / "func"
+    func_dir.mkdir(parents=True)
+
+    maps = rng.uniform(size=(6, 6, 6, 3)) * (rng.uniform(size=(6, 6, 6, 3)) > 0.5)
+    atlas_filename = str(tmp_path / "atlas.nii.gz")
+    nib.save(nib.Nifti1Image(maps, affine), atlas_filename)
+
+    func_filenames = []
+    for run in range(1, n_runs + 1):
+        stem = f"sub-01_task-rest_run-{run}"
+        filename = str(
+            func_dir / f"{stem}_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+        )
+        bold = rng.normal(100, 1, size=(6, 6, 6, n_timepoints)).astype("float32")
+        nib.save(nib.Nifti1Image(bold, affine), filename)
+        func_filenames.append(filename)
+
+        confounds = {
+            column: rng.normal(size=n_timepoints)
+            for column in ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+        }
+        confounds["framewise_displacement"] = np.r_[
+            np.nan, np.abs(rng.normal(0.2, 0.2, n_timepoints - 1))
+        ]
+        confounds["std_dvars"] = np.r_[
+            np.nan, np.abs(rng.normal(1, 0.2, n_timepoints - 1))
+        ]
+        pd.DataFrame(confounds).to_csv(
+            func_dir / f"{stem}_desc-confounds_timeseries.tsv",
+            sep="\t",
+            index=False,
+            na_rep="n/a",
+        )
+        (func_dir / f"{stem}_desc-confounds_timeseries.json").write_text("{}")
+
+    return func_filenames, atlas_filename
+
+
+@pytest.mark.parametrize("interpolate", [False, True])
+def test_sweep_denoising(tmp_path, interpolate):
+    func_filenames, atlas_filename = _fake_derivatives(tmp_path)
+    defaults = {
+        "denoising_strategy": ("motion", "scrub"),
+        "motion": "basic",
+        "fd_threshold": 0.4,
+        "std_dvars_threshold": 1.5,
+        "scrub": 0,
+        "low_pass": 0.1,
+        "interpolate": interpolate,
+    }
+
+    # A single configuration equal to the defaults denoises the extracted signals
+    # as the extraction does
+    ((time_series, confounds, sample_mask),) = fc.sweep_denoising(
+        func_filenames,
+        atlas_filename,
+        [defaults],
+        t_r=2.0,
+        n_jobs=1,
+        verbose=0,
+    )
+    expected = fc.extract_and_denoise_timeseries(
+        func_filenames, atlas_filename, t_r=2.0, n_jobs=1, verbose=0, **defaults
+    )
+    for ts, expected_ts in zip(time_series, expected[0]):
+        assert np.allclose(ts, expected_ts)
+    for conf, expected_conf in zip(confounds, expected[1]):
+        assert np.allclose(conf, expected_conf)
+    for sm, expected_sm in zip(sample_mask, expected[2]):
+        assert np.array_equal(sm, expected_sm)
+    # Some volumes are censored
+    assert any(len(sm) < 40 for sm in sample_mask)
+
+
+def test_get_sweep_configurations(tmp_path):
+    filename = tmp_path / "sweep.json"
+    filename.write_text(
+        json.dumps(
+            [
+                {"name": "motion", "denoising_strategy": ["motion"]},
+                {"name": "lowpass", "low_pass": 0.08, "interpolate": True},
+            ]
+        )
+    )
+    configurations = fc.get_sweep_configurations(str(filename))
+    assert [configuration["name"] for configuration in configurations] == [
+        "motion",
+        "lowpass",
+    ]
+    assert configurations[0]["denoising_strategy"] == ("motion",)
+
+    for configurations, message in [
+        ([{"name": "a"}, {"name": "a", "low_pass": 0.1}], "unique name"),
+        ([{"low_pass": 0.1}], "unique name"),
+        ([{"name": "a", "n_jobs": 2}], "Unknown parameters"),
+    ]:
+        filename.write_text(json.dumps(configurations))
+        with pytest.raises(ValueError, match=message):
+            fc.get_sweep_configurations(str(filename))
+
+
+@pytest.mark.parametrize(
+    "group_sizes, kwargs, expected",
+    [
+        # No files to process
+        ([], {}, (1, 1)),
+        ([0, 0], {}, (1, 1)),
+        # More groups than processes
+        ([1] * 10, {"n_procs": 4}, (4, 1)),
+        ([2, 0, 3], {"n_procs": 8}, (2, 3)),
+        # A single large group (and a small one)
+        ([20], {"n_procs": 8}, (1, 8)),
+        ([3], {"n_procs": 8}, (1, 3)),
+        # Each run takes 0.5 GB in double precision
+        ([4] * 4, {"n_procs": 16, "mem_gb": 2}, (4, 1)),
+        ([4] * 4, {"n_procs": 16, "mem_gb": 2, "precision": "float32"}, (4, 2)),
+        ([4] * 4, {"n_procs": 16, "mem_gb": 0.1}, (1, 1)),
+        # Unless the volumes are streamed in chunks
+        ([4] * 4, {"n_procs": 16, "mem_gb": 2, "chunk_mb": 128}, (4, 4)),
+        ([4] * 4, {"n_procs": 16, "mem_gb": 2, "chunk_mb": 1024}, (4, 1)),
+    ],
+)
+def test_split_resources(tmp_path, group_sizes, kwargs, expected):
+    # Only the headers of the runs are read
+    header = nib.Nifti1Header()
+    header.set_data_shape((64, 64, 64, 256))
+    func_filenames = []
+    for i, size in enumerate(group_sizes):
+        file_group = []
+        for j in range(size):
+            filename = str(tmp_path / f"sub-{i}_run-{j}_bold.nii")
+            with open(filename, "wb") as f:
+                header.write_to(f)
+            file_group.append(filename)
+        func_filenames.append(file_group)
+
+    assert fc.split_resources(func_filenames, **kwargs) == expected
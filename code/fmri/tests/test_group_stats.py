@@ -0,0 +1,85 @@
+import pytest
+import numpy as np
+import fmri.group_stats as gs
+
+
+@pytest.mark.parametrize("memory_mb", [1e-6, 0.01, 512])
+def test_permutation_null_qc_fc(memory_mb):
+    rng = np.random.default_rng(seed=0)
+    n_edges, n_subjects, n_iqms, n_permutation = 20, 8, 3, 50
+    fc_stack = rng.normal(size=(n_edges, n_subjects))
+    iqms = rng.normal(size=(n_subjects, n_iqms))
+
+    counts, bins = gs.permutation_null_qc_fc(
+        fc_stack, iqms, n_permutation=n_permutation, memory_mb=memory_mb
+    )
+    assert counts.shape == (n_iqms, len(bins) - 1)
+    assert (counts.sum(axis=1) == n_edges * n_permutation).all()
+
+    # Brute-force null distribution with the same permutations
+    permutations = np.random.default_rng(seed=42).permuted(
+        np.tile(np.arange(n_subjects), (n_permutation, 1)), axis=1
+    )
+    for i in range(n_iqms):
+        null = [
+            np.corrcoef(fc_stack[e], iqms[perm, i])[0, 1]
+            for perm in permutations
+            for e in range(n_edges)
+        ]
+        expected_counts, _ = np.histogram(null, bins=bins)
+        assert (np.abs(counts[i] - expected_counts) <= 1).all()
+        assert np.abs(counts[i] - expected_counts).sum() <= 2
+
+
+def test_zscore_constant():
+    data = np.array([[1.0, 2.0, 3.0], [4.0, 4.0, 4.0]])
+    standardized = gs.zscore(data, axis=1)
+    assert np.allclose(standardized[1], 0)
+    assert np.isclose(standardized[0].std(), 1)
+
+
+def test_binned_ks_statistic():
+    bins = gs.QC_FC_BINS
+    rng = np.random.default_rng(seed=0)
+    sample = rng.uniform(-0.5, 0.5, size=5000)
+
+    counts, _ = np.histogram(sample, bins=bins)
+    assert gs.binned_ks_statistic(sample, counts, bins) == pytest.approx(0)
+
+    shifted_counts, _ = np.histogram(sample + 0.5, bins=bins)
+    assert gs.binned_ks_statistic(sample, shifted_counts, bins) == pytest.approx(
+        0.5, abs=0.05
+    )
+
+    summary = gs.histogram_summary(counts, bins)
+    assert summary["n"] == sample.size
+    assert summary["mean"] == pytest.approx(sample.mean(), abs=1e-3)
+
+
+def test_compute_qc_fc():
+    from scipy.stats import pearsonr
+
+    rng = np.random.default_rng(seed=0)
+    fc_stack = rng.normal(size=(30, 12))
+    iqms = rng.normal(size=(12, 3))
+
+    qc_fc = gs.compute_qc_fc(fc_stack, iqms)
+    assert qc_fc.shape == (30, 3)
+
+    for e in range(fc_stack.shape[0]):
+        for i in range(iqms.shape[1]):
+            correlation, p_value = pearsonr(fc_stack[e], iqms[:, i])
+            assert qc_fc[e, i] == pytest.approx(correlation)
+            assert gs.correlation_p_value(qc_fc[e, i], 12) == pytest.approx(p_value)
+
+    with pytest.raises(ValueError):
+        gs.compute_qc_fc(fc_stack, iqms[:-1])
+
+
+def test_stack_upper_triangles():
+    rng = np.random.default_rng(seed=0)
+    fc_matrices = [rng.normal(size=(5, 5)) for _ in range(3)]
+
+    fc_stack = gs.stack_upper_triangles(fc_matrices)
+    expected = np.stack(fc_matrices, axis=2)[np.triu_indices(5, k=1)]
+    assert np.array_equal(fc_stack, expected)
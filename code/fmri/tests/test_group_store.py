@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+import fmri.group_stats as gs
+import fmri.group_store as gst
+
+
+def _fake_sessions(n_sessions, seed=0):
+    rng = np.random.default_rng(seed=seed)
+    fc_matrices = []
+    for _ in range(n_sessions):
+        matrix = rng.uniform(-1, 1, size=(6, 6))
+        fc_matrices.append((matrix + matrix.T) / 2)
+    iqms_df = pd.DataFrame(
+        rng.normal(size=(n_sessions, 2)), columns=["fd_mean", "fd_perc"]
+    )
+    keys = [f"sub-{seed}{i}_connectivity.tsv" for i in range(n_sessions)]
+    return keys, fc_matrices, iqms_df
+
+
+def test_group_store(tmp_path):
+    path = str(tmp_path / "group_store")
+    store = gst.GroupStore(path)
+    assert store.n_sessions == 0
+
+    first, second = _fake_sessions(5, seed=1), _fake_sessions(3, seed=2)
+    store.append(*first)
+    # Sessions are appended to the existing store
+    store = gst.GroupStore(path)
+    assert store.missing(first[0] + second[0]) == second[0]
+    store.append(*second)
+
+    fc_stack = gs.stack_upper_triangles(first[1] + second[1])
+    iqms_df = pd.concat([first[2], second[2]], ignore_index=True)
+
+    store = gst.GroupStore(path)
+    assert store.n_sessions == 8
+    assert np.array_equal(store.edges(), fc_stack)
+    pd.testing.assert_frame_equal(store.iqms(), iqms_df)
+    assert np.allclose(store.mean(), fc_stack.mean(axis=1))
+    assert np.allclose(store.variance(), fc_stack.var(axis=1))
+    assert np.allclose(store.qc_fc(), gs.compute_qc_fc(fc_stack, iqms_df))
+
+    counts, bins = store.histograms()
+    assert np.array_equal(bins, np.linspace(-1, 1, gst.FC_DIST_N_BINS + 1))
+    for i in range(store.n_sessions):
+        assert np.array_equal(counts[i], np.histogram(fc_stack[:, i], bins=bins)[0])
+
+
+def test_group_store_stale(tmp_path):
+    fc_dir = tmp_path / "fc"
+    fc_dir.mkdir()
+    keys, fc_matrices, iqms_df = _fake_sessions(3)
+    for key in keys:
+        (fc_dir / key).write_text(key)
+    signatures = {key: gst.file_signature(str(fc_dir / key)) for key in keys}
+
+    path = str(tmp_path / "group_store")
+    store = gst.GroupStore(path)
+    store.append(keys, fc_matrices, iqms_df, signatures=list(signatures.values()))
+    store = gst.GroupStore(path)
+    assert not store.stale(signatures)
+
+    # Sessions written again or removed (e.g., excluded by a filter) are stale
+    (fc_dir / keys[0]).write_text("recomputed connectivity")
+    signatures[keys[0]] = gst.file_signature(str(fc_dir / keys[0]))
+    del signatures[keys[2]]
+    assert store.stale(signatures) == [keys[0], keys[2]]
+
+    # The store is rebuilt from scratch
+    store.clear()
+    assert store.n_sessions == 0
+    assert gst.GroupStore(path).n_sessions == 0
+    store.append(keys[:2], fc_matrices[:2], iqms_df.iloc[:2])
+    store = gst.GroupStore(path)
+    assert store.n_sessions == 2
+    assert store.edges().shape == (15, 2)
+
+    # Sessions appended without signatures are always stale
+    assert store.stale(signatures) == keys[:2]
+
+
+def test_group_store_interrupted(tmp_path):
+    path = str(tmp_path / "group_store")
+    store = gst.GroupStore(path)
+    store.append(*_fake_sessions(4))
+
+    # Edges written without their statistics are discarded
+    with open(tmp_path / "group_store" / gst.EDGES_FILE, "ab") as f:
+        f.write(np.zeros(store.n_edges).tobytes())
+
+    store = gst.GroupStore(path)
+    assert store.n_sessions == 4
+    assert store.edges().shape == (15, 4)
+
+
+def test_edge_histograms():
+    edges = np.array([[-3.0, -1.0, 0.0, 0.5, np.nan], [2.0, 2.0, 3.5, 4.0, 4.0]])
+    bins = gst.histogram_bins(edges, n_bins=4)
+    assert np.array_equal(bins, [-8, -4, 0, 4, 8])
+
+    # Out-of-range values fall in the outermost bins and NaNs are ignored
+    counts = gst.edge_histograms(edges, np.array([-1.0, 0.0, 1.0]))
+    assert np.array_equal(counts, [[2, 2], [0, 5]])
+    counts = gst.edge_histograms(edges, bins)
+    assert np.array_equal(counts, [[0, 2, 2, 0], [0, 0, 3, 2]])
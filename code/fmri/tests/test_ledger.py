@@ -0,0 +1,189 @@
+import os
+import fmri.funconn as fc
+import fmri.ledger as fl
+from fmri.load_save import FC_FILLS, TIMESERIES_FILLS, get_output_fills
+
+
+def test_file_hash(tmp_path):
+    connection = fl.open_ledger(":memory:")
+    filename = tmp_path / "sub-1_bold.nii.gz"
+    filename.write_bytes(b"bold")
+
+    digest = fl.file_hash(connection, str(filename))
+    assert fl.file_hash(connection, str(filename)) == digest
+
+    filename.write_bytes(b"other bold")
+    assert fl.file_hash(connection, str(filename)) != digest
+
+    # Without hashing the content, only the stored hashes are given
+    assert fl.file_hash(connection, str(filename), hash_content=False) is not None
+    filename.write_bytes(b"modified bold")
+    assert fl.file_hash(connection, str(filename), hash_content=False) is None
+    assert fl.inputs_hash(connection, [str(filename)], hash_content=False) is None
+
+    # Missing inputs (e.g., confounds files) are hashed as empty
+    assert fl.inputs_hash(connection, [str(filename), None]) == fl.inputs_hash(
+        connection, [str(filename), str(tmp_path / "missing.tsv")]
+    )
+
+
+def test_find_outdated(tmp_path):
+    connection = fl.open_ledger(str(tmp_path / "ledger.sqlite"))
+    inputs = [str(tmp_path / f"sub-{i}_bold.nii.gz") for i in range(3)]
+    outputs = {filename: f"{filename}.tsv" for filename in inputs}
+    for filename in inputs:
+        with open(filename, "w") as f:
+            f.write(filename)
+
+    input_hashes = {
+        filename: fl.inputs_hash(connection, [filename]) for filename in inputs
+    }
+    params_hash = fl.hash_parameters({"low_pass": 0.08, "strategy": ("motion",)})
+    assert fl.hash_parameters({"strategy": ["motion"], "low_pass": 0.08}) == (
+        params_hash
+    )
+
+    # Outputs are missing
+    assert fl.find_outdated(
+        connection, "timeseries", params_hash, input_hashes, outputs
+    ) == inputs
+
+    # Unrecorded existing outputs are adopted (only recorded if asked to)
+    for filename in inputs:
+        with open(outputs[filename], "w") as f:
+            f.write("output")
+    assert not fl.find_outdated(
+        connection, "timeseries", params_hash, input_hashes, outputs, adopt=False
+    )
+    assert not connection.execute("SELECT * FROM outputs").fetchall()
+    assert not fl.find_outdated(
+        connection, "timeseries", params_hash, input_hashes, outputs
+    )
+    assert len(connection.execute("SELECT * FROM outputs").fetchall()) == 3
+
+    # Other parameters
+    other_hash = fl.hash_parameters({"low_pass": None, "strategy": ("motion",)})
+    assert len(
+        fl.find_outdated(connection, "timeseries", other_hash, input_hashes, outputs)
+    ) == len(inputs)
+
+    fl.record_outputs(connection, "timeseries", params_hash, input_hashes, outputs)
+    assert not fl.find_outdated(
+        connection, "timeseries", params_hash, input_hashes, outputs
+    )
+
+    # Modified or deleted inputs
+    with open(inputs[0], "a") as f:
+        f.write("modified")
+    os.remove(outputs[inputs[2]])
+    input_hashes = {
+        filename: fl.inputs_hash(connection, [filename]) for filename in inputs
+    }
+    assert fl.find_outdated(
+        connection, "timeseries", params_hash, input_hashes, outputs
+    ) == [inputs[0], inputs[2]]
+
+    # Inputs that were not hashed are only outdated if their output is missing
+    input_hashes[inputs[0]] = input_hashes[inputs[2]] = None
+    assert fl.find_outdated(
+        connection, "timeseries", params_hash, input_hashes, outputs
+    ) == [inputs[2]]
+
+
+def test_merge_shard_ledgers(tmp_path):
+    filename = str(tmp_path / "ledger.sqlite")
+    connection = fl.open_ledger(filename)
+    fl.record_outputs(
+        connection,
+        "timeseries",
+        "params",
+        {"sub-0_bold": "hash"},
+        {"sub-0_bold": "ts0"},
+    )
+    connection.close()
+
+    # Each shard starts from the shared ledger and records its own outputs
+    for i in (1, 2):
+        shard_filename = str(tmp_path / f"ledger_shard-{i}.sqlite")
+        shard = fl.open_shard_ledger(filename, shard_filename)
+        assert shard.execute("SELECT COUNT(*) FROM outputs").fetchone()[0] == 1
+        fl.record_outputs(
+            shard,
+            "timeseries",
+            "params",
+            {f"sub-{i}_bold": "hash"},
+            {f"sub-{i}_bold": f"ts{i}"},
+        )
+        shard.close()
+
+    connection = fl.open_ledger(filename)
+    for i in (1, 2):
+        fl.merge_ledger(connection, str(tmp_path / f"ledger_shard-{i}.sqlite"))
+    outputs = connection.execute("SELECT output_path FROM outputs").fetchall()
+    assert sorted(os.path.basename(output) for (output,) in outputs) == [
+        "ts0",
+        "ts1",
+        "ts2",
+    ]
+
+
+def test_plan_ledger(tmp_path):
+    connection = fl.open_ledger(str(tmp_path / "ledger.sqlite"))
+    atlas = tmp_path / "atlas.nii.gz"
+    atlas.write_bytes(b"atlas")
+    inputs = [str(tmp_path / f"sub-{i}_task-rest_bold.nii.gz") for i in range(2)]
+    for filename in inputs:
+        with open(filename, "w") as f:
+            f.write(filename)
+
+    settings = {
+        "atlas_filename": str(atlas),
+        "denoising": {"denoising_strategy": ("motion",), "motion": "basic"},
+        "output_format": "npy",
+        "fc_label": "correlation",
+        "shared_alpha": False,
+        "dynamic": None,
+        "output": str(tmp_path / "output"),
+        "timeseries_fills": get_output_fills(TIMESERIES_FILLS, "npy"),
+        "fc_fills": get_output_fills(FC_FILLS, "npy"),
+    }
+    entries = fc.get_ledger_entries(connection, inputs, settings)["timeseries"]
+    input_hashes = {
+        filename: fl.inputs_hash(connection, [filename]) for filename in inputs
+    }
+    output_paths = entries["output_paths"]
+    os.makedirs(os.path.dirname(output_paths[inputs[0]]), exist_ok=True)
+    with open(output_paths[inputs[0]], "w") as f:
+        f.write("output")
+    fl.record_outputs(
+        connection,
+        "timeseries",
+        entries["params_hash"],
+        {inputs[0]: input_hashes[inputs[0]]},
+        output_paths,
+    )
+
+    # Planning with a modified atlas neither hashes it nor writes the ledger...
+    atlas.write_bytes(b"other atlas")
+    files = connection.execute("SELECT * FROM files ORDER BY path").fetchall()
+    entries = fc.get_ledger_entries(connection, inputs, settings, hash_content=False)
+    assert all(entry["params_hash"] is None for entry in entries.values())
+    input_hashes = {
+        filename: fl.inputs_hash(connection, [filename], hash_content=False)
+        for filename in inputs
+    }
+    # ...and its existing outputs are unknown rather than stale
+    assert fl.find_outdated(
+        connection,
+        "timeseries",
+        entries["timeseries"]["params_hash"],
+        input_hashes,
+        entries["timeseries"]["output_paths"],
+        adopt=False,
+    ) == [inputs[1]]
+    assert connection.execute("SELECT * FROM files ORDER BY path").fetchall() == files
+
+    # Whereas the actual run hashes the modified atlas
+    entries = fc.get_ledger_entries(connection, inputs, settings)
+    assert entries["timeseries"]["params_hash"] is not None
+    assert connection.execute("SELECT * FROM files ORDER BY path").fetchall() != files
@@ -48,6 +48,85 @@ def test_find_mriqc(
     assert mriqc_path == op.join(derivative_path, mriqc_name)
 
 
+@pytest.mark.parametrize(
+    "filename",
+    [
+        "/data/sub-001/ses-003/func/sub-001_ses-003_task-rest_run-2_space-MNI_"
+        "desc-preproc_bold.nii.gz",
+        "/data/sub-1/func/sub-1_task-bht_acq-a_part-mag_desc-preproc_bold.nii.gz",
+        "/data/sub-1/func/sub-1_desc-preproc_bold.nii.gz",
+    ],
+)
+@pytest.mark.parametrize(
+    ("patterns", "fills"),
+    [
+        (fl.TIMESERIES_PATTERN, fl.TIMESERIES_FILLS),
+        (fl.TIMESERIES_PATTERN, {"desc": "denoised", "extension": ".npy"}),
+        (fl.FC_PATTERN, fl.FC_FILLS | {"meas": "correlation"}),
+        (fl.CONFOUND_PATTERN, fl.CONFOUND_FILLS),
+        (["sub-{subject}[_run-{run}]_{suffix}.{extension}"], {"extension": ".png"}),
+        (["sub-{subject}_task-{task}_{suffix}{extension}", fl.FC_PATTERN[0]], {}),
+        (["sub-{subject}_{suffix<bold>|bold}{extension}"], {}),
+    ],
+)
+def test_bids_path_builder(filename, patterns, fills):
+    from bids.layout import parse_file_entities
+    from bids.layout.writing import build_path
+
+    entities = parse_file_entities(filename) | fills
+    expected = build_path(entities, patterns)
+
+    builder = fl.BIDSPathBuilder()
+    assert builder.build(filename, patterns, **fills) == expected
+    # Cached entities and patterns give the same path
+    assert builder.build(filename, patterns, **fills) == expected
+
+
+@pytest.mark.benchmark
+def test_bids_path_builder_benchmark(n_files=10000):
+    """Time the BIDS path builder against PyBIDS on fMRIPrep filenames (see the
+    timings with ``pytest -m benchmark -s``).
+    """
+    from time import perf_counter
+
+    from bids.layout import parse_file_entities
+    from bids.layout.writing import build_path
+
+    filenames = [
+        f"/data/derivatives/fmriprep/sub-{i // 40:03d}/ses-{i // 4 % 10:02d}/func/"
+        f"sub-{i // 40:03d}_ses-{i // 4 % 10:02d}_task-rest_run-{i % 4 + 1}_"
+        "space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+        for i in range(n_files)
+    ]
+    fills = fl.FC_FILLS | {"meas": "correlation"}
+
+    start = perf_counter()
+    expected = [
+        build_path(parse_file_entities(filename) | fills, fl.FC_PATTERN)
+        for filename in filenames
+    ]
+    pybids_time = perf_counter() - start
+
+    # A new builder, so that its first use (parsing the entities) is timed
+    builder = fl.BIDSPathBuilder()
+    start = perf_counter()
+    paths = [builder.build(filename, fl.FC_PATTERN, **fills) for filename in filenames]
+    first_time = perf_counter() - start
+
+    start = perf_counter()
+    for filename in filenames:
+        builder.build(filename, fl.TIMESERIES_PATTERN, **fl.TIMESERIES_FILLS)
+    other_time = perf_counter() - start
+
+    print(
+        f"\n{n_files} files: parse_file_entities + build_path {pybids_time:.2f} s, "
+        f"BIDSPathBuilder {first_time:.2f} s (first use), "
+        f"{other_time:.2f} s (other pattern)"
+    )
+    assert paths == expected
+    assert first_time < pybids_time and other_time < first_time
+
+
 def test_reorder_iqms():
     iqms = {
         "bids_name": [
@@ -108,6 +187,20 @@ def test_find_atlas_dimension(path, expected_dim):
             fl.find_atlas_dimension(path)
 
 
+def test_find_atlas_maps(tmp_path, monkeypatch):
+    monkeypatch.delenv("NILEARN_SHARED_DATA", raising=False)
+    monkeypatch.setenv("NILEARN_DATA", str(tmp_path / "nilearn_data"))
+    assert fl.find_atlas_maps(64) is None
+
+    maps = tmp_path / "nilearn_data" / "difumo_atlases" / "64" / "2mm" / "maps.nii.gz"
+    maps.parent.mkdir(parents=True)
+    maps.touch()
+    assert fl.find_atlas_maps(64) == str(maps)
+    assert fl.find_atlas_maps(64, resolution_mm=3) is None
+    assert fl.find_atlas_maps(128) is None
+    assert fl.find_atlas_maps(64, data_dir=str(tmp_path)) is None
+
+
 @pytest.mark.parametrize("return_existing", [False, True])
 @pytest.mark.parametrize("return_output", [False, True])
 @pytest.mark.parametrize("fc_label", ["sparse inverse covariance", "correlation"])
@@ -181,3 +274,273 @@ def test_check_existing_output(return_existing, return_output, fc_label, tmp_pat
     for file in existing_filenames:
         (tmp_path / file).unlink()
     tmp_path.rmdir()
+
+
+@pytest.mark.parametrize("output_format", ["tsv", "npy"])
+def test_save_load_output(output_format, tmp_path):
+    import numpy as np
+
+    func_filename = ["sub-1/func/sub-1_task-rest_bold.nii.gz"]
+    data = np.random.default_rng(seed=0).normal(size=(20, 4))
+    fills = fl.get_output_fills(fl.TIMESERIES_FILLS, output_format)
+
+    saved_paths = fl.save_output(
+        [data],
+        func_filename,
+        str(tmp_path),
+        patterns=fl.TIMESERIES_PATTERN,
+        **fills,
+    )
+    assert saved_paths[0].endswith(fl.OUTPUT_EXTENSIONS[output_format])
+
+    loaded = fl.load_timeseries(func_filename, str(tmp_path), output_format)
+    assert np.allclose(loaded[0], data)
+
+    if output_format == "npy":
+        assert isinstance(loaded[0], np.memmap)
+        assert op.exists(saved_paths[0].replace(".npy", ".json"))
+
+        exported_paths = fl.export_tsv(saved_paths)
+        assert np.allclose(fl.load_output(exported_paths[0]), data)
+
+    with pytest.raises(ValueError):
+        fl.get_output_fills(fl.TIMESERIES_FILLS, "csv")
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_save_text(dtype, tmp_path):
+    import numpy as np
+
+    data = np.random.default_rng(seed=0).normal(size=(20, 4)).astype(dtype)
+    path = str(tmp_path / "data.tsv")
+    fl.save_text(path, data)
+
+    # The text is exact at the precision of the data
+    assert np.array_equal(fl.load_output(path).astype(dtype), data)
+
+
+def _fake_bids(tmp_path):
+    import json
+    import nibabel as nib
+    import numpy as np
+
+    filenames = []
+    runs = [("1", "1", 2.0, 2.0), ("1", "2", 1.0, 2.0), ("2", "1", 2.0, 3.0)]
+    for sub, ses, t_r, zoom in runs:
+        func_dir = tmp_path / f"sub-{sub}" / f"ses-{ses}" / "func"
+        func_dir.mkdir(parents=True)
+        stem = f"sub-{sub}_ses-{ses}_task-rest_desc-preproc_bold"
+        img = nib.Nifti1Image(np.zeros((3, 3, 3, 4)), np.diag([zoom, zoom, zoom, 1]))
+        nib.save(img, func_dir / f"{stem}.nii.gz")
+        (func_dir / f"{stem}.json").write_text(json.dumps({"RepetitionTime": t_r}))
+        filenames.append(str(func_dir / f"{stem}.nii.gz"))
+
+    description = {"Name": "fake", "BIDSVersion": "1.8.0", "DatasetType": "derivative"}
+    (tmp_path / "dataset_description.json").write_text(json.dumps(description))
+    return filenames
+
+
+def test_get_func_filenames_bids_index(tmp_path, monkeypatch):
+    import functools
+
+    filenames = _fake_bids(tmp_path / "bids")
+    index_dir = str(tmp_path / "index")
+    load_bids_index = functools.partial(fl.load_bids_index, index_dir=index_dir)
+    monkeypatch.setattr(fl, "load_bids_index", load_bids_index)
+
+    files, t_rs = fl.get_func_filenames_bids(str(tmp_path / "bids"))
+    assert files == [[filenames[0]], [filenames[1]], [filenames[2]]]
+    assert t_rs == [2.0, 1.0, 2.0]
+
+    files, _ = fl.get_func_filenames_bids(str(tmp_path / "bids"), ses_filter=["2"])
+    assert files == [[filenames[1]]]
+
+    files_pybids, t_rs_pybids = fl.get_func_filenames_bids(
+        str(tmp_path / "bids"), use_index=False
+    )
+    assert files_pybids == [[filenames[0]], [filenames[1]], [filenames[2]]]
+    assert t_rs_pybids == t_rs
+
+    # Unchanged files are not read again
+    def fail(filename):
+        raise AssertionError(f"{filename} should not be indexed again")
+
+    monkeypatch.setattr(fl, "index_func_file", fail)
+    index = fl.load_bids_index(str(tmp_path / "bids"), index_dir=index_dir)
+    assert index[filenames[2]]["affine"][0][0] == 3.0
+    assert index[filenames[0]]["entities"]["session"] == "1"
+
+
+def test_get_func_filenames_bids_index_raw(tmp_path, monkeypatch):
+    import functools
+    import json
+    import nibabel as nib
+    import numpy as np
+
+    root = tmp_path / "raw"
+    func_dir = root / "sub-1" / "func"
+    func_dir.mkdir(parents=True)
+    img = nib.Nifti1Image(np.zeros((3, 3, 3, 4)), np.eye(4))
+    nib.save(img, func_dir / "sub-1_task-rest_bold.nii.gz")
+    # Neither the uncompressed files nor the derivatives are discovered by PyBIDS
+    nib.save(img, func_dir / "sub-1_task-other_bold.nii")
+    derivatives_dir = root / "derivatives" / "fmriprep" / "sub-1" / "func"
+    derivatives_dir.mkdir(parents=True)
+    nib.save(img, derivatives_dir / "sub-1_task-rest_desc-preproc_bold.nii.gz")
+    # The repetition time is inherited from the top-level sidecar
+    (root / "task-rest_bold.json").write_text(json.dumps({"RepetitionTime": 0.8}))
+    (root / "task-other_bold.json").write_text(json.dumps({"RepetitionTime": 3.0}))
+    description = {"Name": "fake", "BIDSVersion": "1.8.0"}
+    (root / "dataset_description.json").write_text(json.dumps(description))
+
+    load_bids_index = functools.partial(
+        fl.load_bids_index, index_dir=str(tmp_path / "index")
+    )
+    monkeypatch.setattr(fl, "load_bids_index", load_bids_index)
+
+    files, t_rs = fl.get_func_filenames_bids(str(root))
+    assert files == [[str(func_dir / "sub-1_task-rest_bold.nii.gz")]]
+    assert t_rs == [0.8]
+    assert (files, t_rs) == fl.get_func_filenames_bids(str(root), use_index=False)
+
+
+def test_get_sidecar_metadata(tmp_path):
+    import json
+
+    func_dir = tmp_path / "sub-1" / "func"
+    func_dir.mkdir(parents=True)
+    filename = func_dir / "sub-1_task-rest_run-1_bold.nii.gz"
+    sidecars = {
+        tmp_path / "bold.json": {"RepetitionTime": 1.0, "Top": True},
+        tmp_path / "task-rest_bold.json": {"RepetitionTime": 2.0},
+        func_dir / "sub-1_task-rest_bold.json": {"RepetitionTime": 3.0},
+        func_dir / "sub-1_task-other_bold.json": {"RepetitionTime": 4.0},
+    }
+    for sidecar, metadata in sidecars.items():
+        sidecar.write_text(json.dumps(metadata))
+
+    metadata = fl.get_sidecar_metadata(str(filename), str(tmp_path))
+    assert metadata == {"RepetitionTime": 3.0, "Top": True}
+    # Without a root, only the directory of the file is searched
+    assert fl.get_sidecar_metadata(str(filename)) == {"RepetitionTime": 3.0}
+
+
+def test_shared_confounds_files(tmp_path, monkeypatch):
+    import importlib
+
+    nilearn_load_confounds = importlib.import_module(
+        "nilearn.interfaces.fmriprep.load_confounds"
+    )
+    original = nilearn_load_confounds.load_confounds_file_as_dataframe
+
+    confounds_file = tmp_path / "sub-1_task-rest_desc-confounds_timeseries.tsv"
+    pd.DataFrame({"trans_x": [0.0, 1.0], "csf": [2.0, 3.0]}).to_csv(
+        confounds_file, sep="\t", index=False
+    )
+
+    calls = []
+    monkeypatch.setattr(
+        nilearn_load_confounds,
+        "load_confounds_file_as_dataframe",
+        lambda path: calls.append(path) or original(path),
+    )
+    patched = nilearn_load_confounds.load_confounds_file_as_dataframe
+
+    with fl.shared_confounds_files():
+        first = nilearn_load_confounds.load_confounds_file_as_dataframe(
+            str(confounds_file)
+        )
+        first["trans_x"] = 10.0
+        second = nilearn_load_confounds.load_confounds_file_as_dataframe(
+            str(confounds_file)
+        )
+
+    assert len(calls) == 1
+    assert second["trans_x"].tolist() == [0.0, 1.0]
+    assert nilearn_load_confounds.load_confounds_file_as_dataframe is patched
+
+    # A NiLearn release without the private loader fails loudly
+    monkeypatch.delattr(nilearn_load_confounds, "load_confounds_file_as_dataframe")
+    with pytest.raises(ValueError, match="load_confounds_file_as_dataframe"):
+        with fl.shared_confounds_files():
+            pass
+
+
+def test_load_confounds_cached(tmp_path):
+    confounds_file = tmp_path / "sub-1_task-rest_desc-confounds_timeseries.tsv"
+    expected = pd.DataFrame(
+        {"trans_x": [float("nan"), 1.0, 2.0], "csf": [2.0, 3.0, 4.0]}
+    )
+    expected.to_csv(confounds_file, sep="\t", index=False, na_rep="n/a")
+    cache_dir = str(tmp_path / "cache")
+
+    calls = []
+
+    def load_dataframe(path):
+        calls.append(path)
+        return pd.read_csv(path, sep="\t", na_values="n/a")
+
+    first = fl.load_confounds_cached(
+        str(confounds_file), cache_dir, load_dataframe=load_dataframe
+    )
+    second = fl.load_confounds_cached(
+        str(confounds_file), cache_dir, load_dataframe=load_dataframe
+    )
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(first, expected)
+    pd.testing.assert_frame_equal(second, expected)
+
+    # A modified file is parsed again
+    os.utime(confounds_file, ns=(0, 0))
+    fl.load_confounds_cached(
+        str(confounds_file), cache_dir, load_dataframe=load_dataframe
+    )
+    assert len(calls) == 2
+
+
+def test_select_shard():
+    func_filenames = [
+        [
+            f"/data/sub-{sub:02d}/ses-{ses}/func/"
+            f"sub-{sub:02d}_ses-{ses}_task-rest_run-{run}_bold.nii.gz"
+            for sub in range(1, 6)
+            for ses in range(1, 4)
+            for run in range(1, 3)
+        ],
+        ["/data/sub-01/ses-1/func/sub-01_ses-1_task-movie_bold.nii.gz"],
+    ]
+    t_r_list = [1.6, 2.0]
+
+    shards = [fl.select_shard(func_filenames, t_r_list, (i, 3)) for i in (1, 2, 3)]
+
+    # The shards partition the files
+    shard_files = [list(chain.from_iterable(groups)) for groups, _ in shards]
+    assert sorted(chain.from_iterable(shard_files)) == sorted(
+        chain.from_iterable(func_filenames)
+    )
+    for groups, t_rs in shards:
+        assert len(groups) == len(t_rs)
+        assert all(len(group) for group in groups)
+
+    # All the runs of a session belong to the same shard
+    for files in shard_files:
+        sessions = {op.basename(file).split("_task")[0] for file in files}
+        for other in shard_files:
+            if other is not files:
+                assert not sessions & {
+                    op.basename(file).split("_task")[0] for file in other
+                }
+
+    assert fl.get_shard_filename("out/fMRI_duration.csv", (2, 3)) == (
+        "out/fMRI_duration_shard-2of3.csv"
+    )
+    assert fl.get_shard_filename("out/fMRI_duration.csv", None) == (
+        "out/fMRI_duration.csv"
+    )
+
+
+@pytest.mark.parametrize("shard", ["0/2", "3/2", "1", "a/b"])
+def test_parse_shard_invalid(shard):
+    assert fl.parse_shard("2/4") == (2, 4)
+    with pytest.raises(ValueError):
+        fl.parse_shard(shard)
@@ -0,0 +1,54 @@
+import json
+import os
+import pstats
+import fmri.profiling as fp
+
+
+def _job(n_items):
+    with fp.span("inner", items=n_items) as record:
+        record["done"] = True
+    return sum(range(n_items))
+
+
+def test_span_nesting(tmp_path):
+    profiler = fp.Profiler()
+    with profiler.span("outer", files=2):
+        with profiler.span("inner"):
+            pass
+        with profiler.span("inner"):
+            pass
+
+    (outer,) = profiler.spans
+    assert outer["files"] == 2
+    assert [child["name"] for child in outer["children"]] == ["inner", "inner"]
+    for record in [outer, *outer["children"]]:
+        assert record["wall_s"] >= 0
+        assert record["cpu_s"] >= 0
+        assert record["peak_rss_mb"] > 0
+
+    profile_file = str(tmp_path / fp.PROFILE_FILE)
+    profiler.save(profile_file, n_procs=1)
+    with open(profile_file) as f:
+        profile = json.load(f)
+    assert profile["n_procs"] == 1
+    assert profile["spans"][0]["children"][1]["name"] == "inner"
+
+
+def test_run_profiled(tmp_path):
+    profile_dir = str(tmp_path / fp.PROFILE_DIR)
+
+    with fp.span("caller"):
+        result, spans = fp.run_profiled(_job, 10, profile_dir=profile_dir)
+        # The spans of the job are not recorded in those of the caller
+        assert fp.PROFILER._stack[-1]["children"] == []
+        fp.PROFILER.attach(spans)
+
+    assert result == 45
+    (job,) = spans
+    assert job["name"] == "_job"
+    assert job["children"][0] == {**job["children"][0], "items": 10, "done": True}
+    assert fp.PROFILER.spans[-1]["children"] == spans
+
+    (stats_file,) = os.listdir(profile_dir)
+    stats = pstats.Stats(os.path.join(profile_dir, stats_file))
+    assert any(function[2] == "_job" for function in stats.stats)
@@ -0,0 +1,53 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+import fmri.reports as fr
+
+
+@pytest.mark.parametrize("shape", [(5000, 300), (300, 1000), (100, 50)])
+def test_block_average(shape):
+    rng = np.random.default_rng(seed=0)
+    data = rng.normal(size=shape)
+
+    averaged = fr.block_average(data, fr.MAX_CARPET_SHAPE)
+    assert averaged.shape == tuple(
+        min(size, max_size) for size, max_size in zip(shape, fr.MAX_CARPET_SHAPE)
+    )
+    # Block averages stay within the range of the data
+    assert averaged.min() >= data.min() and averaged.max() <= data.max()
+    assert np.isclose(averaged.mean(), data.mean(), atol=1e-2)
+    if averaged.shape == shape:
+        assert np.array_equal(averaged, data)
+
+
+@pytest.mark.parametrize("n_timepoints", [10000, 1001, 500])
+def test_signal_envelope(n_timepoints):
+    rng = np.random.default_rng(seed=0)
+    timeseries = rng.normal(size=(n_timepoints, 4)).cumsum(axis=0)
+
+    x_plot, envelope = fr.signal_envelope(timeseries)
+    assert len(x_plot) == envelope.shape[0] <= fr.MAX_SIGNAL_POINTS
+    assert envelope.shape[1] == 4
+    assert np.all(np.diff(x_plot) >= 0)
+    assert 0 <= x_plot[0] and x_plot[-1] <= n_timepoints - 1
+    # The peaks of the signals are preserved
+    assert np.array_equal(envelope.min(axis=0), timeseries.min(axis=0))
+    assert np.array_equal(envelope.max(axis=0), timeseries.max(axis=0))
+    if n_timepoints <= fr.MAX_SIGNAL_POINTS:
+        assert np.array_equal(envelope, timeseries)
+
+
+@pytest.mark.parametrize("n_regions", [1024, 129, 64])
+def test_set_region_ticks(n_regions):
+    labels = [f"region {i}" for i in range(n_regions)]
+    _, ax = plt.subplots()
+
+    fr.set_region_ticks(ax, labels, scale=2)
+    tick_labels = [label.get_text() for label in ax.get_yticklabels()]
+    assert 0 < len(tick_labels) <= fr.MAX_TICK_LABELS
+    assert tick_labels[0] == labels[0]
+    assert set(tick_labels) <= set(labels)
+    assert ax.get_yticks()[1] == 2 * labels.index(tick_labels[1])
+    if n_regions <= fr.MAX_TICK_LABELS:
+        assert tick_labels == labels
+    plt.close()